@@ -0,0 +1,126 @@
+import itertools
+import json
+import math
+import random
+import click
+from . import commands
+from .results import connect
+
+
+@commands.command()
+@click.option('--results-db', default="results.db", help="SQLite database with the recorded results, default=results.db")
+@click.option('--list', 'list_sessions', is_flag=True, help="List the recorded sessions and exit")
+@click.option('-a', '--baseline', default="", help="Session (or a unique prefix of it) to compare against, default is the second latest session")
+@click.option('-b', '--candidate', default="", help="Session (or a unique prefix of it) to compare, default is the latest session")
+@click.option('-t', '--target', default="", help="Only consider sessions of this target when choosing the default sessions")
+@click.option('--alpha', default=0.05, help="Significance level for the permutation test, default=0.05")
+def compare(results_db, list_sessions, baseline, candidate, target, alpha):
+    db = connect(results_db)
+    if list_sessions:
+        _list_sessions(db)
+        return
+    sessions = [row["session"] for row in db.execute("SELECT session FROM sessions WHERE ? = '' OR target = ? ORDER BY session DESC", (target, target))]
+    if baseline:
+        baseline = _resolve(db, baseline)
+    if candidate:
+        candidate = _resolve(db, candidate)
+    if not baseline or not candidate:
+        if len(sessions) < 2:
+            print("ERROR: At least two sessions are needed for a comparison")
+            return
+        candidate = candidate or sessions[0]
+        baseline = baseline or sessions[1]
+    runs_a = _runs(db, baseline)
+    runs_b = _runs(db, candidate)
+    print(f"Baseline:  {_describe(db, baseline, runs_a)}")
+    print(f"Candidate: {_describe(db, candidate, runs_b)}")
+    print(f"Delta in % of the baseline, * marks a significant difference (permutation test, alpha={alpha})")
+    print(f"Run\tMetric\tBaseline\tCandidate\tDelta %\tp-value\tRuns")
+    for name in [name for name in runs_a.keys() if name in runs_b]:
+        metrics_a = _metrics(runs_a[name])
+        metrics_b = _metrics(runs_b[name])
+        for metric in [metric for metric in metrics_a.keys() if metric in metrics_b]:
+            values_a, values_b = metrics_a[metric], metrics_b[metric]
+            mean_a, mean_b = sum(values_a)/len(values_a), sum(values_b)/len(values_b)
+            delta = (mean_b - mean_a) / mean_a * 100 if mean_a else float("nan")
+            p_value = permutation_test(values_a, values_b)
+            marker = "*" if p_value < alpha else " "
+            print(f"{name}\t{metric}\t{mean_a:10.3f}\t{mean_b:10.3f}\t{delta:+7.1f}{marker}\t{p_value:7.3f}\t{len(values_a)}/{len(values_b)}")
+        if {run["config_hash"] for run in runs_a[name]} != {run["config_hash"] for run in runs_b[name]}:
+            print(f"{name}\tNote: the run configs differ between the sessions")
+
+
+def _list_sessions(db):
+    print("Session\tCommand\tTarget\tRuns\tDatabase version")
+    for session in db.execute("SELECT * FROM sessions ORDER BY session"):
+        runs = list(db.execute("SELECT database_version FROM runs WHERE session = ?", (session["session"],)))
+        versions = ", ".join(sorted({run["database_version"] or "unknown" for run in runs}))
+        print(f"{session['session']}\t{session['command']}\t{session['target']}\t{len(runs)}\t{versions}")
+
+
+def _resolve(db, prefix):
+    sessions = [row["session"] for row in db.execute("SELECT session FROM sessions WHERE session LIKE ?", (prefix + "%",))]
+    if len(sessions) != 1:
+        raise click.ClickException(f"Session {prefix} is unknown or not unique")
+    return sessions[0]
+
+
+def _runs(db, session):
+    """Returns the runs of a session grouped by their name"""
+    runs = dict()
+    for run in db.execute("SELECT * FROM runs WHERE session = ? ORDER BY id", (session,)):
+        runs.setdefault(run["name"], list()).append(run)
+    return runs
+
+
+def _describe(db, session, runs):
+    row = db.execute("SELECT * FROM sessions WHERE session = ?", (session,)).fetchone()
+    all_runs = [run for name_runs in runs.values() for run in name_runs]
+    versions = ", ".join(sorted({f"{run['database_version']} ({run['driver_version']})" for run in all_runs}))
+    return f"{session} {row['command']} {row['target']}: {versions}"
+
+
+def _metrics(runs):
+    """Returns the values per metric over the repetitions of a run. Throughput and insert latencies for insert runs,
+    the average duration of every query for query runs, queries per second and latencies of every query for point runs"""
+    metrics = dict()
+    for run in runs:
+        if run["ops_per_second"] is not None:
+            metrics.setdefault("queries/s" if run["test"] == "point" else "inserts/s", list()).append(run["ops_per_second"])
+        if run["latency_p50"] is not None:
+            metrics.setdefault("p50 ms", list()).append(run["latency_p50"]*1000)
+            metrics.setdefault("p99 ms", list()).append(run["latency_p99"]*1000)
+        report = json.loads(run["report"])
+        queries = report.get("queries", dict())
+        if run["test"] == "mixed":
+            queries = queries.get("queries", dict())
+        if run["test"] == "point":
+            for query, stats in queries.items():
+                metrics.setdefault(f"{query} queries/s", list()).append(stats["queries_per_second"])
+                if stats["latency"]:
+                    metrics.setdefault(f"{query} p50 ms", list()).append(stats["latency"]["p50"]*1000)
+                    metrics.setdefault(f"{query} p99 ms", list()).append(stats["latency"]["p99"]*1000)
+            continue
+        for query, stats in queries.items():
+            metrics.setdefault(f"{query} s", list()).append(stats["avg"])
+    return metrics
+
+
+def permutation_test(values_a, values_b, rounds=10000):
+    """Two-sided permutation test for the difference of the means of two samples, returns the p-value. All splits of the
+    pooled values are checked if there are at most rounds of them, otherwise rounds random ones"""
+    observed = abs(sum(values_b)/len(values_b) - sum(values_a)/len(values_a))
+    pooled = list(values_a) + list(values_b)
+    count, total = 0, 0
+    if math.comb(len(pooled), len(values_a)) <= rounds:
+        splits = (set(indices) for indices in itertools.combinations(range(len(pooled)), len(values_a)))
+    else:
+        splits = (set(random.sample(range(len(pooled)), len(values_a))) for _ in range(rounds))
+    for split in splits:
+        group_a = [value for index, value in enumerate(pooled) if index in split]
+        group_b = [value for index, value in enumerate(pooled) if index not in split]
+        # Allow for rounding errors so the observed split itself always counts
+        if abs(sum(group_b)/len(group_b) - sum(group_a)/len(group_a)) >= observed - 1e-9:
+            count += 1
+        total += 1
+    return count / total
@@ -0,0 +1,42 @@
+import base64
+import json
+import click
+import yaml
+from . import commands
+from .run import one_run
+
+
+@commands.command(name="prepare-dataset")
+@click.option('-t', '--target', required=True, help="Name of the target")
+@click.option('-c', '--config', default="config.yaml", help="Name of the config file to use")
+@click.option('-w', '--workers', default=1, help="Number of workers to prepare a dataset for")
+@click.option('-d', '--dataset', required=True, help="Name of the dataset, use the same name with '--extra-option dataset=<name>' for the insert test")
+@click.option("--num-inserts", default=10000, help="Number of events per worker, default=10000")
+@click.option("--extra-option", multiple=True, help="Extra options for the database module")
+@click.option("--timeout", default=0, help="Timeout in seconds to wait for the workers to complete, or set to 0 to disable timeout. default=0")
+def prepare_dataset(target, config, workers, dataset, num_inserts, extra_option, timeout):
+    config = _read_config(config)
+    target_config = config["targets"][target]
+    namespace = config.get("namespace", "default")
+    run_config, target_module = _prepare_run_config(target_config, dataset, num_inserts, extra_option)
+    results = one_run(workers, run_config, target_module, timeout, namespace)
+    print(f"Prepared dataset {dataset} with {results['sum']['operations']} events for {workers} workers")
+
+
+def _prepare_run_config(target_config, dataset, num_inserts, extra_options):
+    config = dict(target_config)
+    config.update({
+        "task": "prepare-dataset",
+        "dataset": dataset,
+        "num_inserts": num_inserts,
+    })
+    for option in extra_options:
+        k, v = option.split("=", 1)
+        config[k] = v
+    return base64.b64encode(json.dumps(config).encode("utf-8")).decode("utf-8"), config["module"]
+
+
+def _read_config(config_file):
+    with open(config_file) as f:
+        config = yaml.safe_load(f)
+    return config
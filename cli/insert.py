@@ -1,10 +1,13 @@
 import base64
 import json
+import os
 import sys
 import click
 import yaml
 from . import commands
+from .results import open_store
 from .run import one_run
+from .stats import summarize
 
 
 
@@ -13,6 +16,8 @@ from .run import one_run
 @click.option('-c', '--config', default="config.yaml", help="Name of the config file to use")
 @click.option('-w', '--workers', default="1,4,8,12,16", help="Sets of worker counts to use, separate by comma without space, default='1,4,8,12,16'")
 @click.option('-r', '--runs', default=3, help='Number of runs per worker count, default=3')
+@click.option('--tolerance', default=0.0, help="Keep repeating the runs of a worker count until the 95% confidence interval of the throughput is narrower than this share of the mean (e.g. 0.05), default 0 does exactly --runs runs")
+@click.option('--max-runs', default=10, help="Upper limit for the number of runs per worker count with --tolerance, default=10")
 @click.option("--primary-key", default="db", type=click.Choice(['sql', 'db', 'client', 'uuid', 'none'], case_sensitive=False))
 @click.option("--tables", default="single", type=click.Choice(['single', 'multiple'], case_sensitive=False))
 @click.option("--num-inserts", default=10000, help="Number of inserts per worker, default=10000")
@@ -22,7 +27,13 @@ from .run import one_run
 @click.option("--batch", default=0, help="Number of events to insert in one batch, default 0 disables batch mode")
 @click.option('--clean/--no-clean', default=True, help="Clean up the database before each run, enabled by default")
 @click.option('--steps', default=0, help="Do x insert runs without cleaning the database inbetween")
-def insert(target, config, workers, runs, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch, clean, steps):
+@click.option('--client-ceiling', is_flag=True, help="Additionally measure the client-side throughput ceiling per worker core by running the insert path against a null sink")
+@click.option('--target-rate', default="", help="Open-loop mode: send events at a fixed rate (events/s per worker) instead of as fast as possible. Separate several rates by comma")
+@click.option('--timeseries-dir', default="", help="Write the per-second throughput time series of every run as CSV files into this directory")
+@click.option('--duration', default=0, help="Let every worker insert for this many seconds instead of a fixed number of inserts, default 0 uses --num-inserts")
+@click.option('--results-db', default="results.db", help="SQLite database the results of every run are stored in for the compare command, set to an empty string to disable, default=results.db")
+@click.option('--ingest-indices', default="", help="Measure the insert throughput with each of these indices (separate by comma) present during ingest and compare it to a run without indices")
+def insert(target, config, workers, runs, tolerance, max_runs, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch, clean, steps, client_ceiling, target_rate, timeseries_dir, duration, results_db, ingest_indices):
     worker_counts = list(map(lambda el: int(el), workers.split(",")))
     config = _read_config(config)
     target_config = config["targets"][target]
@@ -36,41 +47,148 @@ def insert(target, config, workers, runs, primary_key, tables, num_inserts, pref
     if steps and prefill:
         print("ERROR: --steps and --prefill cannot be used at the same time")
         sys.exit(1)
+    if steps and target_rate:
+        print("ERROR: --steps and --target-rate cannot be used at the same time")
+        sys.exit(1)
+    if tolerance and (steps or target_rate):
+        print("ERROR: --tolerance can not be used together with --steps or --target-rate")
+        sys.exit(1)
+    if ingest_indices and (steps or target_rate or tolerance):
+        print("ERROR: --ingest-indices can not be used together with --steps, --target-rate or --tolerance")
+        sys.exit(1)
+    if duration:
+        extra_option = list(extra_option) + [f"duration={duration}"]
+    open_store(results_db, target, "insert")
 
-    if steps:
-        _steps_test(target_config, worker_counts[0], namespace, primary_key, tables, num_inserts, extra_option, timeout, batch, clean, steps)
+    if target_rate:
+        target_rates = list(map(lambda el: float(el), target_rate.split(",")))
+        _rate_test(target_config, worker_counts, namespace, runs, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch, clean, target_rates, timeseries_dir)
+    elif ingest_indices:
+        _ingest_indices_test(target_config, worker_counts, namespace, runs, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch, clean, ingest_indices.split(","), timeseries_dir)
+    elif steps:
+        _steps_test(target_config, worker_counts[0], namespace, primary_key, tables, num_inserts, extra_option, timeout, batch, clean, steps, timeseries_dir)
     else:
-        _normal_test(target_config, worker_counts, namespace, runs, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch, clean)
+        _normal_test(target_config, worker_counts, namespace, runs, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch, clean, timeseries_dir, tolerance, max_runs)
+    if client_ceiling:
+        _client_ceiling_test(target_config, namespace, primary_key, tables, num_inserts, extra_option, timeout, batch)
 
 
-def _normal_test(target_config, worker_counts, namespace, runs, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch, clean):
+def _normal_test(target_config, worker_counts, namespace, runs, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch, clean, timeseries_dir, tolerance=0, max_runs=0):
     run_config, target_module = _prepare_run_config(target_config, primary_key, tables, num_inserts, prefill, int(batch) if batch else None, clean, extra_option)
 
-    print(f"Workers\tMin\tMax\tAvg")
+    print(f"Workers\tRuns\tMin\tMax\tAvg\tMedian\tp95\tStdev\tCI low\tCI high\tOverlap\tp50 ms\tp99 ms\tp99.9 ms")
     for worker_count in worker_counts:
-        run_results = [one_run(worker_count, run_config, target_module, timeout, namespace)["sum"]["ops_per_second"] for _ in range(runs)]
+        results = list()
+        while True:
+            run = len(results)
+            results.append(one_run(worker_count, run_config, target_module, timeout, namespace, timeseries_file=_timeseries_file(timeseries_dir, f"workers{worker_count}-run{run}"), name=f"workers{worker_count}"))
+            summary = summarize([result["sum"]["ops_per_second"] for result in results])
+            # The interval of fewer than three runs says little, so --tolerance always does at least three
+            if len(results) < max(runs, 3 if tolerance else 1):
+                continue
+            # Only spend more runs on worker counts whose result is still uncertain
+            if not tolerance or len(results) >= max_runs or summary["ci_high"] - summary["ci_low"] <= tolerance * summary["mean"]:
+                break
+        run_results = [result["sum"]["ops_per_second"] for result in results]
         result_min = round(min(run_results))
         result_max = round(max(run_results))
-        result_avg = round(int(sum(run_results)/len(run_results)))
-        print(f"{worker_count:2}\t{result_min:6}\t{result_max:6}\t{result_avg:6}")
+        result_avg = round(summary["mean"])
+        result_median, result_p95, result_stdev, ci_low, ci_high = [round(summary[key]) for key in ["median", "p95", "stdev", "ci_low", "ci_high"]]
+        # Throughput in the wall-clock window in which all workers were inserting, averaged over the runs
+        overlap_results = [result["sum"]["overlap_ops_per_second"] for result in results if result["sum"].get("overlap_ops_per_second")]
+        overlap_avg = f"{round(sum(overlap_results)/len(overlap_results)):6}" if overlap_results else "     -"
+        # Batch latency percentiles averaged over the runs
+        p50, p99, p999 = [_format_ms(_average_latency(results, key), width) for key, width in [("p50", 6), ("p99", 6), ("p999", 8)]]
+        print(f"{worker_count:2}\t{len(results):4}\t{result_min:6}\t{result_max:6}\t{result_avg:6}\t{result_median:6}\t{result_p95:6}\t{result_stdev:6}\t{ci_low:6}\t{ci_high:7}\t{overlap_avg}\t{p50}\t{p99}\t{p999}")
+        for index in summary["outliers"]:
+            print(f"WARNING: Run {index} with {worker_count} workers is an outlier with {round(run_results[index])} inserts/s, check it before relying on the average")
+        if tolerance and summary["ci_high"] - summary["ci_low"] > tolerance * summary["mean"]:
+            print(f"WARNING: The confidence interval with {worker_count} workers is still wider than the tolerance after {len(results)} runs")
+
+
+def _rate_test(target_config, worker_counts, namespace, runs, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch, clean, target_rates, timeseries_dir):
+    print(f"Rate\tWorkers\tInserts/s\tp50 ms\tp99 ms\tp99.9 ms\tMax ms")
+    for target_rate in target_rates:
+        run_config, target_module = _prepare_run_config(target_config, primary_key, tables, num_inserts, prefill, int(batch) if batch else None, clean, list(extra_option) + [f"target_rate={target_rate}"])
+        for worker_count in worker_counts:
+            run_results = [one_run(worker_count, run_config, target_module, timeout, namespace, timeseries_file=_timeseries_file(timeseries_dir, f"rate{round(target_rate)}-workers{worker_count}-run{run}"), name=f"rate{round(target_rate)}-workers{worker_count}") for run in range(runs)]
+            result_avg = round(sum([result["sum"]["ops_per_second"] for result in run_results])/len(run_results))
+            # Report the latencies of the worst run so a single bad run is not hidden by averaging
+            latency = max([result["latency"] for result in run_results if result["latency"]], key=lambda latency: latency["p99"], default=dict())
+            p50, p99, p999, latency_max = [_format_ms(latency.get(key), width) for key, width in [("p50", 6), ("p99", 6), ("p999", 8), ("max", 6)]]
+            print(f"{round(target_rate):6}\t{worker_count:2}\t{result_avg:9}\t{p50}\t{p99}\t{p999}\t{latency_max}")
+
+
+def _ingest_indices_test(target_config, worker_counts, namespace, runs, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch, clean, indices, timeseries_dir):
+    """Runs the inserts without any index, with every single index and with all of them and reports the throughput loss
+    against the run without index"""
+    variants = ["none"] + indices + (["all"] if len(indices) > 1 else [])
+    print(f"Workers\tIndex\tInserts/s\tLoss %\tp99 ms")
+    for worker_count in worker_counts:
+        baseline = None
+        for variant in variants:
+            option = ",".join(indices) if variant == "all" else variant
+            run_config, target_module = _prepare_run_config(target_config, primary_key, tables, num_inserts, prefill, int(batch) if batch else None, clean, list(extra_option) + [f"ingest_indices={option}"])
+            results = [one_run(worker_count, run_config, target_module, timeout, namespace, timeseries_file=_timeseries_file(timeseries_dir, f"index-{variant}-workers{worker_count}-run{run}"), name=f"index-{variant}-workers{worker_count}") for run in range(runs)]
+            result_avg = sum([result["sum"]["ops_per_second"] for result in results])/len(results)
+            p99 = _format_ms(_average_latency(results, "p99"), 6)
+            if baseline is None:
+                baseline = result_avg
+            loss = (baseline - result_avg) / baseline * 100 if baseline else 0
+            print(f"{worker_count:2}\t{variant}\t{round(result_avg):9}\t{loss:6.1f}\t{p99}")
+
 
+def _average_latency(results, key):
+    """Average of a batch latency percentile over the runs, runs without any recorded batch (e.g. 0 inserts) have no latency"""
+    latencies = [result["latency"][key] for result in results if result["latency"]]
+    return sum(latencies)/len(latencies) if latencies else None
 
-def _steps_test(target_config, workers, namespace, primary_key, tables, num_inserts, extra_option, timeout, batch, clean, steps):
+
+def _format_ms(value, width):
+    if value is None:
+        return "-".rjust(width)
+    return f"{value*1000:{width}.1f}"
+
+
+def _steps_test(target_config, workers, namespace, primary_key, tables, num_inserts, extra_option, timeout, batch, clean, steps, timeseries_dir):
     run_config, target_module = _prepare_run_config(target_config, primary_key, tables, num_inserts, 0, int(batch) if batch else None, clean, extra_option)
     run_config_continued, _ = _prepare_run_config(target_config, primary_key, tables, num_inserts, 0, int(batch) if batch else None, False, extra_option)
     stepsize = workers*num_inserts
     width = len(f"{stepsize*steps}")
-    print(f"Stepsize: {stepsize}")
+    duration = dict(option.split("=", 1) for option in extra_option).get("duration", target_config.get("duration"))
+    if duration:
+        # With a duration every step inserts a different number of events, so the level is summed up from the results
+        width = 12
+        print(f"Step duration: {duration}s")
+    else:
+        print(f"Stepsize: {stepsize}")
     print(f"Level".rjust(width)+"\tInserts/s")
+    level = 0
     for step in range(steps):
-        fill = f"{step*stepsize}".rjust(width)
-        inserts = int(round(one_run(workers, run_config, target_module, timeout, namespace)["sum"]["ops_per_second"], -1))
+        fill = f"{level}".rjust(width)
+        result = one_run(workers, run_config, target_module, timeout, namespace, timeseries_file=_timeseries_file(timeseries_dir, f"step{step}"), name=f"step{step}")["sum"]
+        inserts = int(round(result["ops_per_second"], -1))
+        level += result["operations"]
         run_config = run_config_continued
         print(f"{fill}\t{inserts:6}")
 
 
+def _client_ceiling_test(target_config, namespace, primary_key, tables, num_inserts, extra_option, timeout, batch):
+    extra_option = list(extra_option) + ["null_sink=true"]
+    run_config, target_module = _prepare_run_config(target_config, primary_key, tables, num_inserts, 0, int(batch) if batch else None, False, extra_option)
+    result = one_run(1, run_config, target_module, timeout, namespace, name="client-ceiling")["sum"]
+    print(f"Client ceiling (null sink): {round(result['ops_per_second'])} inserts/s per worker, {round(result['ops_per_cpu_second'])} inserts/s per worker core")
+
+
+def _timeseries_file(timeseries_dir, name):
+    if not timeseries_dir:
+        return None
+    return os.path.join(timeseries_dir, f"{name}.csv")
+
+
 def _prepare_run_config(target_config, primary_key, tables, num_inserts, prefill, batch, clean, extra_options):
-    config = target_config
+    # Work on a copy so the options of one test (e.g. target_rate) do not leak into the next one
+    config = dict(target_config)
     config.update({
         "task": "insert",
         "num_inserts": num_inserts,
@@ -40,6 +40,21 @@ class Kubernetes:
             time.sleep(5)
         raise Exception("Failed to wait for pods to terminate")
 
+    def restart_pods(self, namespace, label_key, label_value, timeout=600):
+        """Deletes the pods with the label and waits until their controller has replaced them with new pods that are ready"""
+        old_pods = set(pod.metadata.uid for pod in self.get_pods(namespace, label_key, label_value))
+        if not old_pods:
+            raise Exception(f"No pods with label {label_key}={label_value} found")
+        for pod in self.get_pods(namespace, label_key, label_value):
+            self.api_instance.delete_namespaced_pod(pod.metadata.name, namespace)
+        for _ in range(timeout//5):
+            time.sleep(5)
+            pods = [pod for pod in self.get_pods(namespace, label_key, label_value) if pod.metadata.uid not in old_pods and not pod.metadata.deletion_timestamp]
+            ready = [pod for pod in pods if any(condition.type == "Ready" and condition.status == "True" for condition in pod.status.conditions or [])]
+            if len(ready) >= len(old_pods):
+                return
+        raise Exception("Failed to wait for the restarted pods to become ready")
+
     def patch_socket(self):
         """Taken from https://github.com/kubernetes-client/python/blob/master/examples/pod_portforward.py and adapted
         """
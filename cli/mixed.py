@@ -0,0 +1,86 @@
+import click
+from . import commands
+from .insert import _format_ms, _prepare_run_config, _read_config, _timeseries_file
+from .results import open_store
+from .run import one_run
+
+
+# Number of times each query is executed in the query-only baseline run
+BASELINE_QUERY_RUNS = 3
+
+
+@commands.command()
+@click.option('-t', '--target', required=True, help="Name of the target")
+@click.option('-c', '--config', default="config.yaml", help="Name of the config file to use")
+@click.option('-w', '--workers', default="1,4,8", help="Sets of insert worker counts to use, separate by comma without space, default='1,4,8'")
+@click.option('-q', '--query-workers', default=1, help="Number of workers running queries during the inserts, default=1")
+@click.option('-r', '--runs', default=1, help='Number of runs per worker count, default=1')
+@click.option("--primary-key", default="db", type=click.Choice(['sql', 'db', 'client', 'uuid', 'none'], case_sensitive=False))
+@click.option("--tables", default="single", type=click.Choice(['single', 'multiple'], case_sensitive=False))
+@click.option("--num-inserts", default=10000, help="Number of inserts per insert worker, default=10000")
+@click.option("--prefill", default=0, help="Insert this number of events into the table before starting the test run, default=0")
+@click.option("--extra-option", multiple=True, help="Extra options for the database module")
+@click.option("--timeout", default=0, help="Timeout in seconds to wait for one run to complete. Increase this if you use higher number of inserts, or set to 0 to disable timeout. default=0")
+@click.option("--batch", default=0, help="Number of events to insert in one batch, default 0 disables batch mode")
+@click.option('--baseline', is_flag=True, help="Additionally do an insert-only run and a query-only run to show how much each side loses in the mixed run")
+@click.option('--timeseries-dir', default="", help="Write the per-second throughput time series of every run as CSV files into this directory")
+@click.option('--duration', default=0, help="Let every insert worker insert for this many seconds instead of a fixed number of inserts, default 0 uses --num-inserts")
+@click.option('--results-db', default="results.db", help="SQLite database the results of every run are stored in for the compare command, set to an empty string to disable, default=results.db")
+def mixed(target, config, workers, query_workers, runs, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch, baseline, timeseries_dir, duration, results_db):
+    worker_counts = list(map(lambda el: int(el), workers.split(",")))
+    config = _read_config(config)
+    target_config = config["targets"][target]
+    namespace = config.get("namespace", "default")
+    batch = int(batch) if batch else None
+    if duration:
+        extra_option = list(extra_option) + [f"duration={duration}"]
+    open_store(results_db, target, "mixed")
+    mixed_options = list(extra_option) + ["task=mixed", f"query_workers={query_workers}"]
+    run_config, target_module = _prepare_run_config(dict(target_config), primary_key, tables, num_inserts, prefill, batch, True, mixed_options)
+    for worker_count in worker_counts:
+        for run in range(runs):
+            results = one_run(worker_count+query_workers, run_config, target_module, timeout, namespace, endpoint="/report/mixed",
+                              timeseries_file=_timeseries_file(timeseries_dir, f"mixed-workers{worker_count}-run{run}"), name=f"mixed-workers{worker_count}")
+            baseline_results = None
+            if baseline:
+                baseline_results = _baseline_runs(target_config, worker_count, namespace, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch)
+            _print_results(worker_count, query_workers, results, baseline_results)
+
+
+def _baseline_runs(target_config, worker_count, namespace, primary_key, tables, num_inserts, prefill, extra_option, timeout, batch):
+    """Runs the same inserts without queries and afterwards the queries without inserts on the resulting data"""
+    run_config, target_module = _prepare_run_config(dict(target_config), primary_key, tables, num_inserts, prefill, batch, True, extra_option)
+    insert_results = one_run(worker_count, run_config, target_module, timeout, namespace, name=f"baseline-workers{worker_count}")
+    query_options = list(extra_option) + ["task=query", f"runs={BASELINE_QUERY_RUNS}"]
+    run_config, target_module = _prepare_run_config(dict(target_config), primary_key, tables, num_inserts, prefill, batch, False, query_options)
+    query_results = one_run(1, run_config, target_module, timeout, namespace, endpoint="/report/queries", name=f"baseline-queries-workers{worker_count}")
+    return dict(insert=insert_results, queries=query_results)
+
+
+def _print_results(worker_count, query_workers, results, baseline_results):
+    inserts = results["insert"]["sum"]["ops_per_second"]
+    p99 = _format_ms((results["insert"]["latency"] or dict()).get("p99"), 6)
+    print(f"Insert workers: {worker_count}, query workers: {query_workers}")
+    if baseline_results:
+        baseline_inserts = baseline_results["insert"]["sum"]["ops_per_second"]
+        loss = (1 - inserts/baseline_inserts)*100
+        print(f"Inserts/s\tp99 ms\tBaseline\tLoss %")
+        print(f"{round(inserts):9}\t{p99}\t{round(baseline_inserts):8}\t{loss:6.1f}")
+    else:
+        print(f"Inserts/s\tp99 ms")
+        print(f"{round(inserts):9}\t{p99}")
+    queries = results["queries"]["queries"]
+    max_name_len = max([len(name) for name in queries.keys()])
+    spacing = " " * (max_name_len - len("Query"))
+    if baseline_results:
+        print(f"Query{spacing}\tCount\tAvg  \tp99  \tBaseline\tSlowdown %")
+    else:
+        print(f"Query{spacing}\tCount\tAvg  \tp99  ")
+    for name, stats in queries.items():
+        spacing = " " * (max_name_len - len(name))
+        line = f"{name}{spacing}\t{stats['count']:5}\t{stats['avg']:>5.2f}\t{stats['p99']:>5.2f}"
+        if baseline_results:
+            baseline_avg = baseline_results["queries"]["queries"][name]["avg"]
+            slowdown = (stats['avg']/baseline_avg - 1)*100
+            line += f"\t{baseline_avg:>8.2f}\t{slowdown:10.1f}"
+        print(line)
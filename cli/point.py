@@ -0,0 +1,57 @@
+import base64
+import json
+import click
+from . import commands
+from .insert import _read_config
+from .results import open_store
+from .run import one_run
+
+
+@commands.command()
+@click.option('-t', '--target', required=True, help="Name of the target")
+@click.option('-c', '--config', default="config.yaml", help="Name of the config file to use")
+@click.option('-w', '--workers', default="1,4,8", help="Sets of worker counts to use, separate by comma without space, default='1,4,8'")
+@click.option('--clients', default=16, help="Number of concurrent clients (each with its own connection) per worker, default=16")
+@click.option('-r', '--runs', default=1, help='Number of runs per worker count, default=1')
+@click.option('--duration', default=30, help="Seconds every worker sends queries, default=30")
+@click.option('--queries', default="device-window,latest-devices", help="Point queries to send, separate by comma, default='device-window,latest-devices'")
+@click.option('--window', default=3.0, help="Length of the time window of device-window in hours, default=3")
+@click.option('--devices', default=50, help="Number of devices of latest-devices, default=50")
+@click.option("--extra-option", multiple=True, help="Extra options for the database module")
+@click.option("--timeout", default=0, help="Timeout in seconds to wait for one run to complete, or set to 0 to disable timeout. default=0")
+@click.option('--results-db', default="results.db", help="SQLite database the results of every run are stored in for the compare command, set to an empty string to disable, default=results.db")
+def point(target, config, workers, clients, runs, duration, queries, window, devices, extra_option, timeout, results_db):
+    worker_counts = list(map(lambda el: int(el), workers.split(",")))
+    config = _read_config(config)
+    target_config = config["targets"][target]
+    namespace = config.get("namespace", "default")
+    run_config, target_module = _prepare_run_config(target_config, clients, duration, queries, window, devices, extra_option)
+    open_store(results_db, target, "point")
+    print(f"Workers\tClients\tQuery         \tQueries/s\tp50 ms\tp99 ms\tp99.9 ms\tErrors")
+    for worker_count in worker_counts:
+        for run in range(runs):
+            results = one_run(worker_count, run_config, target_module, timeout, namespace, endpoint="/report/point", name=f"point-workers{worker_count}")
+            rows = list(results["queries"].items()) + [("all", dict(queries_per_second=results["sum"]["ops_per_second"], latency=results["latency"],
+                                                                     errors=results["sum"]["errors"]))]
+            for name, stats in rows:
+                if not stats["latency"]:
+                    print(f"{worker_count:7}\t{results['sum']['clients']:7}\t{name:14}\t{0:9}\t     -\t     -\t       -\t{stats['errors']:6}")
+                    continue
+                p50, p99, p999 = [stats["latency"][key]*1000 for key in ["p50", "p99", "p999"]]
+                print(f"{worker_count:7}\t{results['sum']['clients']:7}\t{name:14}\t{round(stats['queries_per_second']):9}\t{p50:6.1f}\t{p99:6.1f}\t{p999:8.1f}\t{stats['errors']:6}")
+
+
+def _prepare_run_config(target_config, clients, duration, queries, window, devices, extra_options):
+    config = dict(target_config)
+    config.update({
+        "task": "point",
+        "point_clients": clients,
+        "duration": duration,
+        "point_queries": queries,
+        "point_window": int(window*3600*1000),
+        "point_devices": devices,
+    })
+    for option in extra_options:
+        k, v = option.split("=", 1)
+        config[k] = v
+    return base64.b64encode(json.dumps(config).encode("utf-8")).decode("utf-8"), config["module"]
@@ -2,8 +2,11 @@ import base64
 import json
 import click
 import yaml
+from .kubernetes_helper import Kubernetes
+from .results import open_store
 from .run import one_run
 from . import commands
+from .stats import query_summary, variant_summary
 
 
 @commands.command()
@@ -11,26 +14,109 @@ from . import commands
 @click.option('-c', '--config', default="config.yaml", help="Name of the config file to use")
 @click.option('-w', '--workers', default=1, help="Number of workers to use")
 @click.option('-r', '--runs', default=3, help='Number of times each query should be executed, default=3')
+@click.option('--tolerance', default=0.0, help="Keep repeating the run until the 95% confidence interval of the duration of every query is narrower than this share of its mean (e.g. 0.05), default 0 does a single run")
+@click.option('--max-runs', default=10, help="Upper limit for the number of runs with --tolerance, default=10")
 @click.option("--extra-option", multiple=True, help="Extra options for the database module")
 @click.option("--timeout", default=0, help="Timeout in seconds to wait for one run to complete. Increase this if you use higher number of inserts, or set to 0 to disable timeout. default=0")
-def query(target, config, workers, runs, extra_option, timeout):
+@click.option('--results-db', default="results.db", help="SQLite database the results of every run are stored in for the compare command, set to an empty string to disable, default=results.db")
+@click.option('--restart-pods', default="", help="Restart the database pods with this label (e.g. app=postgresql) before the run so the first execution of every query is cold")
+def query(target, config, workers, runs, tolerance, max_runs, extra_option, timeout, results_db, restart_pods):
     config = _read_config(config)
     target_config = config["targets"][target]
     namespace = config.get("namespace", "default")
     run_config, target_module = _prepare_run_config(target_config, runs, extra_option)
-    results = one_run(workers, run_config, target_module, timeout, namespace, endpoint="/report/queries")
+    open_store(results_db, target, "query")
+    reports = list()
+    while True:
+        if restart_pods:
+            label_key, label_value = restart_pods.split("=", 1)
+            print(f"Restarting the pods with label {restart_pods}")
+            Kubernetes().restart_pods(namespace, label_key, label_value)
+        reports.append(one_run(workers, run_config, target_module, timeout, namespace, endpoint="/report/queries", name=f"queries-workers{workers}"))
+        results = reports[0] if len(reports) == 1 else _merge_runs(reports)
+        # Only spend more runs while the duration of some query is still uncertain
+        uncertain = [name for name, stats in results["queries"].items() if stats["ci_high"] - stats["ci_low"] > tolerance * stats["avg"]]
+        if not tolerance or not uncertain or len(reports) >= max_runs:
+            break
+    if len(reports) > 1:
+        print(f"Statistics over the executions of {len(reports)} runs")
     max_name_len = max([len(name) for name in results["queries"].keys()])
     spacing = " " * (max_name_len - len("Query"))
-    print(f"Query{spacing}\tMin  \tMax  \tAvg")
+    print(f"Query{spacing}\tMin  \tMax  \tAvg  \tMedian\tp95  \tStdev\tCI low\tCI high\tOutliers\tFirst\tSteady")
     for name, stats in results["queries"].items():
         spacing = " " * (max_name_len - len(name))
         result_min = round(stats['min'], 2)
         result_max = round(stats['max'], 2)
         result_avg = round(stats['avg'], 2)
-        print(f"{name}{spacing}\t{result_min:>5.2f}\t{result_max:>5.2f}\t{result_avg:>5.2f}")
+        first = f"{stats['first']:.2f}" if stats["first"] is not None else "-"
+        steady = f"{stats['steady']:.2f}" if stats["steady"] is not None else "-"
+        print(f"{name}{spacing}\t{result_min:>5.2f}\t{result_max:>5.2f}\t{result_avg:>5.2f}\t{stats['median']:>6.2f}\t{stats['p95']:>5.2f}\t{stats['stdev']:>5.2f}"
+              f"\t{stats['ci_low']:>6.2f}\t{stats['ci_high']:>7.2f}\t{stats['outliers']:8}\t{first:>5}\t{steady:>6}")
+    if results.get("variants"):
+        _print_variants(results["variants"], max_name_len)
+    plans = dict((name, stats["explain"]) for name, stats in results["queries"].items() if "explain" in stats)
+    if plans:
+        _print_plans(plans, max_name_len)
+    if tolerance and uncertain:
+        print(f"WARNING: The confidence interval of {', '.join(uncertain)} is still wider than the tolerance after {len(reports)} runs")
+
+
+def _merge_runs(reports):
+    """Combines the reports of several runs into one with the statistics of every query over the executions of all runs, computed
+    with the same function the collector uses for a single run"""
+    executions = dict()
+    for report in reports:
+        for worker in report["workers"].values():
+            for name, values in worker["results"].items():
+                executions.setdefault(name, list()).append(values)
+    queries = dict()
+    for name, worker_values in executions.items():
+        # The collector reports no first execution for queries that only ran on warm caches
+        summary = query_summary(worker_values, warm=reports[0]["queries"].get(name, dict()).get("first", 0) is None)
+        if summary is None:
+            continue
+        queries[name] = summary
+        if "explain" in reports[0]["queries"].get(name, dict()):
+            queries[name]["explain"] = reports[0]["queries"][name]["explain"]
+    return dict(queries=queries, variants=_merge_variants(queries, reports[0].get("variants", dict())))
+
+
+def _merge_variants(queries, variants):
+    """Compares the fastest formulation of every query of the variants report with its canonical form over all runs, using the
+    variants the collector matched to the query"""
+    report = dict()
+    for name, variant in variants.items():
+        if name in queries:
+            report[name] = variant_summary(queries, name, [candidate for candidate in variant["variants"] if candidate in queries])
+    return report
+
+
+def _print_variants(variants, max_name_len):
+    spacing = " " * (max_name_len - len("Query"))
+    print(f"Query{spacing}\tCanonical\tFastest\tSpeedup")
+    for name, variant in variants.items():
+        spacing = " " * (max_name_len - len(name))
+        speedup = f"{variant['speedup']:.1f}x" if variant["speedup"] else "-"
+        print(f"{name}{spacing}\t{variant['canonical_avg']:>9.2f}\t{variant['fastest']} ({variant['fastest_avg']:.2f})\t{speedup:>7}")
+
+
+def _print_plans(plans, max_name_len):
+    """Prints the summary of the captured plans, the full plans are in the report stored in the results database"""
+    spacing = " " * (max_name_len - len("Query"))
+    print(f"Query{spacing}\tTime ms\tHit blocks\tRead blocks\tRows scanned\tSlowest step")
+    for name, plan in plans.items():
+        spacing = " " * (max_name_len - len(name))
+        values = [_format(plan[key]) for key in ["time_ms", "buffer_hits", "buffer_reads", "rows_scanned"]]
+        print(f"{name}{spacing}\t{values[0]:>7}\t{values[1]:>10}\t{values[2]:>11}\t{values[3]:>12}\t{plan['slowest'] or '-'}")
+
+
+def _format(value):
+    if value is None:
+        return "-"
+    return f"{value:.1f}" if isinstance(value, float) else str(value)
 
 def _prepare_run_config(target_config, runs, extra_options):
-    config = target_config
+    config = dict(target_config)
     config.update({
         "task": "query",
         "runs": runs,
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import sqlite3
+from datetime import datetime
+
+
+# Every command invocation is one session, runs with the same name in a session are repetitions of the same measurement
+_store = None
+
+
+def open_store(path, target, command):
+    """Opens (and creates if needed) the SQLite results database, all following runs are recorded in a new session"""
+    global _store
+    if not path:
+        _store = None
+        return
+    connection = sqlite3.connect(path)
+    _create_tables(connection)
+    session = datetime.now().isoformat(timespec="milliseconds")
+    connection.execute("INSERT INTO sessions (session, command, target) VALUES (?, ?, ?)", (session, command, target))
+    connection.commit()
+    _store = dict(connection=connection, session=session, target=target)
+
+
+def _create_tables(connection):
+    connection.execute("""CREATE TABLE IF NOT EXISTS sessions (
+        session TEXT PRIMARY KEY,
+        command TEXT,
+        target TEXT
+    )""")
+    connection.execute("""CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session TEXT,
+        timestamp TEXT,
+        target TEXT,
+        module TEXT,
+        name TEXT,
+        test TEXT,
+        workers INTEGER,
+        run_config TEXT,
+        config_hash TEXT,
+        database_version TEXT,
+        driver_version TEXT,
+        ops_per_second REAL,
+        latency_p50 REAL,
+        latency_p99 REAL,
+        report TEXT
+    )""")
+
+
+def record_run(name, test, num_workers, run_config, target_module, version, report):
+    """Stores the report of one run if a results database was opened"""
+    if _store is None:
+        return
+    latency, ops_per_second = dict(), None
+    if test != "queries":
+        insert = report["insert"] if test == "mixed" else report
+        latency = insert.get("latency") or dict()
+        ops_per_second = insert["sum"]["ops_per_second"]
+    config_json = json.dumps(run_config, sort_keys=True)
+    _store["connection"].execute(
+        """INSERT INTO runs (session, timestamp, target, module, name, test, workers, run_config, config_hash, database_version,
+           driver_version, ops_per_second, latency_p50, latency_p99, report) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        (_store["session"], datetime.now().isoformat(timespec="seconds"), _store["target"], target_module, name, test, num_workers,
+         config_json, hashlib.sha1(config_json.encode("utf-8")).hexdigest()[:12], version.get("database"), version.get("driver"),
+         ops_per_second, latency.get("p50"), latency.get("p99"), json.dumps(_slim_report(report))))
+    _store["connection"].commit()
+
+
+def _slim_report(report):
+    """Drops the large histograms and profiles from a report before storing it"""
+    if isinstance(report, dict):
+        return dict((key, _slim_report(value)) for key, value in report.items() if key not in ["latency_histogram", "profile"])
+    return report
+
+
+def connect(path):
+    connection = sqlite3.connect(path)
+    connection.row_factory = sqlite3.Row
+    _create_tables(connection)
+    return connection
@@ -1,8 +1,12 @@
+import base64
+import csv
+import os
 import subprocess
 import time
 import urllib.request as urllib_request
 import json
 from .kubernetes_helper import Kubernetes
+from .results import record_run
 
 
 def http_request(url):
@@ -17,10 +21,30 @@ def http_request(url):
     raise Exception("http_request failed with retry")
 
 
-def one_run(num_workers, run_config, target_module, timeout, namespace, endpoint="/report/insert"):
+def write_timeseries(path, report):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    columns = ["time", "events_per_second", "events", "errors", "bytes_sent", "bytes_received", "workers"]
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for bucket in report["series"]:
+            writer.writerow([bucket[column] for column in columns])
+
+
+def saturated_workers(report):
+    """Returns the workers the collector flagged as CPU-saturated, for the mixed report from both of its parts"""
+    if "cpu_saturated_workers" in report:
+        return report["cpu_saturated_workers"]
+    return [name for part in report.values() if isinstance(part, dict) for name in part.get("cpu_saturated_workers", [])]
+
+
+def one_run(num_workers, run_config, target_module, timeout, namespace, endpoint="/report/insert", timeseries_file=None, name=None):
     kube = Kubernetes()
+    decoded_config = json.loads(base64.b64decode(run_config))
+    processes_per_worker = int(decoded_config.get("processes_per_worker", 1))
     res = subprocess.run(["helm", "install", "-n", namespace, "dbtest", ".", "--set", f"workers={num_workers}", "--set", f"run_config={run_config}", 
-                            "--set", f"target_module={target_module}", "--set", f"namespace={namespace}"], cwd="deployment", stdout=subprocess.DEVNULL)
+                            "--set", f"target_module={target_module}", "--set", f"namespace={namespace}", "--set", f"processes_per_worker={processes_per_worker}"],
+                            cwd="deployment", stdout=subprocess.DEVNULL)
     res.check_returncode()
     wait_time = 0
     while True:
@@ -35,6 +59,14 @@ def one_run(num_workers, run_config, target_module, timeout, namespace, endpoint
     collector_pod_name = kube.find_pod(namespace, "app", "dbtest-collector")
     kube.patch_socket()
     results = json.loads(http_request(f"http://{collector_pod_name}.pod.{namespace}.kubernetes:5000{endpoint}"))
+    saturated = saturated_workers(results)
+    if saturated:
+        print(f"WARNING: Workers {', '.join(saturated)} were CPU-saturated, the result measures the client rather than the database")
+    if timeseries_file:
+        write_timeseries(timeseries_file, json.loads(http_request(f"http://{collector_pod_name}.pod.{namespace}.kubernetes:5000/report/timeseries")))
+    version = json.loads(http_request(f"http://{collector_pod_name}.pod.{namespace}.kubernetes:5000/version"))
+    test = endpoint.rsplit("/", 1)[-1]
+    record_run(name or test, test, num_workers, decoded_config, target_module, version, results)
     res = subprocess.run(f"helm uninstall -n {namespace} dbtest".split(" "), stdout=subprocess.DEVNULL)
     res.check_returncode()
     kube.wait_for_pods_terminated(namespace, "app", "dbtest-worker")
@@ -0,0 +1,100 @@
+# Statistics over repeated measurements. Shared by the CLI and the collector: the Dockerfile copies this file into the
+# modules package of the simulator image
+import math
+import random
+import statistics
+
+
+# Number of resamples for the bootstrap confidence interval and the confidence level it covers
+BOOTSTRAP_RESAMPLES = 1000
+CONFIDENCE = 0.95
+# Values whose modified z-score (based on the median absolute deviation) is above this are flagged as outliers
+OUTLIER_THRESHOLD = 3.5
+# Lower bound for the median absolute deviation as share of the median. With few, very similar values the deviation is tiny and
+# every small difference would be flagged, this way only values more than ~5% away from the median can be outliers
+MIN_RELATIVE_DEVIATION = 0.01
+
+
+def percentile(values, percentile):
+    values = sorted(values)
+    return values[min(len(values)-1, int(percentile/100*len(values)))]
+
+
+def bootstrap_interval(values, confidence=CONFIDENCE, resamples=BOOTSTRAP_RESAMPLES):
+    """Percentile bootstrap confidence interval of the mean. Seeded so the same values always give the same interval"""
+    if len(values) < 2:
+        return values[0], values[0]
+    rng = random.Random(0)
+    means = sorted(sum(rng.choices(values, k=len(values)))/len(values) for _ in range(resamples))
+    alpha = (1 - confidence) / 2
+    return means[int(alpha*(resamples-1))], means[int(math.ceil((1-alpha)*(resamples-1)))]
+
+
+def outliers(values, threshold=OUTLIER_THRESHOLD):
+    """Returns the indices of the values that are far away from the median (modified z-score of Iglewicz and Hoaglin)"""
+    if len(values) < 3:
+        return []
+    median = statistics.median(values)
+    mad = max(statistics.median([abs(value - median) for value in values]), MIN_RELATIVE_DEVIATION * abs(median))
+    if mad == 0:
+        return []
+    return [index for index, value in enumerate(values) if 0.6745 * abs(value - median) / mad > threshold]
+
+
+def summarize(values):
+    """Robust summary of a list of measurements: median, p95, standard deviation, bootstrap confidence interval of the mean
+    and the indices of outliers"""
+    ci_low, ci_high = bootstrap_interval(values)
+    return {
+        "count": len(values),
+        "mean": sum(values)/len(values),
+        "median": statistics.median(values),
+        "p95": percentile(values, 95),
+        "stdev": statistics.stdev(values) if len(values) > 1 else 0,
+        "ci_low": ci_low,
+        "ci_high": ci_high,
+        "outliers": outliers(values),
+    }
+
+
+def query_summary(executions, warm=False):
+    """Statistics of one query over its executions, given as one list of durations per worker (and run). Returns None if the
+    query was never executed. If all executions ran on warm caches there is no cold first execution, first is None and all
+    executions are steady"""
+    values = [value for worker_values in executions for value in worker_values]
+    if not values:
+        return None
+    summary = summarize(values)
+    # The first execution of a query by each worker, and all later ones once the caches are filled
+    first = [worker_values[0] for worker_values in executions if worker_values] if not warm else []
+    steady = [value for worker_values in executions for value in worker_values[0 if warm else 1:]]
+    return {
+        "min": min(values),
+        "max": max(values),
+        "avg": summary["mean"],
+        "count": len(values),
+        "median": summary["median"],
+        "p50": summary["median"],
+        "p95": summary["p95"],
+        "p99": percentile(values, 99),
+        "stdev": summary["stdev"],
+        "ci_low": summary["ci_low"],
+        "ci_high": summary["ci_high"],
+        # Number of executions far away from the median, e.g. a cold first run
+        "outliers": len(summary["outliers"]),
+        "first": sum(first)/len(first) if first else None,
+        "steady": sum(steady)/len(steady) if steady else None,
+    }
+
+
+def variant_summary(queries, name, variants):
+    """Compares the fastest formulation of a query with its canonical form. queries maps the names to their query_summary,
+    variants are the names of the variants of the query"""
+    fastest = min([name] + variants, key=lambda candidate: queries[candidate]["avg"])
+    return {
+        "canonical_avg": queries[name]["avg"],
+        "fastest": fastest,
+        "fastest_avg": queries[fastest]["avg"],
+        "speedup": queries[name]["avg"] / queries[fastest]["avg"] if queries[fastest]["avg"] else None,
+        "variants": variants,
+    }
@@ -1,6 +1,10 @@
 from cli import commands
 from cli.query import query
 from cli.insert import insert
+from cli.mixed import mixed
+from cli.point import point
+from cli.compare import compare
+from cli.dataset import prepare_dataset
 
 
 if __name__ == '__main__':
@@ -1,80 +1,399 @@
+import asyncio
 import os
 import time
-from flask import Flask, request, jsonify, make_response
+from aiohttp import web
 from modules import select_module
+from modules import cache_control, null_sink, profiler, query_variants, stats
 from modules.config import config
+from modules.histogram import Histogram
 
 
-app = Flask(__name__)
+routes = web.RouteTableDef()
 results = dict()
 prefill = list()
+registered = list()
+samples = dict()
+ready = list()
+start_time = None
 WORKER_COUNT = int(os.environ["WORKER_COUNT"])
+# In the mixed task the last query_workers workers to register run queries, all others insert
+QUERY_WORKER_COUNT = int(config.get("query_workers", 1)) if config.get("task", "insert") == "mixed" else 0
+# Workers whose process used more than this share of its CPU core are flagged, their results measure the client and not the database
+CPU_SATURATION_THRESHOLD = float(config.get("cpu_saturation_threshold", 0.9))
+# Every insert process (and query worker of the mixed task) waits at the start barrier, the timed inserts begin this many seconds after the last one arrived
+START_DELAY = 2
+# Longest time a long-poll request (?wait=<seconds>) is held open before it is answered with 503
+MAX_WAIT = 60
+# Result uploads contain histograms and profiles, allow them to be larger than the default limit of 1MB
+MAX_REQUEST_SIZE = 64*1024*1024
+# Set when all workers finished the prefill, when the start time is known and when all insert workers reported their results
+prefill_done = None
+start_scheduled = None
+inserts_done = None
+# Running totals of the interval samples per worker for /metrics, so a scrape does not have to go over all samples
+totals = dict()
 
 
-@app.route("/")
-def index():
-    return "Test Collector"
+async def _wait_for(request, event):
+    """Long-poll: with ?wait=<seconds> the request is held open until the event is set or the time is up. Returns whether it is set"""
+    wait = min(float(request.query.get("wait", 0)), MAX_WAIT)
+    if wait > 0 and not event.is_set():
+        try:
+            await asyncio.wait_for(event.wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+    return event.is_set()
 
 
-@app.route("/prefill", methods=["POST"])
-def report_prefill():
-    data = request.get_json()
-    prefill.append(data["worker"])
-    return "OK"
+def _waiting():
+    return web.Response(text="waiting on workers", status=503)
+
+
+@routes.get("/")
+async def index(request):
+    return web.Response(text="Test Collector")
+
 
+@routes.post("/register")
+async def register_worker(request):
+    data = await request.json()
+    if data["worker"] not in registered:
+        registered.append(data["worker"])
+    index = registered.index(data["worker"])
+    role = "query" if index >= WORKER_COUNT - QUERY_WORKER_COUNT else "insert"
+    return web.json_response(dict(index=index, role=role))
 
-@app.route("/prefill", methods=["GET"])
-def prefill_status():
+
+@routes.post("/prefill")
+async def report_prefill(request):
+    data = await request.json()
+    prefill.append(data["worker"])
     if len(prefill) >= WORKER_COUNT:
-        return make_response("OK", 200)
-    else:
-        return make_response("waiting on workers", 503)
+        prefill_done.set()
+    return web.Response(text="OK")
+
+
+@routes.get("/prefill")
+async def prefill_status(request):
+    if await _wait_for(request, prefill_done):
+        return web.Response(text="OK")
+    return _waiting()
+
+
+def _start_barrier_size():
+    """Number of workers or processes that have to arrive at the start barrier before the start is scheduled"""
+    if config.get("task", "insert") == "point":
+        # Point workers run their clients as threads of one process, they arrive once per worker
+        return WORKER_COUNT
+    # Query workers of the mixed task run in a single process
+    return (WORKER_COUNT - QUERY_WORKER_COUNT) * int(config.get("processes_per_worker", 1)) + QUERY_WORKER_COUNT
+
+
+@routes.post("/start")
+async def report_ready(request):
+    global start_time
+    data = await request.json()
+    if data["worker"] not in ready:
+        ready.append(data["worker"])
+    if start_time is None and len(ready) >= _start_barrier_size():
+        start_time = time.time() + START_DELAY
+        start_scheduled.set()
+    return web.Response(text="OK")
+
+
+@routes.get("/start")
+async def start_status(request):
+    if not await _wait_for(request, start_scheduled):
+        return _waiting()
+    schedule = dict(start_time=start_time)
+    if config.get("duration"):
+        # Time-boxed runs: every worker inserts until this deadline and then reports what it managed
+        schedule["end_time"] = start_time + float(config["duration"])
+    return web.json_response(schedule)
 
 
-@app.route("/result", methods=["POST"])
-def report_result():
-    data = request.get_json()
+@routes.post("/result")
+async def report_result(request):
+    data = await request.json()
     results[data["worker"]] = data
-    return "OK"
+    if len(_insert_results()) >= WORKER_COUNT - QUERY_WORKER_COUNT:
+        inserts_done.set()
+    return web.Response(text="OK")
+
+
+@routes.get("/inserts")
+async def inserts_status(request):
+    if await _wait_for(request, inserts_done):
+        return web.Response(text="OK")
+    return _waiting()
+
+
+@routes.post("/samples")
+async def report_sample(request):
+    data = await request.json()
+    samples.setdefault(data["worker"], list()).append(data)
+    worker_totals = totals.setdefault(data["worker"], dict(events=0, errors=0, bytes_sent=0, bytes_received=0))
+    for key in ["events", "errors", "bytes_sent", "bytes_received"]:
+        worker_totals[key] += data[key]
+    worker_totals["events_per_second"] = data["events"] / data["interval"] if data["interval"] > 0 else 0
+    worker_totals["timestamp"] = data["timestamp"]
+    return web.Response(text="OK")
+
+
+@routes.get("/metrics")
+async def metrics(request):
+    """Live state of the run in the Prometheus text format. The throughput gauge is the sum over the latest sample of every
+    worker that sent one within the last few sample intervals"""
+    interval = float(config.get("sample_interval", 1))
+    now = time.time()
+    lines = list()
+
+    def metric(name, kind, description, values):
+        lines.append(f"# HELP dbtest_{name} {description}")
+        lines.append(f"# TYPE dbtest_{name} {kind}")
+        for labels, value in values:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"dbtest_{name}{{{label_text}}} {value}" if label_text else f"dbtest_{name} {value}")
+
+    metric("workers", "gauge", "Number of workers in each state", [
+        (dict(state="expected"), WORKER_COUNT), (dict(state="registered"), len(registered)), (dict(state="prefilled"), len(prefill)),
+        (dict(state="ready"), len(ready)), (dict(state="finished"), len(results))])
+    active = [worker for worker in totals.values() if now - worker["timestamp"] <= 3*interval]
+    metric("events_per_second", "gauge", "Events per second inserted by all workers according to their latest samples",
+           [(dict(), sum(worker["events_per_second"] for worker in active))])
+    for key, description in [("events", "Events inserted"), ("errors", "Failed requests"), ("bytes_sent", "Bytes sent by the worker pod"),
+                             ("bytes_received", "Bytes received by the worker pod")]:
+        metric(f"{key}_total", "counter", description, [(dict(worker=name), worker[key]) for name, worker in totals.items()])
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+
+@routes.get("/report/timeseries")
+async def collect_results_timeseries(request):
+    """Aggregates the interval samples of all workers into buckets of sample_interval seconds relative to the first sample"""
+    interval = float(config.get("sample_interval", 1))
+    report = dict(interval=interval, workers=samples, series=list())
+    all_samples = [sample for worker_samples in samples.values() for sample in worker_samples]
+    if not all_samples:
+        return web.json_response(report)
+    begin = min(sample["timestamp"] - sample["interval"] for sample in all_samples)
+    buckets = dict()
+    for sample in all_samples:
+        index = int((sample["timestamp"] - begin) / interval)
+        bucket = buckets.setdefault(index, dict(time=index*interval, events=0, errors=0, bytes_sent=0, bytes_received=0, workers=0))
+        for key in ["events", "errors", "bytes_sent", "bytes_received"]:
+            bucket[key] += sample[key]
+        bucket["workers"] += 1
+    for bucket in buckets.values():
+        bucket["events_per_second"] = bucket["events"] / interval
+    report["series"] = [buckets[index] for index in sorted(buckets.keys())]
+    return web.json_response(report)
+
+
+def _insert_results():
+    return dict((name, worker) for name, worker in results.items() if "results" not in worker and "kinds" not in worker)
+
 
+def _query_results():
+    return dict((name, worker) for name, worker in results.items() if "results" in worker)
 
-@app.route("/report/insert")
-def collect_results_insert():
+
+def _overlap_events(begin, end):
+    """Returns the number of events inserted between begin and end according to the interval samples of the workers"""
+    events = 0
+    for worker_samples in samples.values():
+        for sample in worker_samples:
+            sample_begin = sample["timestamp"] - sample["interval"]
+            overlap = min(end, sample["timestamp"]) - max(begin, sample_begin)
+            if overlap > 0 and sample["interval"] > 0:
+                events += sample["events"] * overlap / sample["interval"]
+    return events
+
+
+def _saturated_workers(worker_results):
+    """Returns the names of the workers whose process was CPU-saturated during the run"""
+    return sorted([name for name, worker in worker_results.items()
+                   if worker.get("resources") and worker["resources"]["cpu_utilization"] >= CPU_SATURATION_THRESHOLD])
+
+
+def _insert_report(insert_results):
     report = dict()
-    report["workers"] = results
-    sum_ops, sum_duration = 0, 0
-    for worker in results.values():
+    report["workers"] = dict()
+    merged_histogram = Histogram()
+    for name, worker in insert_results.items():
+        worker = dict(worker)
+        # Profiles are large, they are provided separately under /report/profile
+        worker.pop("profile", None)
+        histogram = Histogram.from_dict(worker.pop("latency_histogram", None))
+        merged_histogram.merge(histogram)
+        worker["latency"] = histogram.summary()
+        report["workers"][name] = worker
+    sum_ops, sum_duration, sum_cpu_time = 0, 0, 0
+    for worker in report["workers"].values():
         sum_ops = sum_ops + worker["operations"]
         sum_duration = sum_duration + worker["duration"]
-    ops_per_second=sum_ops/(sum_duration/len(results))
-    report["sum"] = dict(operations=sum_ops, duration=sum_duration, ops_per_second=ops_per_second)
-    return jsonify(report)
+        sum_cpu_time = sum_cpu_time + worker.get("cpu_time", 0)
+        if worker.get("cpu_time"):
+            worker["ops_per_cpu_second"] = worker["operations"]/worker["cpu_time"]
+    # No workers or only workers that inserted nothing (e.g. a tiny null sink run) have no duration
+    ops_per_second = sum_ops/(sum_duration/len(insert_results)) if sum_duration else 0
+    # Spread of the throughput over the workers, an outlier is a worker that was much slower (or faster) than the others
+    names = list(report["workers"].keys())
+    worker_ops = None
+    if names:
+        worker_ops = stats.summarize([worker["operations"]/worker["duration"] if worker["duration"] else 0 for worker in report["workers"].values()])
+        worker_ops["outliers"] = [names[index] for index in worker_ops["outliers"]]
+    # Events per second of worker CPU time, with the null_sink option this is the client-side ceiling per worker core
+    ops_per_cpu_second = sum_ops/sum_cpu_time if sum_cpu_time else None
+    report["sum"] = dict(operations=sum_ops, duration=sum_duration, ops_per_second=ops_per_second, ops_per_cpu_second=ops_per_cpu_second,
+                         worker_ops_per_second=worker_ops)
+    if insert_results and all("start_time" in worker for worker in insert_results.values()):
+        # ops_per_second assumes all workers ran at the same time, so also report the throughput over the actual wall-clock window
+        starts = [worker["start_time"] for worker in insert_results.values()]
+        ends = [worker["end_time"] for worker in insert_results.values()]
+        report["sum"]["start_skew"] = max(starts) - min(starts)
+        report["sum"]["wall_clock_duration"] = max(ends) - min(starts)
+        report["sum"]["wall_clock_ops_per_second"] = sum_ops / (max(ends) - min(starts)) if max(ends) > min(starts) else 0
+        # The window in which all workers were inserting, measured from the interval samples
+        overlap = min(ends) - max(starts)
+        report["sum"]["overlap_duration"] = overlap
+        report["sum"]["overlap_ops_per_second"] = _overlap_events(max(starts), min(ends)) / overlap if overlap > 0 and samples else None
+    report["latency"] = merged_histogram.summary()
+    report["latency_histogram"] = merged_histogram.to_dict()
+    report["cpu_saturated_workers"] = _saturated_workers(insert_results)
+    report["cpu_saturated"] = len(report["cpu_saturated_workers"]) > 0
+    return report
 
 
-@app.route("/report/queries")
-def collect_results_queries():
+def _queries_report(query_results):
     report = dict()
-    queries = dict([(name, []) for name in list(results.values())[0]["results"].keys()])
-    report["workers"] = results
+    names = list(query_results.values())[0]["results"].keys()
+    report["workers"] = dict((name, dict((key, value) for key, value in worker.items() if key not in ["profile", "plans"])) for name, worker in query_results.items())
     report["queries"] = dict()
-    
-    for worker in results.values():
-        for name, values in worker["results"].items():
-            queries[name].extend(values)
-
-    for name, values in queries.items():
-        report["queries"][name] = {
-            "min": min(values),
-            "max": max(values),
-            "avg": sum(values)/len(values),
-        }
-    
-    return jsonify(report)
+
+    for name in names:
+        summary = stats.query_summary([worker["results"][name] for worker in query_results.values()], warm=cache_control.warm(name))
+        if summary is None:
+            # In the mixed task no round of the query may have ended before the inserts did
+            print(f"No complete execution of query {name}, leaving it out of the report", flush=True)
+            continue
+        report["queries"][name] = summary
+        # All workers run the same queries, so the plan of the first worker that captured one is reported. The plans are captured
+        # once per query, with cache_mode=both the cold and the warm result get the same plan
+        plan_name = cache_control.query_name(name)
+        plans = [worker["plans"][plan_name] for worker in query_results.values() if plan_name in worker.get("plans", dict())]
+        if plans:
+            report["queries"][name]["explain"] = plans[0]
+    report["variants"] = _variants_report(report["queries"])
+    report["cpu_saturated_workers"] = _saturated_workers(query_results)
+    report["cpu_saturated"] = len(report["cpu_saturated_workers"]) > 0
+    return report
+
+
+def _variants_report(queries):
+    """Compares the fastest formulation of every logical query that has variants with its canonical form"""
+    report = dict()
+    for name in queries.keys():
+        variants = [variant for variant in queries.keys() if variant != name and query_variants.logical_name(variant) == name]
+        if variants:
+            report[name] = stats.variant_summary(queries, name, variants)
+    return report
+
+
+def _point_report(point_results):
+    """Queries per second and latency percentiles of the point queries of all workers, per kind and in sum. The rate is
+    relative to the wall-clock window from the common start until the last worker finished"""
+    window = max(worker["end_time"] for worker in point_results.values()) - min(worker["start_time"] for worker in point_results.values())
+    report = dict(workers=dict(), queries=dict())
+    merged_histogram = Histogram()
+    for name, worker in point_results.items():
+        worker = dict(worker)
+        kinds = dict()
+        for kind, kind_result in worker.pop("kinds").items():
+            kinds[kind] = dict(queries=kind_result["queries"], errors=kind_result["errors"], latency=Histogram.from_dict(kind_result["latency_histogram"]).summary())
+        worker["kinds"] = kinds
+        report["workers"][name] = worker
+    for kind in list(point_results.values())[0]["kinds"].keys():
+        histogram = Histogram()
+        for worker in point_results.values():
+            histogram.merge(Histogram.from_dict(worker["kinds"][kind]["latency_histogram"]))
+        merged_histogram.merge(histogram)
+        queries = sum(worker["kinds"][kind]["queries"] for worker in point_results.values())
+        report["queries"][kind] = dict(queries=queries, errors=sum(worker["kinds"][kind]["errors"] for worker in point_results.values()),
+                                       queries_per_second=queries/window if window > 0 else 0, latency=histogram.summary())
+    operations = sum(kind["queries"] for kind in report["queries"].values())
+    # ops_per_second and latency use the names of the insert report so the results database and compare handle both alike
+    report["sum"] = dict(operations=operations, errors=sum(kind["errors"] for kind in report["queries"].values()), duration=window,
+                         ops_per_second=operations/window if window > 0 else 0, clients=sum(worker["clients"] for worker in point_results.values()))
+    report["latency"] = merged_histogram.summary()
+    report["cpu_saturated_workers"] = _saturated_workers(point_results)
+    report["cpu_saturated"] = len(report["cpu_saturated_workers"]) > 0
+    return report
+
+
+@routes.get("/report/insert")
+async def collect_results_insert(request):
+    return web.json_response(_insert_report(results))
+
+
+@routes.get("/report/queries")
+async def collect_results_queries(request):
+    return web.json_response(_queries_report(results))
+
+
+@routes.get("/report/point")
+async def collect_results_point(request):
+    return web.json_response(_point_report(dict((name, worker) for name, worker in results.items() if "kinds" in worker)))
+
+
+@routes.get("/version")
+async def database_version(request):
+    module = select_module()
+    if not hasattr(module, "version"):
+        return web.json_response(dict(database=None, driver=None))
+    try:
+        # The database drivers block, so do not hold up the other requests
+        return web.json_response(await asyncio.get_event_loop().run_in_executor(None, module.version))
+    except Exception as e:
+        print(f"Failed to determine database version: {e}", flush=True)
+        return web.json_response(dict(database=None, driver=None))
+
+
+@routes.get("/report/profile")
+async def collect_results_profile(request):
+    """Combines the sampling profiles and phase timings the workers uploaded with the profile option"""
+    profiles = dict((name, worker["profile"]) for name, worker in results.items() if "profile" in worker)
+    phases = profiler.merge_phases([profile["phases"] for profile in profiles.values() if "phases" in profile])
+    total = sum(phases.values())
+    report = dict(
+        phases=phases,
+        phase_shares=dict((name, seconds/total) for name, seconds in phases.items()) if total else dict(),
+        # Time of other threads and overlapping requests, not part of the shares
+        concurrent_phases=profiler.merge_phases([profile.get("concurrent_phases", dict()) for profile in profiles.values()]),
+        sampling=profiler.merge([profile["sampling"] for profile in profiles.values()]),
+        workers=dict((name, profile.get("phases")) for name, profile in profiles.items()),
+    )
+    return web.json_response(report)
+
+
+@routes.get("/report/mixed")
+async def collect_results_mixed(request):
+    """Reports the insert throughput of the insert workers next to the query latencies of the query workers"""
+    return web.json_response(dict(insert=_insert_report(_insert_results()), queries=_queries_report(_query_results())))
+
+
+async def _create_events(app):
+    # The events have to be created inside the event loop of the server
+    global prefill_done, start_scheduled, inserts_done
+    prefill_done, start_scheduled, inserts_done = asyncio.Event(), asyncio.Event(), asyncio.Event()
+
 
 def run():
     module = select_module()
-    if config.get("task", "insert") == "insert":
+    if config.get("task", "insert") in ["insert", "mixed"] and not null_sink.enabled():
         module.init()
     # It looks like in some cases for yugabytedb the created table is not instantly available for all workers so wait a few seconds
     time.sleep(10) 
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=False)
+    app = web.Application(client_max_size=MAX_REQUEST_SIZE)
+    app.add_routes(routes)
+    app.on_startup.append(_create_events)
+    web.run_app(app, host='0.0.0.0', port=5000)
@@ -1,9 +1,13 @@
+from importlib import metadata as importlib_metadata
 import os
 from arango import ArangoClient
 from .config import config
+from . import async_engine, instrumentation, null_sink, point_workload
 
 
 def _db():
+    if null_sink.enabled():
+        return null_sink.NullArangoDatabase()
     client = ArangoClient(hosts=config["endpoint"])
     db = client.db(config["database"], username=config["username"], password=config["password"])
     return db
@@ -28,6 +32,15 @@ def init():
     print("Created table events")
 
 
+def version():
+    """Returns the version of the database and of the client library"""
+    driver = f"python-arango {importlib_metadata.version('python-arango')}"
+    if null_sink.enabled():
+        return dict(database="null sink", driver=driver)
+    database = f"ArangoDB {_db().version()}"
+    return dict(database=database, driver=driver)
+
+
 def prefill_events(events):
     _insert_events(events, True, 1000)
 
@@ -35,9 +48,78 @@ def prefill_events(events):
 def insert_events(events):
     batch_mode = config.get("batch_mode", False)
     batch_size = config.get("batch_size", 100)
+    if async_engine.enabled():
+        _async_insert(async_engine.batched(events, batch_size if batch_mode else 1))
+        return
     _insert_events(events, batch_mode, batch_size)
 
 
+def insert_batches(batches):
+    if async_engine.enabled():
+        _async_insert(batches)
+        return
+    batch_mode = config.get("batch_mode", False)
+    if not batch_mode:
+        insert_events(event for batch in batches for event in batch.events())
+        return
+    print("Connecting to database", flush=True)
+    sync = config.get("sync", "False").lower() in ["true", "yes", "1"]
+    db = _db()
+    use_multiple_tables = config["use_multiple_tables"]
+    if use_multiple_tables:
+        collections = [db.collection(f"events{i}") for i in range(4)]
+    else:
+        collections = [db.collection("events")]
+
+    print("Inserting events", flush=True)
+    for batch in batches:
+        with instrumentation.phase("serialize"):
+            docs = [dict(timestamp=timestamp, device_id=device_id, sequence_number=sequence_number, temperature=temperature) for timestamp, device_id, sequence_number, temperature in batch.rows()]
+            if config["primary_key"] == "client":
+                for doc in docs:
+                    doc["_key"] = f"{doc['device_id']}{doc['timestamp']}{doc['sequence_number']}"
+        with instrumentation.measure(len(docs)):
+            for col_index, collection in enumerate(collections):
+                col_docs = docs[col_index::len(collections)]
+                if len(col_docs) > 0:
+                    collection.insert_many(col_docs, sync=sync)
+    print("Finished inserting", flush=True)
+
+
+def _async_insert(batches):
+    import aiohttp
+    sync = config.get("sync", "False").lower() in ["true", "yes", "1"]
+    if config["use_multiple_tables"]:
+        collections = [f"events{i}" for i in range(4)]
+    else:
+        collections = ["events"]
+
+    async def connect():
+        return aiohttp.ClientSession(auth=aiohttp.BasicAuth(config["username"], config["password"]), timeout=aiohttp.ClientTimeout(total=600))
+
+    async def send(session, batch):
+        docs = [dict(timestamp=timestamp, device_id=device_id, sequence_number=sequence_number, temperature=temperature) for timestamp, device_id, sequence_number, temperature in async_engine.rows(batch)]
+        if config["primary_key"] == "client":
+            for doc in docs:
+                doc["_key"] = f"{doc['device_id']}{doc['timestamp']}{doc['sequence_number']}"
+        for col_index, collection in enumerate(collections):
+            col_docs = docs[col_index::len(collections)]
+            if len(col_docs) == 0:
+                continue
+            url = f"{config['endpoint']}/_db/{config['database']}/_api/document/{collection}"
+            async with session.post(url, params=dict(waitForSync="true" if sync else "false"), json=col_docs) as response:
+                # The document API answers with 202 even if single documents failed, those are reported in this header
+                if response.status >= 300 or "X-Arango-Error-Codes" in response.headers:
+                    raise Exception(f"Insert failed with status {response.status}: {await response.text()}")
+
+    async def close(session):
+        await session.close()
+
+    print("Inserting events", flush=True)
+    async_engine.run(batches, connect, send, close)
+    print("Finished inserting", flush=True)
+
+
 def _insert_events(events, batch_mode, batch_size):
     print("Connecting to database", flush=True)
     sync = config.get("sync", "False").lower() in ["true", "yes", "1"]
@@ -63,13 +145,16 @@ def _insert_events(events, batch_mode, batch_size):
                 docs_for_collections[0].append(data)
             count += 1
             if count >= batch_size:
-                for col_index, docs in enumerate(docs_for_collections):
-                    collections[col_index].insert_many(docs, sync=sync)
-                    docs.clear()
+                with instrumentation.measure(count):
+                    for col_index, docs in enumerate(docs_for_collections):
+                        collections[col_index].insert_many(docs, sync=sync)
+                        docs.clear()
                 count = 0
-        for col_index, docs in enumerate(docs_for_collections):
-            if len(docs) > 0:
-                collections[col_index].insert_many(docs, sync=sync)
+        if count:
+            with instrumentation.measure(count):
+                for col_index, docs in enumerate(docs_for_collections):
+                    if len(docs) > 0:
+                        collections[col_index].insert_many(docs, sync=sync)
 
     else:
         for idx, event in enumerate(events):
@@ -80,5 +165,42 @@ def _insert_events(events, batch_mode, batch_size):
             data = event.to_dict()
             if config["primary_key"] == "client":
                 data["_key"] = f"{event.device_id}{event.timestamp}{event.sequence_number}"
-            collection.insert(data, sync=sync)
+            with instrumentation.measure():
+                collection.insert(data, sync=sync)
     print("Finished inserting", flush=True)
+
+
+_point_queries = {
+    "device-window": """
+        FOR e IN events
+            FILTER e.device_id == @device_id AND e.timestamp >= @start AND e.timestamp < @end
+            SORT e.timestamp
+            RETURN {timestamp: e.timestamp, temperature: e.temperature}
+    """,
+    "latest-devices": """
+        FOR device_id IN @device_ids
+            LET newest = FIRST(FOR e IN events FILTER e.device_id == device_id SORT e.timestamp DESC LIMIT 1 RETURN e)
+            RETURN {device_id: device_id, timestamp: newest.timestamp, temperature: newest.temperature}
+    """,
+}
+
+
+def sample_events(count):
+    """Returns the device id and timestamp of up to count random stored events to draw the point query parameters from"""
+    cursor = _db().aql.execute("FOR e IN events SORT RAND() LIMIT @count RETURN [e.device_id, e.timestamp]", bind_vars=dict(count=count))
+    return [tuple(sample) for sample in cursor]
+
+
+def point_queries(samples, wait_for_start):
+    """Runs the point and range queries from several clients, see point_workload"""
+
+    def device_window(db, device_id, start, end):
+        list(db.aql.execute(_point_queries["device-window"], bind_vars=dict(device_id=device_id, start=start, end=end)))
+
+    def latest_devices(db, device_ids):
+        list(db.aql.execute(_point_queries["latest-devices"], bind_vars=dict(device_ids=device_ids)))
+
+    def close(db):
+        pass
+
+    return point_workload.run(samples, _db, {"device-window": device_window, "latest-devices": latest_devices}, close, wait_for_start)
@@ -0,0 +1,122 @@
+import asyncio
+import shlex
+import time
+from . import instrumentation
+from .config import config
+
+
+def enabled():
+    return config.get("engine", "sync") == "async"
+
+
+def batched(events, batch_size):
+    """Groups single events into lists of batch_size events"""
+    values = []
+    for event in events:
+        values.append(event)
+        if len(values) >= batch_size:
+            yield values
+            values = []
+    if values:
+        yield values
+
+
+def rows(batch):
+    """Returns the events of an EventBatch or a list of events as (timestamp, device_id, sequence_number, temperature) tuples"""
+    if hasattr(batch, "rows"):
+        return batch.rows()
+    return [(event.timestamp, event.device_id, event.sequence_number, event.temperature) for event in batch]
+
+
+def run(batches, connect, send, close):
+    """Sends batches with up to in_flight requests outstanding at any time. Every in-flight slot uses its own connection
+    created by the coroutine function connect(), send(connection, batch) sends one batch and close(connection) closes a connection.
+    """
+    in_flight = int(config.get("in_flight", 4))
+    asyncio.run(_run(iter(batches), connect, send, close, in_flight))
+
+
+async def _run(batches, connect, send, close, in_flight):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=in_flight)
+
+    async def sender():
+        connection = await connect()
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                batch, intended_start = item
+                send_start = time.perf_counter()
+                start = intended_start if intended_start is not None else send_start
+                await send(connection, batch)
+                instrumentation.recorder.record(start, len(batch))
+                # Sends overlap, so they are counted as concurrent phase that can add up to more than the duration of the run
+                instrumentation.recorder.add_phase("send", time.perf_counter() - send_start, concurrent=True)
+        finally:
+            await close(connection)
+
+    senders = [asyncio.ensure_future(sender()) for _ in range(in_flight)]
+    failed = False
+    try:
+        while not failed:
+            # Batches are produced in a thread so generating or pacing them does not block the requests in flight
+            batch = await loop.run_in_executor(None, next, batches, None)
+            if batch is None:
+                break
+            # Take the scheduled send time along with the batch as the generator moves on to the next one
+            failed = not await _put(queue, (batch, instrumentation.recorder.intended_start), senders)
+        for _ in senders:
+            if failed:
+                break
+            failed = not await _put(queue, None, senders)
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        if failed:
+            for sender in senders:
+                sender.cancel()
+        results = await asyncio.gather(*senders, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+async def _put(queue, item, senders):
+    """Puts item into the queue, returns False if a sender failed while waiting for space"""
+    wait_start = time.perf_counter()
+    put = asyncio.ensure_future(queue.put(item))
+    while True:
+        if any(sender.done() and not sender.cancelled() and sender.exception() for sender in senders):
+            put.cancel()
+            return False
+        pending = [sender for sender in senders if not sender.done()]
+        done, _ = await asyncio.wait(pending + [put], return_when=asyncio.FIRST_COMPLETED)
+        if put in done:
+            # Time the producer waited for a free in-flight slot
+            instrumentation.recorder.add_phase("wait", time.perf_counter() - wait_start)
+            return True
+
+
+def asyncpg_connect_kwargs(connection_string):
+    """Converts a libpq keyword/value connection string into keyword arguments for asyncpg.connect"""
+    kwargs = dict()
+    server_settings = dict()
+    for part in shlex.split(connection_string):
+        key, value = part.split("=", 1)
+        if key == "dbname":
+            kwargs["database"] = value
+        elif key == "port":
+            kwargs["port"] = int(value)
+        elif key in ["host", "user", "password"]:
+            kwargs[key] = value
+        elif key == "options":
+            for option in shlex.split(value):
+                if option != "-c":
+                    name, setting = option.split("=", 1)
+                    server_settings[name] = setting
+    if server_settings:
+        kwargs["server_settings"] = server_settings
+    return kwargs
@@ -0,0 +1,87 @@
+# Encoder for the binary format of PostgreSQL COPY (https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4)
+# for the events table. Numbers are sent in their binary representation so the server does not have to parse them from text.
+import io
+import struct
+import numpy as np
+from .config import config
+
+
+SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+# Signature, flags and length of the header extension area
+HEADER = SIGNATURE + struct.pack(">ii", 0, 0)
+# A field count of -1 marks the end of the data
+TRAILER = struct.pack(">h", -1)
+
+
+def enabled():
+    return config.get("copy_format", "text").lower() == "binary"
+
+
+def copy_statement(table_name, columns):
+    return f"COPY {table_name} ({', '.join(columns)}) FROM STDIN (FORMAT binary)"
+
+
+class CopyBuffer:
+    """Reusable buffer with the binary COPY data for one table. Rows are (timestamp, device_id, sequence_number, temperature)
+    tuples, optionally with a varchar id in front, the columns are bigint, varchar, bigint and real"""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        # Struct per length of the varchar fields, with client ids the length changes from row to row
+        self._structs = dict()
+        self.reset()
+
+    def reset(self):
+        self.buffer.seek(0)
+        self.buffer.truncate(0)
+        self.buffer.write(HEADER)
+
+    def _struct(self, id_length, device_length):
+        key = (id_length, device_length)
+        if key not in self._structs:
+            id_format = "" if id_length is None else f"i{id_length}s"
+            self._structs[key] = struct.Struct(f">h{id_format}iqi{device_length}siqif")
+        return self._structs[key]
+
+    def add_row(self, row):
+        if len(row) == 4:
+            timestamp, device_id, sequence_number, temperature = row
+            device = device_id.encode("utf-8")
+            self.buffer.write(self._struct(None, len(device)).pack(4, 8, timestamp, len(device), device, 8, sequence_number, 4, temperature))
+        else:
+            event_id, timestamp, device_id, sequence_number, temperature = row
+            event_id, device = event_id.encode("utf-8"), device_id.encode("utf-8")
+            self.buffer.write(self._struct(len(event_id), len(device)).pack(5, len(event_id), event_id, 8, timestamp, len(device), device,
+                                                                            8, sequence_number, 4, temperature))
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.add_row(row)
+
+    def add_columns(self, timestamp, device_index, devices, sequence_number, temperature):
+        """Encodes whole columns at once as one numpy record array. device_index selects the device id of every row from devices"""
+        encoded = [device.encode("utf-8") for device in devices]
+        length = len(encoded[0])
+        if any(len(device) != length for device in encoded):
+            # Rows of different length do not fit into one record array
+            self.add_rows(zip(timestamp.tolist(), [devices[index] for index in device_index.tolist()], sequence_number.tolist(), temperature.tolist()))
+            return
+        records = np.empty(len(timestamp), dtype=np.dtype([
+            ("fields", ">i2"), ("timestamp_length", ">i4"), ("timestamp", ">i8"), ("device_length", ">i4"), ("device_id", f"S{length}"),
+            ("sequence_number_length", ">i4"), ("sequence_number", ">i8"), ("temperature_length", ">i4"), ("temperature", ">f4")]))
+        records["fields"] = 4
+        records["timestamp_length"] = 8
+        records["timestamp"] = timestamp
+        records["device_length"] = length
+        records["device_id"] = np.array(encoded, dtype=f"S{length}")[device_index]
+        records["sequence_number_length"] = 8
+        records["sequence_number"] = sequence_number
+        records["temperature_length"] = 4
+        records["temperature"] = temperature
+        self.buffer.write(records.tobytes())
+
+    def file(self):
+        """Finishes the data and returns it as a file to pass to copy_expert, call reset before adding the next rows"""
+        self.buffer.write(TRAILER)
+        self.buffer.seek(0)
+        return self.buffer
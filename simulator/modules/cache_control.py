@@ -0,0 +1,43 @@
+# Cache modes of the query test. With cache_mode=cold the modules clear or bypass the caches of the database before every
+# execution of a query, with warm every query is executed once untimed before the timed rounds. both times every query cold and
+# directly afterwards warm and reports them as "<query>:cold" and "<query>:warm"
+from .config import config
+
+
+SEPARATOR = ":"
+
+
+def mode():
+    return config.get("cache_mode", "")
+
+
+def modes():
+    """The cache modes every query is executed with in one round, None if caches are left as they are"""
+    if mode() == "both":
+        return ["cold", "warm"]
+    if mode() in ["cold", "warm"]:
+        return [mode()]
+    if mode():
+        raise Exception(f"Unknown cache_mode {mode()}, use cold, warm or both")
+    return [None]
+
+
+def warm_up():
+    """Whether every query should be executed once untimed before the timed rounds"""
+    return mode() == "warm"
+
+
+def result_name(name, cache_mode):
+    if mode() == "both":
+        return f"{name}{SEPARATOR}{cache_mode}"
+    return name
+
+
+def warm(name):
+    """Whether all timed executions of a result ran on warm caches (after the untimed warm-up or directly after the cold execution)"""
+    return warm_up() or (mode() == "both" and name.endswith(f"{SEPARATOR}warm"))
+
+
+def query_name(name):
+    """The name of the query a result name belongs to, without the cache mode"""
+    return name.partition(SEPARATOR)[0]
@@ -1,12 +1,16 @@
+from importlib import metadata as importlib_metadata
 import queue
 from queue import Queue
 import cassandra
 from cassandra.query import BatchStatement, BatchType, BoundStatement, SimpleStatement
 from cassandra.cluster import Cluster, ConsistencyLevel
 from .config import config
+from . import instrumentation, null_sink, point_workload
 
 KEYSPACE = config["keyspace"]
 def _db():
+    if null_sink.enabled():
+        return null_sink.NullCassandraSession()
     cluster = Cluster(contact_points=config["contact_points"].split(","))
     session = cluster.connect()
     return session
@@ -46,6 +50,16 @@ def init():
         """)
     print("Created table events")
 
+def version():
+    """Returns the version of the database and of the client library"""
+    driver = f"cassandra-driver {importlib_metadata.version('cassandra-driver')}"
+    if null_sink.enabled():
+        return dict(database="null sink", driver=driver)
+    session = _db()
+    database = f"Cassandra {session.execute('SELECT release_version FROM system.local').one()[0]}"
+    session.shutdown()
+    return dict(database=database, driver=driver)
+
 def prefill_events(events):
     _insert_events(events, True, 1000)
 
@@ -55,7 +69,15 @@ def insert_events(events):
     batch_size = config.get("batch_size", 1000)
     _insert_events(events, batch_mode, batch_size)
 
-def _insert_events(events, batch_mode, batch_size):
+def insert_batches(batches):
+    batch_mode = config.get("batch_mode", False)
+    if not batch_mode:
+        insert_events(event for batch in batches for event in batch.events())
+        return
+    _insert_events(None, batch_mode, None, batches=batches)
+
+
+def _insert_events(events, batch_mode, batch_size, batches=None):
     print("Connecting to database", flush=True)
     use_multiple_tables = config["use_multiple_tables"]
     if use_multiple_tables:
@@ -67,13 +89,24 @@ def _insert_events(events, batch_mode, batch_size):
     statements_list = [session.prepare(f"INSERT INTO {KEYSPACE}.{table_name} (timestamp, device_id, sequence_number, temperature) VALUES (?, ?, ?, ?)") for table_name in table_names]
     max_sync_calls = config["max_sync_calls"]
 
+    if batches is not None:
+        statements = _generate_batch_statements(batches, statements_list, len(table_names))
+    else:
+        statements = _generate_statements(events, statements_list, len(table_names), batch_mode, batch_size)
+    # Binding the values happens while pulling the next statement
+    statements = instrumentation.timed(statements, "serialize")
+
     print("Inserting events", flush=True)
     if max_sync_calls > 1:
         futures = Queue(maxsize=max_sync_calls+1)
-        for idx, stmt in enumerate(_generate_statements(events, statements_list, len(table_names), batch_mode, batch_size)):
+        for idx, stmt in enumerate(statements):
             if idx >= max_sync_calls:
-                futures.get_nowait().result()
+                with instrumentation.phase("wait"):
+                    futures.get_nowait().result()
+            start = instrumentation.recorder.batch_start()
             future = session.execute_async(stmt)
+            # Record the latency when the response arrives and not when the result is collected from the queue
+            future.add_callback(_record_latency, start, _statement_size(stmt))
             futures.put_nowait(future)
         while True:
             try:
@@ -81,11 +114,18 @@ def _insert_events(events, batch_mode, batch_size):
             except queue.Empty:
                 break
     else:
-        for stmt in _generate_statements(events, statements_list, len(table_names), batch_mode, batch_size):
-            session.execute(stmt)
+        for stmt in statements:
+            with instrumentation.measure(_statement_size(stmt)):
+                session.execute(stmt)
     session.shutdown()
     print("Finished inserting", flush=True)
 
+def _record_latency(_, start, count):
+    instrumentation.recorder.record(start, count)
+
+def _statement_size(statement):
+    return len(statement) if isinstance(statement, BatchStatement) else 1
+
 def _generate_statements(events, statements_list, number_of_tables, batch_mode, batch_size = 1):
     if not batch_mode:
         for idx, event in enumerate(events):
@@ -97,6 +137,16 @@ def _generate_statements(events, statements_list, number_of_tables, batch_mode,
                 batch_statement.add(statements_list[idx%number_of_tables].bind((event.timestamp, event.device_id, event.sequence_number, event.temperature)))
             yield batch_statement
 
+def _generate_batch_statements(batches, statements_list, number_of_tables):
+    # Like _generate_statements in batch mode every batch goes to one table, the tables take turns per batch. The driver binds
+    # every row separately, so the columns are converted to rows here
+    for idx, batch in enumerate(batches):
+        batch_statement = BatchStatement(batch_type=BatchType.UNLOGGED, consistency_level=ConsistencyLevel.name_to_value[config["consistency_level"]])
+        statement = statements_list[idx%number_of_tables]
+        for values in batch.rows():
+            batch_statement.add(statement.bind(values))
+        yield batch_statement
+
 def _batch_events(events, batch_size):
     values = []
     for event in events:
@@ -106,3 +156,49 @@ def _batch_events(events, batch_size):
             values = []
     if values:
         yield values
+
+
+def sample_events(count):
+    """Returns device ids and timestamps to draw the point query parameters from. Cassandra returns rows in token order, so
+    the first rows would all belong to a single partition (device). Instead the time range of random devices is looked up and the
+    timestamps are drawn from it"""
+    session = _db()
+    devices = point_workload.sample_devices(row.device_id for row in session.execute(f"SELECT DISTINCT device_id FROM {KEYSPACE}.events"))
+    statement = session.prepare(f"SELECT min(timestamp), max(timestamp) FROM {KEYSPACE}.events WHERE device_id = ?")
+    futures = [(device_id, session.execute_async(statement, (device_id,))) for device_id in devices]
+    time_ranges = dict()
+    for device_id, future in futures:
+        first, last = future.result().one()
+        if first is not None:
+            time_ranges[device_id] = (first, last)
+    session.shutdown()
+    return point_workload.spread_samples(time_ranges, count)
+
+
+def point_queries(samples, wait_for_start):
+    """Runs the point and range queries from several clients, see point_workload. The events of a device are one partition
+    ordered by sequence number, which grows with the timestamp"""
+
+    def connect():
+        session = _db()
+        statements = dict(
+            window=session.prepare(f"SELECT timestamp, temperature FROM {KEYSPACE}.events WHERE device_id = ? AND timestamp >= ? AND timestamp < ? ALLOW FILTERING"),
+            latest=session.prepare(f"SELECT device_id, timestamp, temperature FROM {KEYSPACE}.events WHERE device_id = ? ORDER BY sequence_number DESC LIMIT 1"),
+        )
+        return session, statements
+
+    def device_window(connection, device_id, start, end):
+        session, statements = connection
+        list(session.execute(statements["window"], (device_id, start, end)))
+
+    def latest_devices(connection, device_ids):
+        # A query per partition, sent concurrently
+        session, statements = connection
+        futures = [session.execute_async(statements["latest"], (device_id,)) for device_id in device_ids]
+        for future in futures:
+            list(future.result())
+
+    def close(connection):
+        connection[0].shutdown()
+
+    return point_workload.run(samples, connect, {"device-window": device_window, "latest-devices": latest_devices}, close, wait_for_start)
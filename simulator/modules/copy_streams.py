@@ -0,0 +1,58 @@
+import queue
+import threading
+from . import instrumentation
+from .config import config
+
+
+def count():
+    return int(config.get("copy_streams", 1))
+
+
+class CopyStreams:
+    """Sends batches over several connections at once. Every stream is a thread with its own connection created by connect(),
+    send(connection, payload) sends and commits one batch. The caller keeps building batches while the streams are sending:
+    put() only blocks once every stream is busy and one more batch per stream is waiting (double buffering). The database
+    drivers release the GIL while waiting for the network, so the streams overlap with each other and with the serialization
+    """
+
+    def __init__(self, streams, connect, send, close):
+        self._queue = queue.Queue(maxsize=streams)
+        self._error = None
+        self._threads = [threading.Thread(target=self._stream, args=(connect, send, close), daemon=True) for _ in range(streams)]
+        for thread in self._threads:
+            thread.start()
+
+    def _stream(self, connect, send, close):
+        try:
+            connection = connect()
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                start, size, payload = item
+                with instrumentation.phase("send"):
+                    send(connection, payload)
+                instrumentation.recorder.record(start, size)
+            close(connection)
+        except Exception as e:
+            self._error = e
+            # Keep taking batches so put() and close() do not block forever, the error is raised there
+            while self._queue.get() is not None:
+                pass
+
+    def put(self, size, payload):
+        """Queues a batch of size events, its latency is measured from now until it is committed"""
+        if self._error is not None:
+            raise self._error
+        start = instrumentation.recorder.batch_start()
+        with instrumentation.phase("wait"):
+            self._queue.put((start, size, payload))
+
+    def close(self):
+        """Waits until all queued batches are sent and closes the connections"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error
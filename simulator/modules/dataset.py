@@ -0,0 +1,71 @@
+import json
+import os
+import numpy as np
+from .event_generator import EventBatch, generate_event_batches
+
+
+# Fixed-width record layout of a dataset file. Device ids are stored once per file in a separate device table
+RECORD_DTYPE = np.dtype([
+    ("timestamp", "<i8"),
+    ("device_index", "<i4"),
+    ("sequence_number", "<i8"),
+    ("temperature", "<f8"),
+])
+
+
+def dataset_path(dataset_dir, name, index):
+    return os.path.join(dataset_dir, f"{name}-{index}")
+
+
+def dataset_exists(path):
+    return os.path.exists(f"{path}.npy") and os.path.exists(f"{path}.json")
+
+
+def dataset_parameters(path):
+    """The parameters the dataset was generated with, datasets written before they were recorded only have the number of events"""
+    with open(f"{path}.json") as f:
+        metadata = json.load(f)
+    return dict((key, metadata.get(key)) for key in ["device_id", "events", "sequence_number", "device_spread"])
+
+
+def dataset_size(path):
+    with open(f"{path}.json") as f:
+        return json.load(f)["events"]
+
+
+def write_dataset(path, device_id, num_events, sequence_number=1, device_spread=1, batch_size=100000):
+    """Generates num_events events and writes them to path.npy (records) and path.json (device table)"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    records = np.lib.format.open_memmap(f"{path}.npy.tmp", mode="w+", dtype=RECORD_DTYPE, shape=(num_events,))
+    devices = []
+    offset = 0
+    for batch in generate_event_batches(device_id, 0, num_events, batch_size, sequence_number=sequence_number, device_spread=device_spread):
+        chunk = records[offset:offset+len(batch)]
+        chunk["timestamp"] = batch.timestamp
+        chunk["device_index"] = batch.device_index
+        chunk["sequence_number"] = batch.sequence_number
+        chunk["temperature"] = batch.temperature
+        devices = batch.devices.tolist()
+        offset += len(batch)
+    records.flush()
+    del records
+    with open(f"{path}.json", "w") as f:
+        json.dump(dict(devices=devices, events=num_events, device_id=device_id, sequence_number=sequence_number, device_spread=device_spread), f)
+    # Only move the records in place once complete so an aborted prepare is not mistaken for a valid dataset
+    os.replace(f"{path}.npy.tmp", f"{path}.npy")
+
+
+def read_dataset(path, batch_size):
+    """Memory-maps a dataset and yields EventBatch objects whose columns are views into the mapped file"""
+    with open(f"{path}.json") as f:
+        devices = np.array(json.load(f)["devices"], dtype=object)
+    records = np.load(f"{path}.npy", mmap_mode="r")
+    for offset in range(0, len(records), batch_size):
+        chunk = records[offset:offset+batch_size]
+        yield EventBatch(
+            timestamp=chunk["timestamp"],
+            device_index=chunk["device_index"],
+            sequence_number=chunk["sequence_number"],
+            temperature=chunk["temperature"],
+            devices=devices,
+        )
@@ -1,13 +1,18 @@
+from importlib import metadata as importlib_metadata
 from datetime import date, timedelta
+import json
 import time
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
 import urllib3
 from .config import config
+from . import async_engine, cache_control, event_generator, instrumentation, null_sink, point_workload, query_plans, query_variants
 
 urllib3.disable_warnings()
 
 def _db():
+    if null_sink.enabled():
+        return null_sink.NullElasticsearch()
     client = Elasticsearch(config["endpoint"], verify_certs=False)
     return client
 
@@ -19,25 +24,76 @@ def init():
         client.indices.delete("events")
     
     if not client.indices.exists("events"):
-        client.indices.create("events", """{
-            "mappings": {
-                "properties": {
-                    "timestamp": { "type": "date", "format": "epoch_millis" },
-                    "device_id": { "type": "keyword" },
-                    "sequence_number": { "type": "long" },
-                    "temperature": { "type": "float" }
-                }
-            },
-            "settings": {
-                "index": {
-                    "number_of_shards": 3,  
-                    "number_of_replicas": 2 
-                }
+        mappings = {
+            "properties": {
+                "timestamp": { "type": "date", "format": "epoch_millis" },
+                "device_id": { "type": "keyword" },
+                "sequence_number": { "type": "long" },
+                "temperature": { "type": "float" }
             }
-        }""")
+        }
+        settings = {
+            "index": {
+                "number_of_shards": 3,
+                "number_of_replicas": 2
+            }
+        }
+        if "ingest_indices" in config:
+            _apply_ingest_indices(mappings, settings)
+        client.indices.create("events", json.dumps(dict(mappings=mappings, settings=settings)))
     print("Created index")
 
 
+# Elasticsearch indexes every field, so the ingest indices select the fields that stay indexed (all others are only kept as doc
+# values) and the sort order of the index segments
+_ingest_indices = {
+    "device_ts": dict(fields=["device_id", "timestamp"]),
+    "temperature": dict(fields=["temperature"]),
+    "timestamp": dict(fields=["timestamp"]),
+    # Segments sorted by timestamp let range queries skip whole blocks, similar to a BRIN index
+    "timestamp_brin": dict(fields=["timestamp"], sort=["timestamp"]),
+    "device_ts_covering": dict(fields=["device_id", "timestamp", "temperature"], sort=["device_id", "timestamp"]),
+}
+
+
+def _apply_ingest_indices(mappings, settings):
+    names = [name for name in config["ingest_indices"].split(",") if name != "none"]
+    fields, sort = set(), []
+    for name in names:
+        if name not in _ingest_indices:
+            raise Exception(f"Unknown ingest index {name}, use one of {', '.join(_ingest_indices.keys())}")
+        fields.update(_ingest_indices[name]["fields"])
+        sort = sort or _ingest_indices[name].get("sort", [])
+    unindexed = [field for field in mappings["properties"].keys() if field not in fields]
+    for field in unindexed:
+        mappings["properties"][field]["index"] = False
+    if unindexed:
+        # Recorded in the index so the query and point tasks can refuse to run against it
+        mappings["_meta"] = dict(unindexed_fields=unindexed)
+    if sort:
+        settings["index"]["sort.field"] = sort
+    print(f"Indexed fields: {', '.join(sorted(fields)) or 'none'}", flush=True)
+
+
+def _check_queryable(client, fields=None):
+    """The term and range filters of the queries fail on fields that are not indexed, so an index created with ingest_indices
+    has to be re-created without the option before it can be queried. fields restricts the check to the fields filtered on"""
+    mapping = client.indices.get_mapping(index="events")["events"]["mappings"]
+    unindexed = [field for field in mapping.get("_meta", dict()).get("unindexed_fields", []) if fields is None or field in fields]
+    if unindexed:
+        raise Exception(f"The events index was created with ingest_indices and does not index {', '.join(unindexed)}, "
+                        "re-create it without ingest_indices (clean_database) before running queries")
+
+
+def version():
+    """Returns the version of the database and of the client library"""
+    driver = f"elasticsearch {importlib_metadata.version('elasticsearch')}"
+    if null_sink.enabled():
+        return dict(database="null sink", driver=driver)
+    database = f"Elasticsearch {_db().info()['version']['number']}"
+    return dict(database=database, driver=driver)
+
+
 def prefill_events(events):
     _insert_events(events, True, 10000)
 
@@ -45,9 +101,79 @@ def prefill_events(events):
 def insert_events(events):
     batch_mode = config.get("batch_mode", False)
     batch_size = config.get("batch_size", 1000)
+    if async_engine.enabled():
+        _async_insert(async_engine.batched(events, batch_size if batch_mode else 1))
+        return
     _insert_events(events, batch_mode, batch_size)
 
 
+def insert_batches(batches):
+    if async_engine.enabled():
+        _async_insert(batches)
+        return
+    batch_mode = config.get("batch_mode", False)
+    if not batch_mode:
+        insert_events(event for batch in batches for event in batch.events())
+        return
+    print("Connecting to database", flush=True)
+    client = _db()
+    gen_id = config.get("primary_key", "db") == "client"
+
+    print("Inserting events", flush=True)
+    for batch in batches:
+        # Build the bulk body directly from the columns, the generated device ids need no JSON escaping
+        with instrumentation.phase("serialize"):
+            timestamp, device_id, sequence_number, temperature = batch.text_columns()
+            if gen_id:
+                action = event_generator.concat('{"index":{"_index":"events","_id":"', device_id, timestamp, sequence_number, '"}}\n')
+            else:
+                action = '{"index":{"_index":"events"}}\n'
+            body = "".join(event_generator.concat(action, '{"timestamp":', timestamp, ',"device_id":"', device_id, '","sequence_number":',
+                                                  sequence_number, ',"temperature":', temperature, '}\n').tolist())
+        with instrumentation.measure(len(batch)):
+            _bulk_body(client, body)
+
+    print("Finished inserting", flush=True)
+
+
+def _bulk_body(client, body):
+    result = client.bulk(body=body, request_timeout=600)
+    if result["errors"]:
+        failed = [item["index"] for item in result["items"] if "error" in item["index"]]
+        raise Exception(f"{len(failed)} documents failed to index: {failed[0]['error']}")
+
+
+def _async_insert(batches):
+    from elasticsearch import AsyncElasticsearch
+    from elasticsearch.helpers import async_bulk
+    gen_id = config.get("primary_key", "db") == "client"
+
+    async def connect():
+        return AsyncElasticsearch(config["endpoint"], verify_certs=False)
+
+    async def send(client, batch):
+        values = list()
+        for timestamp, device_id, sequence_number, temperature in async_engine.rows(batch):
+            document = {
+                "_index": "events",
+                "timestamp": timestamp,
+                "device_id": device_id,
+                "sequence_number": sequence_number,
+                "temperature": temperature,
+            }
+            if gen_id:
+                document["_id"] = f"{device_id}{timestamp}{sequence_number}"
+            values.append(document)
+        await async_bulk(client, values)
+
+    async def close(client):
+        await client.close()
+
+    print("Inserting events", flush=True)
+    async_engine.run(batches, connect, send, close)
+    print("Finished inserting", flush=True)
+
+
 def _insert_events(events, batch_mode, batch_size):
     print("Connecting to database", flush=True)
     client = _db()
@@ -78,10 +204,13 @@ def _batch_mode(client, events, batch_size):
         values.append(document)
         count += 1
         if count >= batch_size:
-            bulk(client, values)
+            with instrumentation.measure(count):
+                bulk(client, values)
             values.clear()
             count = 0
-    bulk(client, values)
+    if count:
+        with instrumentation.measure(count):
+            bulk(client, values)
         
 
 
@@ -94,10 +223,11 @@ def _single_insert_mode(client, events):
             "sequence_number": event.sequence_number,
             "temperature": event.temperature,
         }
-        if gen_id:
-            client.index(index="events", id=f"{event.device_id}{event.timestamp}{event.sequence_number}", document=document)
-        else:
-            client.index(index="events", document=document)
+        with instrumentation.measure():
+            if gen_id:
+                client.index(index="events", id=f"{event.device_id}{event.timestamp}{event.sequence_number}", document=document)
+            else:
+                client.index(index="events", document=document)
 
 
 _queries = {
@@ -143,8 +273,35 @@ _queries = {
     },
 }
 
-def queries():
+_query_variants = {
+    "temperature-min-max": {
+        "stats": {
+            "aggs": {
+                "temperature_stats": { "stats": { "field": "temperature" } }
+            }
+        },
+    },
+    "newest-per-device": {
+        # top_metrics only reads the sort field and the metric instead of fetching the whole newest document
+        "top-metrics": {
+            "aggs": {
+                "devices": {
+                    "terms": { "field": "device_id", "size": 100000 },
+                    "aggs": {
+                        "newest": { "top_metrics": {
+                            "metrics": { "field": "temperature" },
+                            "sort": { "timestamp": "desc" }
+                        }}
+                    }
+                }
+            }
+        },
+    },
+}
+
+def queries(rounds=None):
     client = _db()
+    _check_queryable(client)
 
     if "queries" in config:
         included = config["queries"].split(",")
@@ -152,19 +309,93 @@ def queries():
             if key not in included:
                 del _queries[key]
 
-    query_times = dict([(name, []) for name in _queries.keys()])
-    for i in range(int(config["runs"])):
-        for name, query in _queries.items():
-            print(f"Executing query {name}", flush=True)
-            start = time.time()
-            if name == "count-events":
-                result = client.cat.count("events", request_timeout=600)
-                print(result, flush=True)
-            else:
-                result = client.search(index="events", body=query, size=0, request_timeout=600)
+    selected = query_variants.expand(_queries, _query_variants)
+    query_times = dict([(cache_control.result_name(name, mode), []) for name in selected.keys() for mode in cache_control.modes()])
+    if cache_control.warm_up():
+        for name, query in selected.items():
+            print(f"Warming up query {name}", flush=True)
+            _execute(client, name, query, None)
+    if rounds is None:
+        rounds = range(int(config["runs"]))
+    for i in rounds:
+        for name, query in selected.items():
+            for mode in cache_control.modes():
+                if mode == "cold":
+                    # Drops the request, query and field data caches of the index, the page cache of the OS stays
+                    client.indices.clear_cache(index="events")
+                print(f"Executing query {name}", flush=True)
+                start = time.time()
+                result = _execute(client, name, query, mode)
                 print(result, flush=True)
-            duration = time.time() - start
-            print("Finished query", flush=True)
-            query_times[name].append(duration)
+                duration = time.time() - start
+                print("Finished query", flush=True)
+                query_times[cache_control.result_name(name, mode)].append(duration)
 
     return query_times
+
+
+def _execute(client, name, query, cache_mode):
+    if name == "count-events":
+        return client.cat.count("events", request_timeout=600)
+    # Cold searches bypass the shard request cache which would otherwise answer repeated aggregations
+    params = dict(request_cache=False) if cache_mode == "cold" else dict()
+    return client.search(index="events", body=query, size=0, request_timeout=600, **params)
+
+
+def explain_queries():
+    """Returns a summary of the profile of every query, see query_plans"""
+    client = _db()
+    plans = dict()
+    for name, query in query_variants.expand(_queries, _query_variants).items():
+        print(f"Profiling query {name}", flush=True)
+        plans[name] = query_plans.explain_elasticsearch(client, query)
+    return plans
+
+
+def sample_events(count):
+    """Returns the device id and timestamp of up to count random stored events to draw the point query parameters from"""
+    query = {
+        "query": { "function_score": { "query": { "match_all": {} }, "random_score": {} } },
+        "_source": ["device_id", "timestamp"]
+    }
+    result = _db().search(index="events", body=query, size=count, request_timeout=600)
+    return [(hit["_source"]["device_id"], hit["_source"]["timestamp"]) for hit in result["hits"]["hits"]]
+
+
+def point_queries(samples, wait_for_start):
+    """Runs the point and range queries from several clients, see point_workload"""
+    _check_queryable(_db(), ["device_id", "timestamp"])
+
+    def device_window(client, device_id, start, end):
+        query = {
+            "query": { "bool": { "filter": [
+                { "term": { "device_id": device_id } },
+                { "range": { "timestamp": { "gte": start, "lt": end } } }
+            ]}},
+            "sort": [{ "timestamp": "asc" }],
+            "_source": ["timestamp", "temperature"]
+        }
+        client.search(index="events", body=query, size=10000, request_timeout=600)
+
+    def latest_devices(client, device_ids):
+        query = {
+            "query": { "terms": { "device_id": device_ids } },
+            "aggs": {
+                "devices": {
+                    "terms": { "field": "device_id", "size": len(device_ids) },
+                    "aggs": {
+                        "newest": { "top_hits": {
+                            "sort": [{ "timestamp": { "order": "desc" }}],
+                            "_source": { "includes": ["timestamp", "temperature"] },
+                            "size": 1
+                        }}
+                    }
+                }
+            }
+        }
+        client.search(index="events", body=query, size=0, request_timeout=600)
+
+    def close(client):
+        client.close()
+
+    return point_workload.run(samples, _db, {"device-window": device_window, "latest-devices": latest_devices}, close, wait_for_start)
@@ -1,8 +1,11 @@
 from datetime import datetime
+import functools
+import itertools
 import random
 import string
 from dataclasses import dataclass
 from dataclasses_json import dataclass_json
+import numpy as np
 
 
 @dataclass_json
@@ -14,16 +17,78 @@ class Event:
     temperature: float
 
 
+@dataclass
+class EventBatch:
+    """A batch of events stored as columns. device_id is resolved from a small per-worker table of device ids via device_index"""
+    timestamp: np.ndarray
+    device_index: np.ndarray
+    sequence_number: np.ndarray
+    temperature: np.ndarray
+    devices: np.ndarray
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    @property
+    def device_id(self):
+        return self.devices[self.device_index]
+
+    def rows(self):
+        """Returns the batch as a list of (timestamp, device_id, sequence_number, temperature) tuples of python values"""
+        return list(zip(self.timestamp.tolist(), self.device_id.tolist(), self.sequence_number.tolist(), self.temperature.tolist()))
+
+    def events(self):
+        for timestamp, device_id, sequence_number, temperature in self.rows():
+            yield Event(timestamp, device_id, sequence_number, temperature)
+
+    def text_columns(self, selection=slice(None)):
+        """Returns the columns (timestamp, device_id, sequence_number, temperature) of the selected events as arrays of strings,
+        to build text formats with concat() without a python object per event"""
+        return (self.timestamp[selection].astype(str), self.devices.astype(str)[self.device_index[selection]],
+                self.sequence_number[selection].astype(str), self.temperature[selection].astype(str))
+
+
+def concat(*parts):
+    """Concatenates string columns and constant strings element-wise"""
+    return functools.reduce(np.char.add, parts)
+
+
 def _rand_string(length):
     return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
 
 
 def generate_events(device_id, start_timestamp, num_events, sequence_number=1, device_spread=1):
+    """Yields num_events events, or an endless stream if num_events is None"""
     device_ids = [f"{_rand_string(4)}{device_id}{_rand_string(4)}" for i in range(device_spread)]
     if start_timestamp == 0:
         start_timestamp = int(datetime.now().timestamp()*1000)
-    for i in range(num_events):
+    for i in (range(num_events) if num_events is not None else itertools.count()):
         event = Event(start_timestamp, device_ids[i%device_spread], sequence_number, random.uniform(-20, 35))
         yield event
         sequence_number += 1
         start_timestamp += random.randint(5, 10)*60
+
+
+def generate_event_batches(device_id, start_timestamp, num_events, batch_size, sequence_number=1, device_spread=1):
+    """Columnar variant of generate_events that yields EventBatch objects with up to batch_size events each. num_events=None is endless"""
+    rng = np.random.default_rng()
+    devices = np.array([f"{_rand_string(4)}{device_id}{_rand_string(4)}" for i in range(device_spread)], dtype=object)
+    if start_timestamp == 0:
+        start_timestamp = int(datetime.now().timestamp()*1000)
+    offset = 0
+    while num_events is None or offset < num_events:
+        size = min(batch_size, num_events - offset) if num_events is not None else batch_size
+        steps = rng.integers(5, 11, size=size, dtype=np.int64)*60
+        timestamps = np.empty(size, dtype=np.int64)
+        timestamps[0] = start_timestamp
+        np.cumsum(steps[:-1], out=timestamps[1:])
+        timestamps[1:] += start_timestamp
+        yield EventBatch(
+            timestamp=timestamps,
+            device_index=np.arange(offset, offset+size, dtype=np.int64) % device_spread,
+            sequence_number=np.arange(sequence_number+offset, sequence_number+offset+size, dtype=np.int64),
+            temperature=rng.uniform(-20, 35, size=size),
+            devices=devices,
+        )
+        start_timestamp = int(timestamps[-1] + steps[-1])
+        offset += size
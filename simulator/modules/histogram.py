@@ -0,0 +1,76 @@
+import threading
+
+
+# Values are recorded in microseconds. Below 2*SUB_BUCKETS every microsecond has its own bucket, above that every power of two
+# is split into SUB_BUCKETS buckets, which keeps the relative error below 1/SUB_BUCKETS (like an HdrHistogram with ~2 significant digits)
+SUB_BUCKET_BITS = 6
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+
+def _index(value):
+    magnitude = max(0, value.bit_length() - SUB_BUCKET_BITS - 1)
+    return SUB_BUCKETS*magnitude + (value >> magnitude)
+
+
+def _value(index):
+    magnitude = max(0, index // SUB_BUCKETS - 1)
+    mantissa = index - SUB_BUCKETS*magnitude
+    lower = mantissa << magnitude
+    upper = ((mantissa + 1) << magnitude) - 1
+    return (lower + upper) // 2
+
+
+class Histogram:
+    """Compact, mergeable latency histogram. Only non-empty buckets are stored"""
+
+    def __init__(self):
+        self.counts = dict()
+        self.total = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, count=1):
+        value = max(0, int(seconds*1000000))
+        index = _index(value)
+        with self._lock:
+            self.counts[index] = self.counts.get(index, 0) + count
+            self.total += count
+            if value > self.max:
+                self.max = value
+
+    def merge(self, other):
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, percentile):
+        """Returns the given percentile in seconds"""
+        if not self.total:
+            return None
+        threshold = percentile/100*self.total
+        seen = 0
+        for index in sorted(self.counts.keys()):
+            seen += self.counts[index]
+            if seen >= threshold:
+                return min(_value(index), self.max)/1000000
+        return self.max/1000000
+
+    def summary(self):
+        if not self.total:
+            return None
+        return dict(count=self.total, p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99),
+                    p999=self.percentile(99.9), max=self.max/1000000)
+
+    def to_dict(self):
+        return dict(unit="us", counts=sorted(self.counts.items()), total=self.total, max=self.max)
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        if data:
+            histogram.counts = dict((index, count) for index, count in data["counts"])
+            histogram.total = data["total"]
+            histogram.max = data["max"]
+        return histogram
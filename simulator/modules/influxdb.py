@@ -1,9 +1,11 @@
+from importlib import metadata as importlib_metadata
 from datetime import date, timedelta
 import time
 import influxdb_client
 from influxdb_client import Point
 from influxdb_client.client.write_api import SYNCHRONOUS, WritePrecision
 from .config import config
+from . import async_engine, cache_control, event_generator, instrumentation, null_sink, point_workload, query_plans, query_variants
 
 
 BUCKET_NAME = "dbtest"
@@ -12,6 +14,8 @@ NEXT_YEAR = (date.today()+ timedelta(days=366)).year
 
 
 def _db():
+    if null_sink.enabled():
+        return null_sink.NullInfluxClient()
     client = influxdb_client.InfluxDBClient(url=config["endpoint"], token=config["token"], org=config["org"], timeout=600*1000)
     return client
 
@@ -32,6 +36,15 @@ def init():
     print("Created bucket")
 
 
+def version():
+    """Returns the version of the database and of the client library"""
+    driver = f"influxdb-client {importlib_metadata.version('influxdb-client')}"
+    if null_sink.enabled():
+        return dict(database="null sink", driver=driver)
+    database = f"InfluxDB {_db().health().version}"
+    return dict(database=database, driver=driver)
+
+
 def prefill_events(events):
     _insert_events(events, True, 1000)
 
@@ -39,9 +52,57 @@ def prefill_events(events):
 def insert_events(events):
     batch_mode = config.get("batch_mode", False)
     batch_size = config.get("batch_size", 1000)
+    if async_engine.enabled():
+        _async_insert(async_engine.batched(events, batch_size if batch_mode else 1))
+        return
     _insert_events(events, batch_mode, batch_size)
 
 
+def insert_batches(batches):
+    if async_engine.enabled():
+        _async_insert(batches)
+        return
+    batch_mode = config.get("batch_mode", False)
+    if not batch_mode:
+        insert_events(event for batch in batches for event in batch.events())
+        return
+    print("Connecting to database", flush=True)
+    client = _db()
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+
+    print("Inserting events", flush=True)
+    for batch in batches:
+        # Build the line protocol directly from the columns instead of creating a Point per event
+        with instrumentation.phase("serialize"):
+            timestamp, device_id, _, temperature = batch.text_columns()
+            lines = "\n".join(event_generator.concat("events,device_id=", device_id, " temperature=", temperature, " ", timestamp).tolist())
+        with instrumentation.measure(len(batch)):
+            write_api.write(bucket=BUCKET_NAME, record=lines, write_precision=WritePrecision.MS)
+
+    print("Finished inserting", flush=True)
+
+
+def _async_insert(batches):
+    import aiohttp
+
+    async def connect():
+        return aiohttp.ClientSession(headers={"Authorization": f"Token {config['token']}"}, timeout=aiohttp.ClientTimeout(total=600))
+
+    async def send(session, batch):
+        body = "\n".join([f"events,device_id={device_id} temperature={temperature} {timestamp}" for timestamp, device_id, _, temperature in async_engine.rows(batch)])
+        params = dict(org=config["org"], bucket=BUCKET_NAME, precision="ms")
+        async with session.post(f"{config['endpoint']}/api/v2/write", params=params, data=body.encode("utf-8")) as response:
+            if response.status >= 300:
+                raise Exception(f"Write failed with status {response.status}: {await response.text()}")
+
+    async def close(session):
+        await session.close()
+
+    print("Inserting events", flush=True)
+    async_engine.run(batches, connect, send, close)
+    print("Finished inserting", flush=True)
+
+
 def _insert_events(events, batch_mode, batch_size):
     print("Connecting to database", flush=True)
     client = _db()
@@ -59,7 +120,8 @@ def _insert_events(events, batch_mode, batch_size):
 def _single_insert_mode(write_api, events):
     for event in events:
         p = Point("events").time(event.timestamp, write_precision=WritePrecision.MS).tag("device_id", event.device_id).field("temperature", event.temperature)
-        write_api.write(bucket=BUCKET_NAME, record=p)
+        with instrumentation.measure():
+            write_api.write(bucket=BUCKET_NAME, record=p)
 
 
 def _batch_mode(write_api, events, batch_size):
@@ -70,11 +132,13 @@ def _batch_mode(write_api, events, batch_size):
         buffer.append(p)
         size += 1
         if size >= batch_size:
-            write_api.write(bucket=BUCKET_NAME, record=buffer)
+            with instrumentation.measure(size):
+                write_api.write(bucket=BUCKET_NAME, record=buffer)
             buffer.clear()
             size = 0
-    if size >= 0:
-        write_api.write(bucket=BUCKET_NAME, record=buffer) 
+    if size > 0:
+        with instrumentation.measure(size):
+            write_api.write(bucket=BUCKET_NAME, record=buffer)
 
 
 _queries = {
@@ -155,17 +219,119 @@ _queries = {
     """,
 }
 
-def queries():
+_query_variants = {
+    # Single pass over the data with reduce instead of one pass per aggregate and joins
+    "temperature-min-max": {
+        "reduce": f"""
+            from(bucket: "{BUCKET_NAME}")
+            |> range(start: {CURRENT_YEAR}-01-01, stop: {NEXT_YEAR}-12-31)
+            |> keep(columns: ["_value"])
+            |> group()
+            |> reduce(identity: {{min: 1000.0, max: -1000.0}}, fn: (r, accumulator) => ({{
+                min: if r._value < accumulator.min then r._value else accumulator.min,
+                max: if r._value > accumulator.max then r._value else accumulator.max
+            }}))
+        """,
+    },
+    "temperature-stats-per-device": {
+        "reduce": f"""
+            from(bucket: "{BUCKET_NAME}")
+            |> range(start: {CURRENT_YEAR}-01-01, stop: {NEXT_YEAR}-12-31)
+            |> keep(columns: ["device_id", "_value"])
+            |> group(columns: ["device_id"])
+            |> reduce(identity: {{count: 0.0, sum: 0.0, min: 1000.0, max: -1000.0}}, fn: (r, accumulator) => ({{
+                count: accumulator.count + 1.0,
+                sum: accumulator.sum + r._value,
+                min: if r._value < accumulator.min then r._value else accumulator.min,
+                max: if r._value > accumulator.max then r._value else accumulator.max
+            }}))
+            |> map(fn: (r) => ({{device_id: r.device_id, mean: r.sum / r.count, min: r.min, max: r.max}}))
+            |> group()
+        """,
+    },
+}
+
+def queries(rounds=None):
     client = _db()
     query_api = client.query_api()
 
-    query_times = dict([(name, []) for name in _queries.keys()])
-    for i in range(int(config["runs"])):
-        for name, query in _queries.items():
-            start = time.time()
-            result = query_api.query(query=query)
-            list(result) # Force client to actually fetch results
-            duration = time.time() - start
-            query_times[name].append(duration)
+    selected = query_variants.expand(_queries, _query_variants)
+    query_times = dict([(cache_control.result_name(name, mode), []) for name in selected.keys() for mode in cache_control.modes()])
+    if cache_control.warm_up():
+        for query in selected.values():
+            list(query_api.query(query=query))
+    if rounds is None:
+        rounds = range(int(config["runs"]))
+    for i in rounds:
+        for name, query in selected.items():
+            for mode in cache_control.modes():
+                if mode == "cold":
+                    # InfluxDB has no query cache to clear, a new client at least starts without open connections
+                    client.close()
+                    client = _db()
+                    query_api = client.query_api()
+                start = time.time()
+                result = query_api.query(query=query)
+                list(result) # Force client to actually fetch results
+                duration = time.time() - start
+                query_times[cache_control.result_name(name, mode)].append(duration)
 
     return query_times
+
+
+def explain_queries():
+    """Returns a summary of the Flux profiler output of every query, see query_plans"""
+    query_api = _db().query_api()
+    plans = dict()
+    for name, query in query_variants.expand(_queries, _query_variants).items():
+        print(f"Profiling query {name}", flush=True)
+        plans[name] = query_plans.explain_influxdb(query_api, query)
+    return plans
+
+
+def sample_events(count):
+    """Returns device ids and timestamps to draw the point query parameters from. Flux can not draw random rows over all series,
+    so the first and last timestamp of every device (series) is looked up and the timestamps are drawn from this range"""
+    query_api = _db().query_api()
+    time_ranges = dict()
+    for selector in ["first", "last"]:
+        query = f"""
+            from(bucket: "{BUCKET_NAME}")
+            |> range(start: {CURRENT_YEAR}-01-01, stop: {NEXT_YEAR}-12-31)
+            |> filter(fn: (r) => r._measurement == "events" and r._field == "temperature")
+            |> {selector}()
+            |> keep(columns: ["device_id", "_time"])
+        """
+        for table in query_api.query(query=query):
+            for record in table.records:
+                time_ranges.setdefault(record.values["device_id"], list()).append(int(record.get_time().timestamp()*1000))
+    devices = point_workload.sample_devices(device_id for device_id, timestamps in time_ranges.items() if len(timestamps) == 2)
+    return point_workload.spread_samples(dict((device_id, tuple(time_ranges[device_id])) for device_id in devices), count)
+
+
+def point_queries(samples, wait_for_start):
+    """Runs the point and range queries from several clients, see point_workload"""
+
+    def device_window(client, device_id, start, end):
+        # time() expects nanoseconds, the timestamps of the events are milliseconds
+        query = f"""
+            from(bucket: "{BUCKET_NAME}")
+            |> range(start: time(v: {start*1000000}), stop: time(v: {end*1000000}))
+            |> filter(fn: (r) => r._measurement == "events" and r.device_id == "{device_id}")
+        """
+        list(client.query_api().query(query=query))
+
+    def latest_devices(client, device_ids):
+        devices = ", ".join(f'"{device_id}"' for device_id in device_ids)
+        query = f"""
+            from(bucket: "{BUCKET_NAME}")
+            |> range(start: {CURRENT_YEAR}-01-01, stop: {NEXT_YEAR}-12-31)
+            |> filter(fn: (r) => r._measurement == "events" and contains(value: r.device_id, set: [{devices}]))
+            |> last()
+        """
+        list(client.query_api().query(query=query))
+
+    def close(client):
+        client.close()
+
+    return point_workload.run(samples, _db, {"device-window": device_window, "latest-devices": latest_devices}, close, wait_for_start)
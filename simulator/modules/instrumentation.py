@@ -0,0 +1,247 @@
+import gc
+import os
+import threading
+import time
+from contextlib import contextmanager
+from .histogram import Histogram
+
+
+class Recorder:
+    """Collects the latency of every batch/statement sent by a module"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Responses can be recorded from other threads (Cassandra callbacks, COPY streams)
+        self._lock = threading.Lock()
+        self.histogram = Histogram()
+        self.events = 0
+        self.errors = 0
+        self.intended_start = None
+        # Seconds spent per phase of the insert (generate, serialize, send, wait) by the main thread, see phase(). The phases
+        # of the main thread do not overlap, so together with the rest (other) they add up to the duration of the insert
+        self.phases = dict()
+        # Seconds spent per phase by other threads (COPY streams, the generator of the async engine) and by overlapping
+        # requests, summed up so they can exceed the duration
+        self.concurrent_phases = dict()
+
+    def batch_start(self):
+        # In open-loop mode a batch is due at its scheduled time, so measure from there even if sending is late (coordinated omission)
+        if self.intended_start is not None:
+            return self.intended_start
+        return time.perf_counter()
+
+    def record(self, start, count=1):
+        self.histogram.record(time.perf_counter() - start)
+        with self._lock:
+            self.events += count
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+    def add_phase(self, name, seconds, concurrent=None):
+        if concurrent is None:
+            concurrent = threading.current_thread() is not threading.main_thread()
+        phases = self.concurrent_phases if concurrent else self.phases
+        with self._lock:
+            phases[name] = phases.get(name, 0) + seconds
+
+
+recorder = Recorder()
+
+
+def reset():
+    recorder.reset()
+
+
+@contextmanager
+def measure(count=1):
+    start = recorder.batch_start()
+    with phase("send"):
+        yield
+    recorder.record(start, count)
+
+
+# Phases can be nested (e.g. a module serializing events while pulling them from the generator), every phase only
+# counts the time not spent in nested phases. The stack of nested time is kept per thread
+_phase_stack = threading.local()
+
+
+@contextmanager
+def phase(name):
+    """Adds the time spent in the block (minus nested phases) to the given phase"""
+    start = _enter_phase()
+    try:
+        yield
+    finally:
+        _exit_phase(name, start)
+
+
+def timed(items, name):
+    """Adds the time spent producing every item of items to the given phase"""
+    items = iter(items)
+    while True:
+        start = _enter_phase()
+        item = next(items, StopIteration)
+        _exit_phase(name, start)
+        if item is StopIteration:
+            return
+        yield item
+
+
+def _enter_phase():
+    stack = getattr(_phase_stack, "nested", None)
+    if stack is None:
+        stack = _phase_stack.nested = list()
+    stack.append(0)
+    return time.perf_counter()
+
+
+def _exit_phase(name, start):
+    elapsed = time.perf_counter() - start
+    stack = _phase_stack.nested
+    recorder.add_phase(name, elapsed - stack.pop())
+    if stack:
+        stack[-1] += elapsed
+
+
+def network_bytes():
+    """Returns (bytes sent, bytes received) over all network interfaces of the pod except loopback"""
+    sent, received = 0, 0
+    try:
+        with open("/proc/net/dev") as f:
+            for line in f.readlines()[2:]:
+                interface, counters = line.split(":", 1)
+                if interface.strip() == "lo":
+                    continue
+                counters = counters.split()
+                received += int(counters[0])
+                sent += int(counters[8])
+    except OSError:
+        pass
+    return sent, received
+
+
+class Deadline:
+    """Ends a stream of items once the deadline (a time.time() timestamp) has passed and counts the events let through"""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.events = 0
+
+    def limit(self, items, size=None):
+        for item in items:
+            if time.time() >= self.deadline:
+                return
+            self.events += size(item) if size else 1
+            yield item
+
+
+def rss_bytes():
+    """Returns the resident set size of the current process"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+class ResourceMonitor:
+    """Samples the CPU usage and memory of the process and the network traffic of the pod while a workload runs and records
+    the pauses of the garbage collector. stop() returns a summary
+    """
+
+    def __init__(self, interval=1):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self.cpu_utilization_max = 0
+        self.rss_max = 0
+        self.gc_collections = 0
+        self.gc_pause_total = 0
+        self.gc_pause_max = 0
+        self._gc_start = None
+
+    def start(self):
+        self._wall_start = time.time()
+        self._cpu_start = time.process_time()
+        self._network_start = network_bytes()
+        self.rss_max = rss_bytes()
+        gc.callbacks.append(self._gc_callback)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        gc.callbacks.remove(self._gc_callback)
+        wall_time = time.time() - self._wall_start
+        cpu_time = time.process_time() - self._cpu_start
+        sent, received = network_bytes()
+        return dict(
+            wall_time=wall_time,
+            cpu_time=cpu_time,
+            cpu_utilization=cpu_time/wall_time if wall_time else 0,
+            cpu_utilization_max=max(self.cpu_utilization_max, cpu_time/wall_time if wall_time else 0),
+            rss_max=max(self.rss_max, rss_bytes()),
+            gc_collections=self.gc_collections,
+            gc_pause_total=self.gc_pause_total,
+            gc_pause_max=self.gc_pause_max,
+            bytes_sent=sent-self._network_start[0],
+            bytes_received=received-self._network_start[1],
+        )
+
+    def _gc_callback(self, phase, info):
+        if phase == "start":
+            self._gc_start = time.perf_counter()
+        elif self._gc_start is not None:
+            pause = time.perf_counter() - self._gc_start
+            self.gc_collections += 1
+            self.gc_pause_total += pause
+            self.gc_pause_max = max(self.gc_pause_max, pause)
+            self._gc_start = None
+
+    def _sample(self):
+        last_wall, last_cpu = time.time(), time.process_time()
+        while not self._stop.wait(self.interval):
+            wall, cpu = time.time(), time.process_time()
+            if wall > last_wall:
+                self.cpu_utilization_max = max(self.cpu_utilization_max, (cpu-last_cpu)/(wall-last_wall))
+            self.rss_max = max(self.rss_max, rss_bytes())
+            last_wall, last_cpu = wall, cpu
+
+
+def merge_resources(summaries):
+    """Combines the resource summaries of several processes of one worker pod"""
+    return dict(
+        wall_time=max([summary["wall_time"] for summary in summaries]),
+        cpu_time=sum([summary["cpu_time"] for summary in summaries]),
+        # Every process has its own core, so the busiest one decides whether the pod was saturated
+        cpu_utilization=max([summary["cpu_utilization"] for summary in summaries]),
+        cpu_utilization_max=max([summary["cpu_utilization_max"] for summary in summaries]),
+        rss_max=sum([summary["rss_max"] for summary in summaries]),
+        gc_collections=sum([summary["gc_collections"] for summary in summaries]),
+        gc_pause_total=sum([summary["gc_pause_total"] for summary in summaries]),
+        gc_pause_max=max([summary["gc_pause_max"] for summary in summaries]),
+        # The network counters are per pod, so the processes all see the same traffic
+        bytes_sent=max([summary["bytes_sent"] for summary in summaries]),
+        bytes_received=max([summary["bytes_received"] for summary in summaries]),
+    )
+
+
+def paced(items, interval, items_per_send=1):
+    """Yields items on a fixed schedule: every items_per_send items a new send is due, interval seconds after the previous one.
+    If the consumer falls behind the schedule items are yielded immediately so the backlog is visible in the latencies.
+    """
+    start = time.perf_counter()
+    for idx, item in enumerate(items):
+        if idx % items_per_send == 0:
+            intended_start = start + (idx // items_per_send) * interval
+            delay = intended_start - time.perf_counter()
+            if delay > 0:
+                with phase("wait"):
+                    time.sleep(delay)
+            recorder.intended_start = intended_start
+        yield item
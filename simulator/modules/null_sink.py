@@ -0,0 +1,138 @@
+# Stand-ins for the database clients that run the full client-side serialization path of a module but do no network I/O.
+# Used with the null_sink option to measure how many events/s the worker code itself can produce.
+import json
+import re
+from .config import config
+
+
+def enabled():
+    return str(config.get("null_sink", "false")).lower() == "true"
+
+
+class NullPostgresCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def mogrify(self, query, args=None):
+        from psycopg2.extensions import adapt
+        if isinstance(query, str):
+            query = query.encode("utf-8")
+        if args is None:
+            return query
+        return query % tuple(adapt(arg).getquoted() for arg in args)
+
+    def execute(self, query, args=None):
+        self.mogrify(query, args)
+
+    def copy_from(self, file, table, sep="\t", columns=None):
+        file.read().encode("utf-8")
+
+    def copy_expert(self, sql, file):
+        file.read()
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class NullPostgresConnection:
+    encoding = "UTF8"
+
+    def cursor(self):
+        return NullPostgresCursor(self)
+
+    def set_session(self, **kwargs):
+        pass
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullInfluxWriteApi:
+
+    def write(self, bucket, record, write_precision=None):
+        records = record if isinstance(record, list) else [record]
+        lines = [r if isinstance(r, str) else r.to_line_protocol() for r in records]
+        "\n".join(lines).encode("utf-8")
+
+
+class NullInfluxClient:
+
+    def write_api(self, write_options=None):
+        return NullInfluxWriteApi()
+
+
+class NullElasticsearchTransport:
+
+    def __init__(self):
+        from elasticsearch.serializer import JSONSerializer
+        self.serializer = JSONSerializer()
+
+
+class NullElasticsearch:
+
+    def __init__(self):
+        self.transport = NullElasticsearchTransport()
+
+    def bulk(self, body, *args, **kwargs):
+        body.encode("utf-8")
+        # Every indexed document consists of an action line and a source line
+        return dict(errors=False, items=[dict(index=dict(status=201)) for _ in range(body.count("\n")//2)])
+
+    def index(self, index, document, id=None):
+        self.transport.serializer.dumps(document).encode("utf-8")
+
+
+class NullCassandraFuture:
+
+    def add_callback(self, fn, *args, **kwargs):
+        fn(None, *args, **kwargs)
+
+    def result(self):
+        return None
+
+
+class NullCassandraSession:
+    default_timeout = None
+
+    def prepare(self, query):
+        from cassandra import ProtocolVersion
+        from cassandra.cqltypes import FloatType, LongType, VarcharType
+        from cassandra.protocol import ColumnMetadata
+        from cassandra.query import PreparedStatement
+        column_types = dict(timestamp=LongType, device_id=VarcharType, sequence_number=LongType, temperature=FloatType)
+        match = re.search(r"INSERT INTO (\w+)\.(\w+) \(([^)]*)\)", query)
+        keyspace, table = match.group(1), match.group(2)
+        columns = [column.strip() for column in match.group(3).split(",")]
+        column_metadata = [ColumnMetadata(keyspace, table, column, column_types[column]) for column in columns]
+        return PreparedStatement(column_metadata, b"null", [], query, keyspace, ProtocolVersion.V4, [], None)
+
+    def execute(self, statement):
+        return None
+
+    def execute_async(self, statement):
+        return NullCassandraFuture()
+
+    def shutdown(self):
+        pass
+
+
+class NullArangoCollection:
+
+    def insert(self, document, sync=None):
+        json.dumps(document).encode("utf-8")
+
+    def insert_many(self, documents, sync=None):
+        json.dumps(documents).encode("utf-8")
+
+
+class NullArangoDatabase:
+
+    def collection(self, name):
+        return NullArangoCollection()
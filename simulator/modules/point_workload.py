@@ -0,0 +1,121 @@
+# Parameterized point and range queries like the ones dashboards send: the readings of one device in a time window and the
+# latest reading of a set of devices. The parameters are drawn from a sample of the stored events, every worker runs the queries
+# from several client threads (each with its own connection) until the end of the run
+import random
+import threading
+import time
+from .config import config
+from .histogram import Histogram
+
+
+KINDS = ["device-window", "latest-devices"]
+# Number of stored events the device ids and timestamps are drawn from
+SAMPLE_SIZE = 10000
+# Upper limit of devices whose time range is looked up by databases that can not sample events (see spread_samples)
+MAX_SAMPLE_DEVICES = 1000
+# Seconds the clients send queries if the run has no duration
+DEFAULT_DURATION = 30
+
+
+def kinds():
+    selected = config.get("point_queries", ",".join(KINDS)).split(",")
+    for kind in selected:
+        if kind not in KINDS:
+            raise Exception(f"Unknown point query {kind}, use one of {', '.join(KINDS)}")
+    return selected
+
+
+def clients():
+    return int(config.get("point_clients", 16))
+
+
+def window():
+    """Length of the time window of device-window in milliseconds of the timestamp column, default 3 hours"""
+    return int(config.get("point_window", 3*3600*1000))
+
+
+def device_count():
+    return int(config.get("point_devices", 50))
+
+
+def spread_samples(time_ranges, count, rng=random):
+    """For databases that can not draw random events: draws count (device_id, timestamp) pairs from the time ranges
+    ((first, last) timestamp per device) of the devices, the devices uniformly and the timestamps uniformly within their range"""
+    devices = list(time_ranges.keys())
+    samples = list()
+    for _ in range(count if devices else 0):
+        device_id = rng.choice(devices)
+        first, last = time_ranges[device_id]
+        samples.append((device_id, rng.randint(first, last)))
+    return samples
+
+
+def sample_devices(devices, rng=random):
+    """Limits the devices whose time ranges are looked up for spread_samples to a random subset"""
+    devices = list(devices)
+    return rng.sample(devices, min(MAX_SAMPLE_DEVICES, len(devices)))
+
+
+class Parameters:
+    """Draws random query parameters from a sample of (device_id, timestamp) pairs of the stored events"""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.devices = sorted(set(device_id for device_id, _ in samples))
+
+    def draw(self, kind, rng):
+        if kind == "device-window":
+            # The window ends at a stored event so it always contains data
+            device_id, timestamp = rng.choice(self.samples)
+            return device_id, timestamp - window(), timestamp + 1
+        return (rng.sample(self.devices, min(device_count(), len(self.devices))),)
+
+
+def run(samples, connect, queries, close, wait_for_start):
+    """Runs the queries from clients() threads until the end of the run. queries maps every kind to a function
+    (connection, *parameters), device-window gets device_id, start and end (exclusive), latest-devices a list of device ids.
+    The connections are opened before wait_for_start() is called, it has to return the schedule of the run"""
+    if not samples:
+        raise Exception("No events found to draw the query parameters from, insert events before running point queries")
+    parameters = Parameters(samples)
+    selected = kinds()
+    print(f"Drew parameters from {len(samples)} events of {len(parameters.devices)} devices", flush=True)
+    connections = [connect() for _ in range(clients())]
+    schedule = wait_for_start()
+    end_time = schedule.get("end_time") or schedule["start_time"] + DEFAULT_DURATION
+    client_results = [dict((kind, dict(queries=0, errors=0, histogram=Histogram())) for kind in selected) for _ in connections]
+    threads = [threading.Thread(target=_client, args=(connection, queries, parameters, selected, end_time, results), daemon=True)
+               for connection, results in zip(connections, client_results)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    finished = time.time()
+    for connection in connections:
+        close(connection)
+    merged = dict()
+    for kind in selected:
+        histogram = Histogram()
+        for results in client_results:
+            histogram.merge(results[kind]["histogram"])
+        merged[kind] = dict(queries=sum(results[kind]["queries"] for results in client_results),
+                            errors=sum(results[kind]["errors"] for results in client_results), latency_histogram=histogram.to_dict())
+    return dict(kinds=merged, clients=len(connections), start_time=schedule["start_time"], end_time=finished)
+
+
+def _client(connection, queries, parameters, selected, end_time, results):
+    rng = random.Random()
+    while time.time() < end_time:
+        kind = rng.choice(selected)
+        arguments = parameters.draw(kind, rng)
+        # The schedule is in wall-clock time, the latency is measured with the monotonic high-resolution clock
+        start = time.perf_counter()
+        try:
+            queries[kind](connection, *arguments)
+        except Exception as e:
+            if not results[kind]["errors"]:
+                print(f"Point query {kind} failed: {e}", flush=True)
+            results[kind]["errors"] += 1
+            continue
+        results[kind]["histogram"].record(time.perf_counter() - start)
+        results[kind]["queries"] += 1
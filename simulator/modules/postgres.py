@@ -1,12 +1,20 @@
+from importlib import metadata as importlib_metadata
+import collections
 import io
+import os
+import string
+import struct
 import time
 import psycopg2
 import psycopg2.extras
 from .config import config
+from . import async_engine, binary_copy, cache_control, copy_streams, event_generator, instrumentation, null_sink, point_workload, query_plans, query_variants
 
 
 
 def _db():
+    if null_sink.enabled():
+        return null_sink.NullPostgresConnection()
     connection_string = config["connection_string"]
     con = psycopg2.connect(connection_string)
     if not config.get("batch_mode", False):
@@ -50,6 +58,9 @@ def init():
     else:
         pk_column = ""
 
+    partitioning = config.get("partitioning")
+    # A primary key of a partitioned table has to contain the partition key
+    constraint = config.get("primary_key_constraint", _PARTITIONED_PRIMARY_KEYS[partitioning] if partitioning else "PRIMARY KEY (id)")
     for table_name in table_names:
         cur.execute(
         f"""
@@ -57,26 +68,259 @@ def init():
             timestamp bigint,
             device_id varchar,
             sequence_number bigint,
-            temperature real,
-            {config.get("primary_key_constraint","PRIMARY KEY (id)")}
-            )
+            temperature real{"," if constraint else ""}
+            {constraint}
+            ){_PARTITION_CLAUSES[partitioning] if partitioning else ""}
         """)
+        db.commit()
+        if partitioning:
+            _create_partitions(db, cur, table_name, partitioning)
     db.commit()
     print("Created table events")
+    _create_ingest_indices(db, cur, table_names)
     cur.close()
 
 
+_PARTITION_CLAUSES = dict(
+    range=" PARTITION BY RANGE (timestamp)",
+    hash=" PARTITION BY HASH (device_id)",
+    # The schema has no natural list key (like a region or tenant), so the device ids are grouped by their first character
+    list=" PARTITION BY LIST ((left(device_id, 1)))",
+)
+_PARTITIONED_PRIMARY_KEYS = dict(
+    range="PRIMARY KEY (id, timestamp)",
+    hash="PRIMARY KEY (id, device_id)",
+    # Primary keys can not contain the expression of the list partitioning
+    list="",
+)
+# Largest gap between the timestamps of two events of a worker (see event_generator)
+_MAX_TIMESTAMP_STEP = 600
+
+
+def _create_partitions(db, cur, table_name, partitioning):
+    """Creates the partitions of a partitioned table. Range partitions are created ahead of time for all timestamps the workers
+    of this run will generate, later runs without cleaning the database (steps) add the partitions for their new timestamps"""
+    if partitioning == "hash":
+        count = int(config.get("partition_count", 8))
+        statements = [f"CREATE TABLE IF NOT EXISTS {table_name}_p{index} PARTITION OF {table_name} FOR VALUES WITH (MODULUS {count}, REMAINDER {index})"
+                      for index in range(count)]
+    elif partitioning == "list":
+        count = int(config.get("partition_count", 4))
+        characters = string.ascii_lowercase + string.digits
+        statements = [f"CREATE TABLE IF NOT EXISTS {table_name}_p{index} PARTITION OF {table_name} FOR VALUES IN ({', '.join(repr(c) for c in characters[index::count])})"
+                      for index in range(count)]
+        statements.append(f"CREATE TABLE IF NOT EXISTS {table_name}_default PARTITION OF {table_name} DEFAULT")
+    else:
+        interval = int(config.get("partition_interval", 86400000))
+        first = int(time.time()*1000) // interval
+        if "partition_count" in config:
+            last = first + int(config["partition_count"]) - 1
+        else:
+            events_per_worker = int(config.get("prefill", 0)) // int(os.environ.get("WORKER_COUNT", 1)) + int(config.get("num_inserts", 0))
+            last = (int(time.time()*1000) + events_per_worker*_MAX_TIMESTAMP_STEP) // interval + 1
+        statements = [f"CREATE TABLE IF NOT EXISTS {table_name}_r{index} PARTITION OF {table_name} FOR VALUES FROM ({index*interval}) TO ({(index+1)*interval})"
+                      for index in range(first, last+1)]
+        # Events beyond the partitions created ahead (e.g. with --duration) end up here instead of failing
+        statements.append(f"CREATE TABLE IF NOT EXISTS {table_name}_default PARTITION OF {table_name} DEFAULT")
+    print(f"Creating {len(statements)} partitions for {table_name}", flush=True)
+    for statement in statements:
+        try:
+            cur.execute(statement)
+            db.commit()
+        except psycopg2.Error as e:
+            # A new range partition fails if the default partition already contains events of its range from an earlier run
+            db.rollback()
+            print(f"Failed to create partition: {e}", flush=True)
+
+
+def version():
+    """Returns the version of the database and of the client library"""
+    driver = f"psycopg2-binary {importlib_metadata.version('psycopg2-binary')}"
+    if null_sink.enabled():
+        return dict(database="null sink", driver=driver)
+    db = _db()
+    cur = db.cursor()
+    cur.execute("SELECT version()")
+    database = cur.fetchone()[0]
+    db.close()
+    return dict(database=database, driver=driver)
+
+
 def prefill_events(events):
     _insert_events(events, True, 1000)
 
 
 def insert_events(events):
+    if _pipeline_engine():
+        _pipeline_insert_mode(events)
+        return
     batch_mode = config.get("batch_mode", False)
     batch_size = config.get("batch_size", 100)
+    if async_engine.enabled():
+        _async_insert(async_engine.batched(events, batch_size if batch_mode else 1))
+        return
     use_values_lists = config.get("use_values_lists", "false").lower() == "true"
     _insert_events(events, batch_mode, batch_size, use_values_lists)
 
 
+def insert_batches(batches):
+    if _pipeline_engine():
+        _pipeline_insert_mode(event for batch in batches for event in batch.events())
+        return
+    if async_engine.enabled():
+        _async_insert(batches)
+        return
+    batch_mode = config.get("batch_mode", False)
+    if not batch_mode:
+        insert_events(event for batch in batches for event in batch.events())
+        return
+    use_values_lists = config.get("use_values_lists", "false").lower() == "true"
+    print("Connecting to database", flush=True)
+    if config["use_multiple_tables"]:
+        table_names = ["events0", "events1", "events2", "events3"]
+    else:
+        table_names = ["events"]
+
+    print("Inserting events", flush=True)
+    binary = binary_copy.enabled() and not use_values_lists
+    streams = _copy_streams(table_names) if not use_values_lists else None
+    if streams is None:
+        db = _db()
+        cur = db.cursor()
+    # With several streams a batch is still being sent while the next one is encoded, so the buffers are only reused with one
+    buffers = [binary_copy.CopyBuffer() for _ in table_names] if binary and streams is None else None
+    for batch in batches:
+        with instrumentation.phase("serialize"):
+            if binary:
+                files = _binary_copy_files(batch, buffers or [binary_copy.CopyBuffer() for _ in table_names])
+            elif use_values_lists:
+                rows = _batch_rows(batch)
+                values_lists = [rows[table_index::len(table_names)] for table_index in range(len(table_names))]
+            else:
+                files = _text_copy_files(batch, len(table_names))
+        if use_values_lists:
+            _values_lists_insert(db, cur, values_lists, table_names)
+        elif streams is not None:
+            streams.put(len(batch), files)
+        else:
+            with instrumentation.measure(len(batch)):
+                for table_index, values in enumerate(files):
+                    _copy_from(cur, values, table_names[table_index])
+                db.commit()
+    if streams is not None:
+        streams.close()
+    else:
+        cur.close()
+    print("Finished inserting", flush=True)
+
+
+def _batch_rows(batch):
+    return _rows_with_id(batch.rows())
+
+
+def _rows_with_id(rows):
+    if config["primary_key"] == "client":
+        rows = [(f"{device_id}{timestamp}{sequence_number}", timestamp, device_id, sequence_number, temperature) for timestamp, device_id, sequence_number, temperature in rows]
+    return rows
+
+
+def _copy_file(rows):
+    return io.StringIO("".join(["\t".join(map(str, row)) + "\n" for row in rows]))
+
+
+def _text_copy_files(batch, number_of_tables):
+    """Formats the text COPY data of every table directly from the columns, the rows are distributed over the tables like in
+    _copy_file"""
+    files = list()
+    for table_index in range(number_of_tables):
+        timestamp, device_id, sequence_number, temperature = batch.text_columns(slice(table_index, None, number_of_tables))
+        parts = [timestamp, "\t", device_id, "\t", sequence_number, "\t", temperature, "\n"]
+        if config["primary_key"] == "client":
+            parts = [device_id, timestamp, sequence_number, "\t"] + parts
+        files.append(io.StringIO("".join(event_generator.concat(*parts).tolist())))
+    return files
+
+
+def _binary_copy_files(batch, buffers):
+    """Encodes the batch into the binary COPY buffer of every table, the rows are distributed over the tables like in the text format"""
+    rows = _batch_rows(batch) if config["primary_key"] == "client" else None
+    for table_index, buffer in enumerate(buffers):
+        buffer.reset()
+        if rows is not None:
+            buffer.add_rows(rows[table_index::len(buffers)])
+        else:
+            selection = slice(table_index, None, len(buffers))
+            buffer.add_columns(batch.timestamp[selection], batch.device_index[selection], batch.devices, batch.sequence_number[selection], batch.temperature[selection])
+    return [buffer.file() for buffer in buffers]
+
+
+def _copy_streams(table_names):
+    """Returns CopyStreams that send the COPY files of a batch (one per table) on copy_streams connections, or None to use one"""
+    if copy_streams.count() <= 1:
+        return None
+
+    def connect():
+        db = _db()
+        return db, db.cursor()
+
+    def send(connection, files):
+        db, cur = connection
+        for table_index, values in enumerate(files):
+            _copy_from(cur, values, table_names[table_index])
+        db.commit()
+
+    def close(connection):
+        connection[1].close()
+        connection[0].close()
+
+    return copy_streams.CopyStreams(copy_streams.count(), connect, send, close)
+
+
+def _copy_from(cur, values, table_name):
+    if config["primary_key"] != "client":
+        columns = ('timestamp', 'device_id', 'sequence_number', 'temperature')
+    else:
+        columns = ('id','timestamp', 'device_id', 'sequence_number', 'temperature')
+    if binary_copy.enabled():
+        cur.copy_expert(binary_copy.copy_statement(table_name, columns), values)
+    else:
+        cur.copy_from(values,table_name,sep="\t",columns=columns)
+
+
+def _async_insert(batches):
+    import asyncpg
+    use_values_lists = config.get("use_values_lists", "false").lower() == "true"
+    if config["use_multiple_tables"]:
+        table_names = ["events0", "events1", "events2", "events3"]
+    else:
+        table_names = ["events"]
+    if config["primary_key"] != "client":
+        columns = ['timestamp', 'device_id', 'sequence_number', 'temperature']
+    else:
+        columns = ['id', 'timestamp', 'device_id', 'sequence_number', 'temperature']
+
+    async def connect():
+        return await asyncpg.connect(**async_engine.asyncpg_connect_kwargs(config["connection_string"]))
+
+    async def send(connection, batch):
+        rows = _rows_with_id(async_engine.rows(batch))
+        async with connection.transaction():
+            for table_index, table_name in enumerate(table_names):
+                values = rows[table_index::len(table_names)]
+                if use_values_lists:
+                    placeholders = ", ".join([f"${index+1}" for index in range(len(columns))])
+                    await connection.executemany(f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})", values)
+                else:
+                    await connection.copy_records_to_table(table_name, records=values, columns=columns)
+
+    async def close(connection):
+        await connection.close()
+
+    print("Inserting events", flush=True)
+    async_engine.run(batches, connect, send, close)
+    print("Finished inserting", flush=True)
+
+
 def _insert_events(events, batch_mode, batch_size, use_values_lists=False):
     print("Connecting to database", flush=True)
     use_multiple_tables = config["use_multiple_tables"]
@@ -123,63 +367,101 @@ def _values_lists_mode(events, use_multiple_tables, batch_size, table_names):
 
 def _values_lists_insert(db, cur, values_lists, table_names):
     # Implement retry due to TransactionAbortedError(ABORT_REASON_NEW_LEASE_PREVENTS_TXN) problems with CockroachDB
+    start = instrumentation.recorder.batch_start()
     done = False
-    for _ in range(5):
-        try:
-            for table_index, values in enumerate(values_lists):
-                if config["primary_key"] != "client":
-                    psycopg2.extras.execute_values(cur, f"INSERT INTO {table_names[table_index]} (timestamp, device_id, sequence_number, temperature) VALUES %s", values)
-                else:
-                    psycopg2.extras.execute_values(cur, f"INSERT INTO {table_names[table_index]} (id, timestamp, device_id, sequence_number, temperature) VALUES %s", values)
-            db.commit()
-            done = True
-            break
-        except:
-            print("Retrying insert due to problem")
+    with instrumentation.phase("send"):
+        for _ in range(5):
+            try:
+                for table_index, values in enumerate(values_lists):
+                    if config["primary_key"] != "client":
+                        psycopg2.extras.execute_values(cur, f"INSERT INTO {table_names[table_index]} (timestamp, device_id, sequence_number, temperature) VALUES %s", values)
+                    else:
+                        psycopg2.extras.execute_values(cur, f"INSERT INTO {table_names[table_index]} (id, timestamp, device_id, sequence_number, temperature) VALUES %s", values)
+                db.commit()
+                done = True
+                break
+            except:
+                print("Retrying insert due to problem")
+                instrumentation.recorder.error()
     if not done:
         raise Exception("Failed to insert data after 5 tries. Aborting")
+    instrumentation.recorder.record(start, sum(len(values) for values in values_lists))
     for values in values_lists:
         values.clear()
 
 
 def _copy_mode(events, use_multiple_tables, batch_size, table_names):
-    db = _db()
-    cur = db.cursor()
+    streams = _copy_streams(table_names)
+    if streams is None:
+        db = _db()
+        cur = db.cursor()
     count = 0
-    # the values_lists here is a StringIO containing the TSV to COPY
-    values_lists = [io.StringIO() for _ in range(4 if use_multiple_tables else 1)]
+    binary = binary_copy.enabled()
+    # the values_lists here is a StringIO containing the TSV to COPY, or a buffer with the binary COPY data
+    values_lists = [binary_copy.CopyBuffer() if binary else io.StringIO() for _ in range(4 if use_multiple_tables else 1)]
     for idx, event in enumerate(events):
-        if config["primary_key"] != "client": 
-            val = f'{event.timestamp}\t{event.device_id}\t{event.sequence_number}\t{event.temperature}\n' 
-        else:
-            event_id = f"{event.device_id}{event.timestamp}{event.sequence_number}"
-            val = f'{event_id}\t{event.timestamp}\t{event.device_id}\t{event.sequence_number}\t{event.temperature}\n' 
-        if use_multiple_tables:
-            values_lists[idx%4].writelines(val)
+        values = values_lists[idx%4] if use_multiple_tables else values_lists[0]
+        if binary:
+            if config["primary_key"] != "client":
+                values.add_row((event.timestamp, event.device_id, event.sequence_number, event.temperature))
+            else:
+                event_id = f"{event.device_id}{event.timestamp}{event.sequence_number}"
+                values.add_row((event_id, event.timestamp, event.device_id, event.sequence_number, event.temperature))
         else:
-            values_lists[0].writelines(val)
+            if config["primary_key"] != "client": 
+                val = f'{event.timestamp}\t{event.device_id}\t{event.sequence_number}\t{event.temperature}\n' 
+            else:
+                event_id = f"{event.device_id}{event.timestamp}{event.sequence_number}"
+                val = f'{event_id}\t{event.timestamp}\t{event.device_id}\t{event.sequence_number}\t{event.temperature}\n' 
+            values.writelines(val)
         count += 1
-        if count >= batch_size:
+        if count >= batch_size and streams is not None:
+            # The buffers go to a stream, the next batch needs new ones
+            streams.put(count, [_copy_buffer_file(values) for values in values_lists])
+            values_lists = [binary_copy.CopyBuffer() if binary else io.StringIO() for _ in values_lists]
+            count = 0
+        elif count >= batch_size:
+            with instrumentation.measure(count):
+                for table_index, values in enumerate(values_lists):
+                    if binary:
+                        _copy_from(cur, values.file(), table_names[table_index])
+                        values.reset()
+                        continue
+                    values.seek(0)
+                    if config["primary_key"] != "client": 
+                        cur.copy_from(values,table_names[table_index],sep="\t",columns=('timestamp', 'device_id', 'sequence_number', 'temperature'))
+                    else:
+                        cur.copy_from(values,table_names[table_index],sep="\t",columns=('id','timestamp', 'device_id', 'sequence_number', 'temperature'))
+                    values.seek(0)
+                    values.truncate(0)
+                db.commit()
+            count = 0
+    # Commit any remaining data
+    if count > 0 and streams is not None:
+        streams.put(count, [_copy_buffer_file(values) for values in values_lists])
+    elif count > 0:
+        with instrumentation.measure(count):
             for table_index, values in enumerate(values_lists):
+                if binary:
+                    _copy_from(cur, values.file(), table_names[table_index])
+                    continue
                 values.seek(0)
                 if config["primary_key"] != "client": 
-                    cur.copy_from(values,table_names[table_index],sep="\t",columns=('timestamp', 'device_id', 'sequence_number', 'temperature'))
+                    cur.copy_from(values,table_names[table_index],sep="\t",columns=('timestamp', 'device_id', 'sequence_number', 'temperature'))                   
                 else:
                     cur.copy_from(values,table_names[table_index],sep="\t",columns=('id','timestamp', 'device_id', 'sequence_number', 'temperature'))
-                values.seek(0)
-                values.truncate(0)
             db.commit()
-            count = 0
-    # Commit any remaining data
-    if count > 0:
-        for table_index, values in enumerate(values_lists):
-            values.seek(0)
-            if config["primary_key"] != "client": 
-                cur.copy_from(values,table_names[table_index],sep="\t",columns=('timestamp', 'device_id', 'sequence_number', 'temperature'))                   
-            else:
-                cur.copy_from(values,table_names[table_index],sep="\t",columns=('id','timestamp', 'device_id', 'sequence_number', 'temperature'))
-        db.commit()
-    cur.close()
+    if streams is not None:
+        streams.close()
+    else:
+        cur.close()
+
+
+def _copy_buffer_file(values):
+    if isinstance(values, binary_copy.CopyBuffer):
+        return values.file()
+    values.seek(0)
+    return values
 
 
 def _single_insert_mode(events, use_multiple_tables, batch_size, batch_mode):
@@ -192,13 +474,14 @@ def _single_insert_mode(events, use_multiple_tables, batch_size, batch_mode):
         else:
             table_name = "events"
 
-        if config["primary_key"] != "client":
-            cur.execute(f"INSERT INTO {table_name} (timestamp, device_id, sequence_number, temperature) VALUES (%s, %s, %s, %s)",
-                    (event.timestamp, event.device_id, event.sequence_number, event.temperature))
-        else:
-            event_id = f"{event.device_id}{event.timestamp}{event.sequence_number}"
-            cur.execute(f"INSERT INTO {table_name} (id, timestamp, device_id, sequence_number, temperature) VALUES (%s, %s, %s, %s, %s)",
-                    (event_id, event.timestamp, event.device_id, event.sequence_number, event.temperature))
+        with instrumentation.measure():
+            if config["primary_key"] != "client":
+                cur.execute(f"INSERT INTO {table_name} (timestamp, device_id, sequence_number, temperature) VALUES (%s, %s, %s, %s)",
+                        (event.timestamp, event.device_id, event.sequence_number, event.temperature))
+            else:
+                event_id = f"{event.device_id}{event.timestamp}{event.sequence_number}"
+                cur.execute(f"INSERT INTO {table_name} (id, timestamp, device_id, sequence_number, temperature) VALUES (%s, %s, %s, %s, %s)",
+                        (event_id, event.timestamp, event.device_id, event.sequence_number, event.temperature))
         count += 1
         if batch_mode and count >= batch_size:
             db.commit()
@@ -208,11 +491,115 @@ def _single_insert_mode(events, use_multiple_tables, batch_size, batch_mode):
     cur.close()
 
 
+def _pipeline_engine():
+    if config.get("engine", "sync") != "pipeline":
+        return False
+    if config.get("batch_mode", False):
+        raise Exception("engine=pipeline sends every event as its own insert and can not be combined with batch mode")
+    return True
+
+
+# Type oids of the parameters of the prepared insert (varchar id, bigint timestamp, varchar device_id, bigint sequence_number,
+# real temperature) and whether they are sent in binary (1) or text (0) format
+_PIPELINE_TYPES = dict(id=(1043, 0), timestamp=(20, 1), device_id=(1043, 0), sequence_number=(20, 1), temperature=(700, 1))
+
+
+def _pipeline_insert_mode(events):
+    """Single-row inserts on one connection in libpq pipeline mode, using the low-level libpq wrapper of psycopg 3. The insert
+    is prepared on the server once per table, every event is sent as its own statement followed by a sync point so it commits on
+    its own, and up to pipeline_depth events are in flight before the worker waits for the oldest one"""
+    from psycopg import pq
+    depth = int(config.get("pipeline_depth", 100))
+    print("Connecting to database", flush=True)
+    if config["use_multiple_tables"]:
+        table_names = ["events0", "events1", "events2", "events3"]
+    else:
+        table_names = ["events"]
+    if config["primary_key"] != "client":
+        columns = ['timestamp', 'device_id', 'sequence_number', 'temperature']
+    else:
+        columns = ['id', 'timestamp', 'device_id', 'sequence_number', 'temperature']
+    param_types = [_PIPELINE_TYPES[column][0] for column in columns]
+    param_formats = [_PIPELINE_TYPES[column][1] for column in columns]
+    conn = pq.PGconn.connect(config["connection_string"].encode("utf-8"))
+    if conn.status != pq.ConnStatus.OK:
+        raise Exception(f"Failed to connect to the database: {conn.error_message.decode('utf-8', 'replace')}")
+    conn.enter_pipeline_mode()
+    placeholders = ", ".join([f"${index+1}" for index in range(len(columns))])
+    for table_name in table_names:
+        conn.send_prepare(table_name.encode("utf-8"), f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})".encode("utf-8"), param_types)
+    conn.pipeline_sync()
+    _pipeline_result(conn)
+
+    print("Inserting events", flush=True)
+    statements = [table_name.encode("utf-8") for table_name in table_names]
+    pending = collections.deque()
+    for idx, event in enumerate(events):
+        params = [struct.pack(">q", event.timestamp), event.device_id.encode("utf-8"), struct.pack(">q", event.sequence_number), struct.pack(">f", event.temperature)]
+        if config["primary_key"] == "client":
+            params.insert(0, f"{event.device_id}{event.timestamp}{event.sequence_number}".encode("utf-8"))
+        start = instrumentation.recorder.batch_start()
+        with instrumentation.phase("send"):
+            conn.send_query_prepared(statements[idx % len(statements)], params, param_formats)
+            conn.pipeline_sync()
+            pending.append(start)
+            if len(pending) >= depth:
+                _pipeline_result(conn)
+                instrumentation.recorder.record(pending.popleft())
+    with instrumentation.phase("send"):
+        while pending:
+            _pipeline_result(conn)
+            instrumentation.recorder.record(pending.popleft())
+    conn.exit_pipeline_mode()
+    conn.finish()
+    print("Finished inserting", flush=True)
+
+
+def _pipeline_result(conn):
+    """Waits for the results of the oldest sync point in the pipeline, i.e. until its statements are committed"""
+    from psycopg import pq
+    conn.flush()
+    error = None
+    while True:
+        result = conn.get_result()
+        if result is None:
+            # End of the results of one statement
+            continue
+        if result.status == pq.ExecStatus.PIPELINE_SYNC:
+            break
+        if result.status == pq.ExecStatus.FATAL_ERROR and error is None:
+            error = result.error_message.decode("utf-8", "replace")
+    if error:
+        instrumentation.recorder.error()
+        raise Exception(f"Insert in pipeline failed: {error}")
+
+
 _indices = [
     "CREATE INDEX IF NOT EXISTS events_device_ts ON events (device_id ASC, timestamp ASC, temperature ASC)",
     "CREATE INDEX IF NOT EXISTS events_temp ON events (temperature ASC)",
 ]
 
+# Indices that can be created before the inserts with ingest_indices to measure what they cost during ingest
+_ingest_indices = {
+    "device_ts": "CREATE INDEX IF NOT EXISTS {table}_device_ts ON {table} (device_id, timestamp)",
+    "temperature": "CREATE INDEX IF NOT EXISTS {table}_temperature ON {table} (temperature)",
+    "timestamp": "CREATE INDEX IF NOT EXISTS {table}_timestamp ON {table} (timestamp)",
+    "timestamp_brin": "CREATE INDEX IF NOT EXISTS {table}_timestamp_brin ON {table} USING brin (timestamp)",
+    "device_ts_covering": "CREATE INDEX IF NOT EXISTS {table}_device_ts_covering ON {table} (device_id, timestamp) INCLUDE (temperature)",
+}
+
+
+def _create_ingest_indices(db, cur, table_names):
+    names = [name for name in config.get("ingest_indices", "none").split(",") if name != "none"]
+    for name in names:
+        if name not in _ingest_indices:
+            raise Exception(f"Unknown ingest index {name}, use one of {', '.join(_ingest_indices.keys())}")
+        for table_name in table_names:
+            print(f"Creating ingest index {name} on {table_name}", flush=True)
+            cur.execute(_ingest_indices[name].format(table=table_name))
+    db.commit()
+
+
 _queries = {
     "count-events": "SELECT count(*) FROM events",
     "temperature-min-max": "SELECT max(temperature), min(temperature) FROM events",
@@ -221,9 +608,30 @@ _queries = {
     "newest-per-device": "SELECT device_id, temperature from (SELECT device_id, temperature, timestamp=max(timestamp) over (partition by device_id) newest FROM events) e where newest",
 }
 
-def queries():
-    db = _db()
-    cur = db.cursor()
+_query_variants = {
+    "temperature-stats": {
+        # Yugabyte does not push down avg to the nodes for partial aggregation, sum and count are pushed down
+        "sum-count": "SELECT max(temperature), sum(temperature)/count(temperature)::numeric avg, min(temperature) FROM events",
+    },
+    "temperature-stats-per-device": {
+        "sum-count": "SELECT device_id, max(temperature), sum(temperature)/count(temperature)::numeric avg, min(temperature) FROM events GROUP BY device_id",
+    },
+    "newest-per-device": {
+        "distinct-on": "SELECT DISTINCT ON (device_id) device_id, temperature FROM events ORDER BY device_id, timestamp DESC",
+        # Loose index scan (https://wiki.postgresql.org/wiki/Loose_indexscan), see issue #7
+        "loose-index-scan": """
+            WITH RECURSIVE devices AS (
+                (SELECT device_id FROM events ORDER BY device_id LIMIT 1)
+                UNION ALL
+                SELECT (SELECT device_id FROM events WHERE device_id > d.device_id ORDER BY device_id LIMIT 1) FROM devices d WHERE d.device_id IS NOT NULL
+            )
+            SELECT d.device_id, e.temperature FROM devices d, LATERAL (SELECT temperature FROM events WHERE device_id = d.device_id ORDER BY timestamp DESC LIMIT 1) e
+            WHERE d.device_id IS NOT NULL
+        """,
+    },
+}
+
+def _create_indices(db, cur):
     if config.get("create_indices", "false").lower() == "true":
         print("Creating indices", flush=True)
         for index in _indices:
@@ -235,6 +643,12 @@ def queries():
                 cur = db.cursor()
                 cur.execute(index)
         db.commit()
+    return cur
+
+
+def queries(rounds=None):
+    db = _db()
+    cur = _create_indices(db, db.cursor())
 
     if "queries" in config:
         included = config["queries"].split(",")
@@ -242,15 +656,84 @@ def queries():
             if key not in included:
                 del _queries[key]
 
-    query_times = dict([(name, []) for name in _queries.keys()])
-    for i in range(int(config["runs"])):
-        for name, query in _queries.items():
-            print(f"Executing query {name}", flush=True)
-            start = time.time()
+    selected = query_variants.expand(_queries, _query_variants)
+    query_times = dict([(cache_control.result_name(name, mode), []) for name in selected.keys() for mode in cache_control.modes()])
+    if cache_control.warm_up():
+        for name, query in selected.items():
+            print(f"Warming up query {name}", flush=True)
             cur.execute(query)
-            list(cur.fetchall()) # Force client to actually fetch results
-            duration = time.time() - start
-            print(f"Finished query. Duration: {duration}", flush=True)
-            query_times[name].append(duration)
+            cur.fetchall()
+    if rounds is None:
+        rounds = range(int(config["runs"]))
+    for i in rounds:
+        for name, query in selected.items():
+            for mode in cache_control.modes():
+                if mode == "cold":
+                    db, cur = _cold_connection(db)
+                print(f"Executing query {name}", flush=True)
+                start = time.time()
+                cur.execute(query)
+                list(cur.fetchall()) # Force client to actually fetch results
+                duration = time.time() - start
+                print(f"Finished query. Duration: {duration}", flush=True)
+                query_times[cache_control.result_name(name, mode)].append(duration)
 
     return query_times
+
+
+def _cold_connection(db):
+    """Replaces the connection with a fresh one without any session state (cached plans, temporary tables, caches of the backend
+    process). Shared buffers and the page cache of the OS are only cleared by restarting the database"""
+    db.close()
+    db = _db()
+    # DISCARD ALL can not run inside a transaction block, which is opened implicitly with batch_mode
+    db.set_session(autocommit=True)
+    cur = db.cursor()
+    cur.execute("DISCARD ALL")
+    return db, cur
+
+
+def explain_queries():
+    """Returns a summary of the execution plan of every query, see query_plans"""
+    db = _db()
+    cur = db.cursor()
+    plans = dict()
+    for name, query in query_variants.expand(_queries, _query_variants).items():
+        print(f"Explaining query {name}", flush=True)
+        plans[name] = query_plans.explain_postgres(db, cur, query)
+    return plans
+
+_point_queries = {
+    "device-window": "SELECT timestamp, temperature FROM events WHERE device_id = %s AND timestamp >= %s AND timestamp < %s ORDER BY timestamp",
+    "latest-devices": "SELECT DISTINCT ON (device_id) device_id, timestamp, temperature FROM events WHERE device_id = ANY(%s) ORDER BY device_id, timestamp DESC",
+}
+
+
+def sample_events(count):
+    """Returns the device id and timestamp of up to count random stored events to draw the point query parameters from. This
+    reads the whole table once, but only before the timed part of the run"""
+    db = _db()
+    cur = db.cursor()
+    cur.execute("SELECT device_id, timestamp FROM events ORDER BY random() LIMIT %s", (count,))
+    samples = [tuple(row) for row in cur.fetchall()]
+    db.close()
+    return samples
+
+
+def point_queries(samples, wait_for_start):
+    """Runs the point and range queries from several clients, see point_workload"""
+    db = _db()
+    _create_indices(db, db.cursor())
+    db.close()
+
+    def query(kind):
+        def execute(connection, *parameters):
+            with connection.cursor() as cur:
+                cur.execute(_point_queries[kind], parameters)
+                cur.fetchall()
+        return execute
+
+    def close(connection):
+        connection.close()
+
+    return point_workload.run(samples, _db, dict((kind, query(kind)) for kind in _point_queries.keys()), close, wait_for_start)
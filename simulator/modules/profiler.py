@@ -0,0 +1,96 @@
+import os
+import signal
+import time
+from .config import config
+
+
+# Number of most frequent stacks kept in a profile, the function counts are always complete
+MAX_STACKS = 500
+
+
+def enabled():
+    return config.get("profile", "false").lower() == "true"
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Samples the stack of the main thread on a wall-clock timer signal (SIGALRM). Python runs signal handlers only in the
+    main thread, so other threads (COPY streams, the generator of the async engine) are not sampled. The handler only runs
+    between two bytecodes, so if a sample is delayed by a long call into C (e.g. waiting for the database) it is weighted
+    with the number of ticks that passed in the meantime and the time is attributed to the Python line that made the call.
+    System calls interrupted by the signal are retried by Python (PEP 475)
+    """
+
+    def __init__(self, interval=None):
+        self.interval = float(interval or config.get("profile_interval", 0.01))
+        self.samples = 0
+        self.stacks = dict()
+        self._previous_handler = None
+
+    def start(self):
+        self._last = time.perf_counter()
+        self._previous_handler = signal.signal(signal.SIGALRM, self._sample)
+        signal.setitimer(signal.ITIMER_REAL, self.interval, self.interval)
+        return self
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self._previous_handler)
+        return self.to_dict()
+
+    def _sample(self, signum, frame):
+        now = time.perf_counter()
+        ticks = max(1, round((now - self._last) / self.interval))
+        self._last = now
+        stack = list()
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + ticks
+        self.samples += ticks
+
+    def to_dict(self):
+        return dict(interval=self.interval, samples=self.samples, functions=_function_counts(self.stacks),
+                    stacks=sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)[:MAX_STACKS])
+
+
+def _function_counts(stacks):
+    """Returns [name, self samples, total samples] for every function, self counts the samples in which it was the innermost frame"""
+    counts = dict()
+    for stack, count in stacks.items():
+        names = stack.split(";")
+        for name in set(names):
+            counts.setdefault(name, [0, 0])[1] += count
+        counts[names[-1]][0] += count
+    return sorted([[name, own, total] for name, (own, total) in counts.items()], key=lambda item: item[1], reverse=True)
+
+
+def merge(profiles):
+    """Combines several profiles (of the processes of a worker or of all workers) into one"""
+    samples = 0
+    functions = dict()
+    stacks = dict()
+    for profile in profiles:
+        samples += profile["samples"]
+        for name, own, total in profile["functions"]:
+            counts = functions.setdefault(name, [0, 0])
+            counts[0] += own
+            counts[1] += total
+        for stack, count in profile["stacks"]:
+            stacks[stack] = stacks.get(stack, 0) + count
+    return dict(interval=profiles[0]["interval"] if profiles else None, samples=samples,
+                functions=sorted([[name, own, total] for name, (own, total) in functions.items()], key=lambda item: item[1], reverse=True),
+                stacks=sorted(stacks.items(), key=lambda item: item[1], reverse=True)[:MAX_STACKS])
+
+
+def merge_phases(phases_list):
+    phases = dict()
+    for entry in phases_list:
+        for name, seconds in entry.items():
+            phases[name] = phases.get(name, 0) + seconds
+    return phases
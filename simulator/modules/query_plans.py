@@ -0,0 +1,87 @@
+# Capture of the execution plans of the queries. With explain=true every query is run once more after the timed rounds with
+# the plan/profiling facility of the database and a summary of the plan is added to the query report, so a slow query can be
+# traced to the scan, sort or aggregation it spends its time in
+import json
+from .config import config
+
+
+def enabled():
+    return config.get("explain", "false").lower() == "true"
+
+
+def _summary(time_ms, buffer_hits, buffer_reads, rows_scanned, slowest, plan):
+    return dict(time_ms=time_ms, buffer_hits=buffer_hits, buffer_reads=buffer_reads, rows_scanned=rows_scanned, slowest=slowest, plan=plan)
+
+
+def explain_postgres(db, cur, query):
+    """Runs the query with EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON). Databases that do not support the options (e.g. CockroachDB)
+    get a plain EXPLAIN ANALYZE whose text is kept as the plan"""
+    try:
+        cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}")
+        plan = cur.fetchone()[0]
+    except Exception as e:
+        print(f"EXPLAIN with JSON format failed, falling back to text: {e}", flush=True)
+        if not db.autocommit:
+            db.rollback()
+        cur = db.cursor()
+        cur.execute(f"EXPLAIN ANALYZE {query}")
+        return _summary(None, None, None, None, None, "\n".join(str(row[0]) for row in cur.fetchall()))
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    plan = plan[0]
+    root = plan["Plan"]
+    nodes = list(_postgres_nodes(root))
+    rows_scanned = sum(node.get("Actual Rows", 0) * node.get("Actual Loops", 1) for node in nodes if node["Node Type"].endswith("Scan"))
+    slowest = max(nodes, key=_postgres_exclusive_time)
+    return _summary(plan.get("Execution Time"), root.get("Shared Hit Blocks"), root.get("Shared Read Blocks"), rows_scanned,
+                    f"{slowest['Node Type']} ({_postgres_exclusive_time(slowest):.1f} ms)", plan)
+
+
+def _postgres_nodes(node):
+    yield node
+    for child in node.get("Plans", []):
+        yield from _postgres_nodes(child)
+
+
+def _postgres_exclusive_time(node):
+    """Time spent in the node itself without its children, in ms over all loops"""
+    total = node.get("Actual Total Time", 0) * node.get("Actual Loops", 1)
+    children = sum(child.get("Actual Total Time", 0) * child.get("Actual Loops", 1) for child in node.get("Plans", []))
+    return max(total - children, 0)
+
+
+def explain_elasticsearch(client, query):
+    """Runs the search with the profile API. The number of matched documents is reported as the rows scanned, Elasticsearch
+    reports no buffer statistics"""
+    body = dict(query or dict(track_total_hits=True), profile=True)
+    result = client.search(index="events", body=body, size=0, request_timeout=600)
+    components = []
+    for shard in result["profile"]["shards"]:
+        for search in shard["searches"]:
+            components.extend(search["query"])
+            components.extend(search["collector"])
+        components.extend(shard.get("aggregations", []))
+    slowest = max(components, key=lambda component: component["time_in_nanos"], default=None)
+    return _summary(result["took"], None, None, result["hits"]["total"]["value"],
+                    f"{slowest.get('type', slowest.get('name'))} ({slowest['time_in_nanos']/1000000:.1f} ms)" if slowest else None,
+                    result["profile"])
+
+
+# Enables the Flux profilers, their results are returned as additional tables
+FLUX_PROFILER = 'import "profiler"\noption profiler.enabledProfilers = ["query", "operator"]\n'
+
+
+def explain_influxdb(query_api, query):
+    """Runs the Flux query with the query and operator profilers"""
+    tables = query_api.query(query=FLUX_PROFILER + query)
+    profiles = dict(query=[], operator=[])
+    for table in tables:
+        for record in table.records:
+            measurement = record.values.get("_measurement", "")
+            if measurement.startswith("profiler/"):
+                profiles[measurement[len("profiler/"):]].append(dict((key, value if isinstance(value, (int, float, str)) else str(value))
+                                                                    for key, value in record.values.items() if key not in ["result", "table"]))
+    query_profile = profiles["query"][0] if profiles["query"] else dict()
+    slowest = max(profiles["operator"], key=lambda operator: operator.get("DurationSum", 0), default=None)
+    return _summary(query_profile["TotalDuration"]/1000000 if "TotalDuration" in query_profile else None, None, None, None,
+                    f"{slowest['Type']} ({slowest['DurationSum']/1000000:.1f} ms)" if slowest else None, profiles)
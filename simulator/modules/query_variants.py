@@ -0,0 +1,29 @@
+# Alternative formulations of the queries. Every module can define variants of its logical queries (e.g. a loose index scan
+# instead of a window function), with query_variants=true they are run and timed next to the canonical form as "<query>@<variant>"
+from .config import config
+from . import cache_control
+
+
+SEPARATOR = "@"
+
+
+def enabled():
+    return config.get("query_variants", "false").lower() == "true"
+
+
+def expand(queries, variants):
+    """Returns the queries to run: the canonical queries followed by their variants if enabled"""
+    selected = dict(queries)
+    if enabled():
+        for name, query_variants in variants.items():
+            if name not in queries:
+                continue
+            for variant, query in query_variants.items():
+                selected[f"{name}{SEPARATOR}{variant}"] = query
+    return selected
+
+
+def logical_name(name):
+    """The name of the logical query a query or variant name belongs to, the cache mode of the name is kept"""
+    query, separator, cache_mode = name.partition(cache_control.SEPARATOR)
+    return query.split(SEPARATOR, 1)[0] + separator + cache_mode
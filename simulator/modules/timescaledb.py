@@ -1,11 +1,15 @@
+from importlib import metadata as importlib_metadata
 import io
 import time
 import psycopg2
 import psycopg2.extras
 from .config import config
+from . import async_engine, binary_copy, cache_control, event_generator, instrumentation, null_sink, point_workload, query_plans, query_variants
 
 
 def _db():
+    if null_sink.enabled():
+        return null_sink.NullPostgresConnection()
     connection_string = config["connection_string"]
     con = psycopg2.connect(connection_string)
     if not config.get("batch_mode", False):
@@ -40,9 +44,26 @@ def init():
         cur.execute(f"SELECT create_hypertable('{table_name}', 'timestamp', chunk_time_interval => 86400000, if_not_exists => TRUE)")
     db.commit()
     print("Created table events")
+    _create_ingest_indices(db, cur, table_names)
     cur.close()
 
 
+def version():
+    """Returns the version of the database and of the client library"""
+    driver = f"psycopg2-binary {importlib_metadata.version('psycopg2-binary')}"
+    if null_sink.enabled():
+        return dict(database="null sink", driver=driver)
+    db = _db()
+    cur = db.cursor()
+    cur.execute("SELECT version()")
+    postgres_version = cur.fetchone()[0]
+    cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'timescaledb'")
+    row = cur.fetchone()
+    database = f"TimescaleDB {row[0] if row else 'not installed'} on {postgres_version}"
+    db.close()
+    return dict(database=database, driver=driver)
+
+
 def prefill_events(events):
     _insert_events(events, True, 1000)
 
@@ -50,10 +71,114 @@ def prefill_events(events):
 def insert_events(events):
     batch_mode = config.get("batch_mode", False)
     batch_size = config.get("batch_size", 100)
+    if async_engine.enabled():
+        _async_insert(async_engine.batched(events, batch_size if batch_mode else 1))
+        return
     use_values_lists = config.get("use_values_lists", "false").lower() == "true"
     _insert_events(events, batch_mode, batch_size, use_values_lists)
 
 
+def insert_batches(batches):
+    if async_engine.enabled():
+        _async_insert(batches)
+        return
+    batch_mode = config.get("batch_mode", False)
+    if not batch_mode:
+        insert_events(event for batch in batches for event in batch.events())
+        return
+    use_values_lists = config.get("use_values_lists", "false").lower() == "true"
+    print("Connecting to database", flush=True)
+    if config["use_multiple_tables"]:
+        table_names = ["events0", "events1", "events2", "events3"]
+    else:
+        table_names = ["events"]
+
+    print("Inserting events", flush=True)
+    db = _db()
+    cur = db.cursor()
+    buffers = [binary_copy.CopyBuffer() for _ in table_names] if binary_copy.enabled() and not use_values_lists else None
+    for batch in batches:
+        with instrumentation.phase("serialize"):
+            if buffers:
+                files = _binary_copy_files(batch, buffers)
+            elif use_values_lists:
+                rows = batch.rows()
+                values_lists = [rows[table_index::len(table_names)] for table_index in range(len(table_names))]
+            else:
+                files = _text_copy_files(batch, len(table_names))
+        if use_values_lists:
+            _values_lists_insert(db, cur, values_lists, table_names)
+        else:
+            with instrumentation.measure(len(batch)):
+                for table_index, values in enumerate(files):
+                    _copy_from(cur, values, table_names[table_index])
+                db.commit()
+    cur.close()
+    print("Finished inserting", flush=True)
+
+
+def _copy_file(rows):
+    return io.StringIO("".join(["\t".join(map(str, row)) + "\n" for row in rows]))
+
+
+def _text_copy_files(batch, number_of_tables):
+    """Formats the text COPY data of every table directly from the columns, the rows are distributed over the tables like in
+    _copy_file"""
+    files = list()
+    for table_index in range(number_of_tables):
+        timestamp, device_id, sequence_number, temperature = batch.text_columns(slice(table_index, None, number_of_tables))
+        files.append(io.StringIO("".join(event_generator.concat(timestamp, "\t", device_id, "\t", sequence_number, "\t", temperature, "\n").tolist())))
+    return files
+
+
+def _binary_copy_files(batch, buffers):
+    """Encodes the batch into the binary COPY buffer of every table, the rows are distributed over the tables like in the text format"""
+    for table_index, buffer in enumerate(buffers):
+        buffer.reset()
+        selection = slice(table_index, None, len(buffers))
+        buffer.add_columns(batch.timestamp[selection], batch.device_index[selection], batch.devices, batch.sequence_number[selection], batch.temperature[selection])
+    return [buffer.file() for buffer in buffers]
+
+
+def _copy_from(cur, values, table_name):
+    columns = ('timestamp', 'device_id', 'sequence_number', 'temperature')
+    if binary_copy.enabled():
+        cur.copy_expert(binary_copy.copy_statement(table_name, columns), values)
+    else:
+        cur.copy_from(values,table_name,sep="\t",columns=columns)
+
+
+def _async_insert(batches):
+    import asyncpg
+    use_values_lists = config.get("use_values_lists", "false").lower() == "true"
+    if config["use_multiple_tables"]:
+        table_names = ["events0", "events1", "events2", "events3"]
+    else:
+        table_names = ["events"]
+    columns = ['timestamp', 'device_id', 'sequence_number', 'temperature']
+
+    async def connect():
+        return await asyncpg.connect(**async_engine.asyncpg_connect_kwargs(config["connection_string"]))
+
+    async def send(connection, batch):
+        rows = async_engine.rows(batch)
+        async with connection.transaction():
+            for table_index, table_name in enumerate(table_names):
+                values = rows[table_index::len(table_names)]
+                if use_values_lists:
+                    placeholders = ", ".join([f"${index+1}" for index in range(len(columns))])
+                    await connection.executemany(f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})", values)
+                else:
+                    await connection.copy_records_to_table(table_name, records=values, columns=columns)
+
+    async def close(connection):
+        await connection.close()
+
+    print("Inserting events", flush=True)
+    async_engine.run(batches, connect, send, close)
+    print("Finished inserting", flush=True)
+
+
 def _insert_events(events, batch_mode, batch_size, use_values_lists=False):
     print("Connecting to database", flush=True)
     use_multiple_tables = config["use_multiple_tables"]
@@ -96,18 +221,22 @@ def _values_lists_mode(events, use_multiple_tables, batch_size, table_names):
 
 def _values_lists_insert(db, cur, values_lists, table_names):
     # Implement retry due to TransactionAbortedError(ABORT_REASON_NEW_LEASE_PREVENTS_TXN) problems with CockroachDB
+    start = instrumentation.recorder.batch_start()
     done = False
-    for _ in range(5):
-        try:
-            for table_index, values in enumerate(values_lists):
-                psycopg2.extras.execute_values(cur, f"INSERT INTO {table_names[table_index]} (timestamp, device_id, sequence_number, temperature) VALUES %s", values)
-            db.commit()
-            done = True
-            break
-        except:
-            print("Retrying insert due to problem")
+    with instrumentation.phase("send"):
+        for _ in range(5):
+            try:
+                for table_index, values in enumerate(values_lists):
+                    psycopg2.extras.execute_values(cur, f"INSERT INTO {table_names[table_index]} (timestamp, device_id, sequence_number, temperature) VALUES %s", values)
+                db.commit()
+                done = True
+                break
+            except:
+                print("Retrying insert due to problem")
+                instrumentation.recorder.error()
     if not done:
         raise Exception("Failed to insert data after 5 tries. Aborting")
+    instrumentation.recorder.record(start, sum(len(values) for values in values_lists))
     for values in values_lists:
         values.clear()
 
@@ -116,29 +245,39 @@ def _copy_mode(events, use_multiple_tables, batch_size, table_names):
     db = _db()
     cur = db.cursor()
     count = 0
-    # the values_lists here is a StringIO containing the TSV to COPY
-    values_lists = [io.StringIO() for _ in range(4 if use_multiple_tables else 1)]
+    binary = binary_copy.enabled()
+    # the values_lists here is a StringIO containing the TSV to COPY, or a buffer with the binary COPY data
+    values_lists = [binary_copy.CopyBuffer() if binary else io.StringIO() for _ in range(4 if use_multiple_tables else 1)]
     for idx, event in enumerate(events):
-        val = f'{event.timestamp}\t{event.device_id}\t{event.sequence_number}\t{event.temperature}\n' 
-        if use_multiple_tables:
-            values_lists[idx%4].writelines(val)
+        values = values_lists[idx%4] if use_multiple_tables else values_lists[0]
+        if binary:
+            values.add_row((event.timestamp, event.device_id, event.sequence_number, event.temperature))
         else:
-            values_lists[0].writelines(val)
+            values.writelines(f'{event.timestamp}\t{event.device_id}\t{event.sequence_number}\t{event.temperature}\n')
         count += 1
         if count >= batch_size:
+            with instrumentation.measure(count):
+                for table_index, values in enumerate(values_lists):
+                    if binary:
+                        _copy_from(cur, values.file(), table_names[table_index])
+                        values.reset()
+                        continue
+                    values.seek(0)
+                    cur.copy_from(values,table_names[table_index],sep="\t",columns=('timestamp', 'device_id', 'sequence_number', 'temperature'))
+                    values.seek(0)
+                    values.truncate(0)
+                db.commit()
+            count = 0
+    # Commit any remaining data
+    if count > 0:
+        with instrumentation.measure(count):
             for table_index, values in enumerate(values_lists):
+                if binary:
+                    _copy_from(cur, values.file(), table_names[table_index])
+                    continue
                 values.seek(0)
                 cur.copy_from(values,table_names[table_index],sep="\t",columns=('timestamp', 'device_id', 'sequence_number', 'temperature'))
-                values.seek(0)
-                values.truncate(0)
             db.commit()
-            count = 0
-    # Commit any remaining data
-    if count > 0:
-        for table_index, values in enumerate(values_lists):
-            values.seek(0)
-            cur.copy_from(values,table_names[table_index],sep="\t",columns=('timestamp', 'device_id', 'sequence_number', 'temperature'))
-        db.commit()
     cur.close()
 
 
@@ -152,8 +291,9 @@ def _single_insert_mode(events, use_multiple_tables, batch_size, batch_mode):
         else:
             table_name = "events"
 
-        cur.execute(f"INSERT INTO {table_name} (timestamp, device_id, sequence_number, temperature) VALUES (%s, %s, %s, %s)",
-                (event.timestamp, event.device_id, event.sequence_number, event.temperature))
+        with instrumentation.measure():
+            cur.execute(f"INSERT INTO {table_name} (timestamp, device_id, sequence_number, temperature) VALUES (%s, %s, %s, %s)",
+                    (event.timestamp, event.device_id, event.sequence_number, event.temperature))
         count += 1
         if batch_mode and count >= batch_size:
             db.commit()
@@ -168,6 +308,27 @@ _indices = [
     "CREATE INDEX IF NOT EXISTS events_temp ON events (temperature ASC)",
 ]
 
+# Indices that can be created before the inserts with ingest_indices to measure what they cost during ingest
+_ingest_indices = {
+    "device_ts": "CREATE INDEX IF NOT EXISTS {table}_device_ts ON {table} (device_id, timestamp)",
+    "temperature": "CREATE INDEX IF NOT EXISTS {table}_temperature ON {table} (temperature)",
+    "timestamp": "CREATE INDEX IF NOT EXISTS {table}_timestamp ON {table} (timestamp)",
+    "timestamp_brin": "CREATE INDEX IF NOT EXISTS {table}_timestamp_brin ON {table} USING brin (timestamp)",
+    "device_ts_covering": "CREATE INDEX IF NOT EXISTS {table}_device_ts_covering ON {table} (device_id, timestamp) INCLUDE (temperature)",
+}
+
+
+def _create_ingest_indices(db, cur, table_names):
+    names = [name for name in config.get("ingest_indices", "none").split(",") if name != "none"]
+    for name in names:
+        if name not in _ingest_indices:
+            raise Exception(f"Unknown ingest index {name}, use one of {', '.join(_ingest_indices.keys())}")
+        for table_name in table_names:
+            print(f"Creating ingest index {name} on {table_name}", flush=True)
+            cur.execute(_ingest_indices[name].format(table=table_name))
+    db.commit()
+
+
 _queries = {
     "count-events": "SELECT count(*) FROM events",
     "temperature-min-max": "SELECT max(temperature), min(temperature) FROM events",
@@ -176,29 +337,110 @@ _queries = {
     "newest-per-device": "SELECT e.device_id, e.temperature FROM events e JOIN (SELECT device_id, max(timestamp) as ts FROM events GROUP BY device_id) newest ON e.device_id=newest.device_id AND e.timestamp = newest.ts",
 }
 
-def queries():
-    db = _db()
-    cur = db.cursor()
+_query_variants = {
+    "newest-per-device": {
+        # Can use the SkipScan of TimescaleDB on the events_device_ts index
+        "distinct-on": "SELECT DISTINCT ON (device_id) device_id, temperature FROM events ORDER BY device_id, timestamp DESC",
+        "last": "SELECT device_id, last(temperature, timestamp) FROM events GROUP BY device_id",
+    },
+}
+
+def _create_indices(db, cur):
     if config.get("create_indices", "false").lower() == "true":
         for index in _indices:
             cur.execute(index)
         db.commit()
 
+
+def queries(rounds=None):
+    db = _db()
+    cur = db.cursor()
+    _create_indices(db, cur)
+
     if "queries" in config:
         included = config["queries"].split(",")
         for key in list(_queries.keys()):
             if key not in included:
                 del _queries[key]
 
-    query_times = dict([(name, []) for name in _queries.keys()])
-    for i in range(int(config["runs"])):
-        for name, query in _queries.items():
-            print(f"Executing query {name}", flush=True)
-            start = time.time()
+    selected = query_variants.expand(_queries, _query_variants)
+    query_times = dict([(cache_control.result_name(name, mode), []) for name in selected.keys() for mode in cache_control.modes()])
+    if cache_control.warm_up():
+        for name, query in selected.items():
+            print(f"Warming up query {name}", flush=True)
             cur.execute(query)
-            list(cur.fetchall()) # Force client to actually fetch results
-            duration = time.time() - start
-            print("Finished query", flush=True)
-            query_times[name].append(duration)
+            cur.fetchall()
+    if rounds is None:
+        rounds = range(int(config["runs"]))
+    for i in rounds:
+        for name, query in selected.items():
+            for mode in cache_control.modes():
+                if mode == "cold":
+                    db, cur = _cold_connection(db)
+                print(f"Executing query {name}", flush=True)
+                start = time.time()
+                cur.execute(query)
+                list(cur.fetchall()) # Force client to actually fetch results
+                duration = time.time() - start
+                print("Finished query", flush=True)
+                query_times[cache_control.result_name(name, mode)].append(duration)
 
     return query_times
+
+
+def _cold_connection(db):
+    """Replaces the connection with a fresh one without any session state (cached plans, temporary tables, caches of the backend
+    process). Shared buffers and the page cache of the OS are only cleared by restarting the database"""
+    db.close()
+    db = _db()
+    # DISCARD ALL can not run inside a transaction block, which is opened implicitly with batch_mode
+    db.set_session(autocommit=True)
+    cur = db.cursor()
+    cur.execute("DISCARD ALL")
+    return db, cur
+
+
+def explain_queries():
+    """Returns a summary of the execution plan of every query, see query_plans"""
+    db = _db()
+    cur = db.cursor()
+    plans = dict()
+    for name, query in query_variants.expand(_queries, _query_variants).items():
+        print(f"Explaining query {name}", flush=True)
+        plans[name] = query_plans.explain_postgres(db, cur, query)
+    return plans
+
+_point_queries = {
+    "device-window": "SELECT timestamp, temperature FROM events WHERE device_id = %s AND timestamp >= %s AND timestamp < %s ORDER BY timestamp",
+    "latest-devices": "SELECT DISTINCT ON (device_id) device_id, timestamp, temperature FROM events WHERE device_id = ANY(%s) ORDER BY device_id, timestamp DESC",
+}
+
+
+def sample_events(count):
+    """Returns the device id and timestamp of up to count random stored events to draw the point query parameters from. This
+    reads the whole table once, but only before the timed part of the run"""
+    db = _db()
+    cur = db.cursor()
+    cur.execute("SELECT device_id, timestamp FROM events ORDER BY random() LIMIT %s", (count,))
+    samples = [tuple(row) for row in cur.fetchall()]
+    db.close()
+    return samples
+
+
+def point_queries(samples, wait_for_start):
+    """Runs the point and range queries from several clients, see point_workload"""
+    db = _db()
+    _create_indices(db, db.cursor())
+    db.close()
+
+    def query(kind):
+        def execute(connection, *parameters):
+            with connection.cursor() as cur:
+                cur.execute(_point_queries[kind], parameters)
+                cur.fetchall()
+        return execute
+
+    def close(connection):
+        connection.close()
+
+    return point_workload.run(samples, _db, dict((kind, query(kind)) for kind in _point_queries.keys()), close, wait_for_start)
@@ -1,9 +1,18 @@
+import multiprocessing
 import os
+import threading
 import time
 import requests
 from modules import select_module
+from modules import instrumentation, null_sink, point_workload, profiler, query_plans
 from modules.config import config
-from modules.event_generator import generate_events
+from modules.event_generator import generate_events, generate_event_batches
+from modules.dataset import dataset_exists, dataset_parameters, dataset_path, dataset_size, read_dataset, write_dataset
+from modules.histogram import Histogram
+
+
+# Seconds the collector holds a long-poll request open before it answers that the workers are still not done
+LONG_POLL_WAIT = 30
 
 
 def worker_id():
@@ -27,20 +36,55 @@ def wait_for_collector_init():
         time.sleep(2)
 
 
+def register_worker():
+    """Registers the worker with the collector and returns a stable index for it (0..WORKER_COUNT-1)"""
+    return _register()["index"]
+
+
+def worker_role():
+    """Returns the role (insert or query) the collector assigned to this worker in the mixed task"""
+    return _register()["role"]
+
+
+def _register():
+    url = os.environ.get("COLLECTOR_URL", "http://localhost:5000")
+    response = requests.post(f"{url}/register", json=dict(worker=worker_id()))
+    response.raise_for_status()
+    return response.json()
+
+
+def wait_for_start(name):
+    """Waits at the start barrier of the collector until all insert processes (and query workers) are ready and returns the schedule
+    (the common start_time and with the duration option the end_time)"""
+    print("Waiting for start", flush=True)
+    url = os.environ.get("COLLECTOR_URL", "http://localhost:5000")
+    requests.post(f"{url}/start", json=dict(worker=name)).raise_for_status()
+    while True:
+        try:
+            # The collector answers as soon as the last process arrived at the barrier
+            response = requests.get(f"{url}/start", params=dict(wait=LONG_POLL_WAIT), timeout=LONG_POLL_WAIT+5)
+            if response.ok:
+                schedule = response.json()
+                break
+        except:
+            time.sleep(0.2)
+    delay = schedule["start_time"] - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    return schedule
+
+
 def wait_for_prefill_complete():
     print("Waiting for prefill completion", flush=True)
     url = os.environ.get("COLLECTOR_URL", "http://localhost:5000")
     while True:
         try:
-            response = requests.get(f"{url}/prefill", timeout=2)
+            response = requests.get(f"{url}/prefill", params=dict(wait=LONG_POLL_WAIT), timeout=LONG_POLL_WAIT+5)
             if response.ok:
                 print("Prefill complete. Starting work", flush=True)
                 return
-            else:
-                pass
         except:
-            pass
-        time.sleep(4)
+            time.sleep(4)
 
 
 def do_prefill(mod):
@@ -55,41 +99,309 @@ def do_prefill(mod):
     return num_events + 1
 
 
-def run_queries(module):
+def prepare_dataset(index, sequence_number=1, num_events=None, device_id=None):
+    path = dataset_path(config.get("dataset_dir", "/datasets"), config["dataset"], index)
+    if num_events is None:
+        num_events = int(config["num_inserts"])
+    requested = dict(device_id=device_id or worker_id(), events=num_events, sequence_number=sequence_number,
+                     device_spread=int(config.get("device_spread", "1")))
+    if dataset_exists(path):
+        existing = dataset_parameters(path)
+        if existing == requested:
+            print(f"Using existing dataset {path}", flush=True)
+            return path
+        # Replaying a dataset of another run would insert the wrong number of events or overlapping sequence numbers
+        print(f"Existing dataset {path} was generated with {existing} instead of {requested}, regenerating it", flush=True)
+    print(f"Preparing dataset {path}", flush=True)
+    write_dataset(path, requested["device_id"], num_events, sequence_number=sequence_number, device_spread=requested["device_spread"])
+    return path
+
+
+def process_name(process_index):
+    if int(config.get("processes_per_worker", 1)) == 1:
+        return worker_id()
+    return f"{worker_id()}-{process_index}"
+
+
+def process_shares(num_events, sequence_number=1):
+    """Splits the events of a worker between its processes, returns a list of (number of events, first sequence number) per process"""
+    processes = int(config.get("processes_per_worker", 1))
+    shares = list()
+    for process_index in range(processes):
+        process_events = num_events // processes + (1 if process_index < num_events % processes else 0)
+        shares.append((process_events, sequence_number))
+        sequence_number += process_events
+    return shares
+
+
+def run_prepare_dataset():
+    print("Running prepare-dataset task", flush=True)
+    start = time.time()
+    worker_index = register_worker()
+    shares = process_shares(int(config["num_inserts"]))
+    operations = 0
+    for process_index, (num_events, sequence_number) in enumerate(shares):
+        path = prepare_dataset(worker_index*len(shares) + process_index, sequence_number, num_events, process_name(process_index))
+        operations += dataset_size(path)
+    duration = time.time() - start
+    url = os.environ.get("COLLECTOR_URL", "http://localhost:5000")
+    data = dict(worker=worker_id(), operations=operations, duration=duration)
+    print(requests.post(f"{url}/result", json=data))
+
+
+def inserts_running():
+    url = os.environ.get("COLLECTOR_URL", "http://localhost:5000")
+    try:
+        return not requests.get(f"{url}/inserts", timeout=2).ok
+    except:
+        return True
+
+
+class QueryRounds:
+    """Yields query rounds while the inserts of the mixed task are running (until all insert workers have reported their results
+    or the deadline of the schedule has passed). complete is the number of rounds that ended while the inserts were still running,
+    a round overlapping the end of the inserts ran partly against an idle database and is not counted"""
+
+    def __init__(self, schedule):
+        self.end_time = schedule.get("end_time")
+        self.complete = 0
+
+    def _inserting(self):
+        if self.end_time is not None and time.time() >= self.end_time:
+            return False
+        return inserts_running()
+
+    def __iter__(self):
+        round = 0
+        while self._inserting():
+            self.complete = round
+            yield round
+            round += 1
+
+
+def run_queries(module, rounds=None):
     print("Running query task", flush=True)
-    results = module.queries()
+    monitor = instrumentation.ResourceMonitor().start()
+    sampler_profile = profiler.SamplingProfiler().start() if profiler.enabled() else None
+    results = module.queries(rounds)
+    if isinstance(rounds, QueryRounds):
+        results = dict((name, times[:rounds.complete]) for name, times in results.items())
+    profile = sampler_profile.stop() if sampler_profile else None
+    resources = monitor.stop()
+    # The plans are captured after the timed rounds so they do not influence the timings
+    plans = module.explain_queries() if query_plans.enabled() and hasattr(module, "explain_queries") else None
+    print("Transmitting results")
+    data = dict(worker=worker_id(), results=results, resources=resources)
+    if plans:
+        data["plans"] = plans
+    if profile:
+        data["profile"] = dict(sampling=profile)
+    url = os.environ.get("COLLECTOR_URL", "http://localhost:5000")
+    print(requests.post(f"{url}/result", json=data))
+
+
+def run_point_queries(module):
+    print("Running point query task", flush=True)
+    if not hasattr(module, "point_queries"):
+        raise Exception("The selected module does not support point queries")
+    monitor = instrumentation.ResourceMonitor().start()
+    samples = module.sample_events(point_workload.SAMPLE_SIZE)
+    data = module.point_queries(samples, lambda: wait_for_start(worker_id()))
+    data["resources"] = monitor.stop()
+    data["worker"] = worker_id()
     print("Transmitting results")
-    data = dict(worker=worker_id(), results=results)
     url = os.environ.get("COLLECTOR_URL", "http://localhost:5000")
     print(requests.post(f"{url}/result", json=data))
 
 
+def push_samples(stop, interval, name, include_network=True):
+    """Periodically sends the events inserted, network bytes and errors of the last interval to the collector until stop is set"""
+    url = os.environ.get("COLLECTOR_URL", "http://localhost:5000")
+    recorder = instrumentation.recorder
+    last_time, last_events, last_errors = time.time(), recorder.events, recorder.errors
+    last_sent, last_received = instrumentation.network_bytes()
+    while True:
+        stopped = stop.wait(interval)
+        now, events, errors = time.time(), recorder.events, recorder.errors
+        # The network counters are per pod, so with several processes per worker only one of them reports them
+        sent, received = instrumentation.network_bytes() if include_network else (last_sent, last_received)
+        sample = dict(worker=name, timestamp=now, interval=now-last_time, events=events-last_events, errors=errors-last_errors,
+                      bytes_sent=sent-last_sent, bytes_received=received-last_received)
+        try:
+            requests.post(f"{url}/samples", json=sample, timeout=2)
+        except:
+            print("Failed to send sample to collector", flush=True)
+        last_time, last_events, last_errors, last_sent, last_received = now, events, errors, sent, received
+        if stopped:
+            return
+
+
+def insert_process(module, process_index, num_events, sequence_number, dataset_index=None):
+    """Runs the timed insert of one process and returns its results"""
+    processes = int(config.get("processes_per_worker", 1))
+    name = process_name(process_index)
+    device_spread = int(config.get("device_spread", "1"))
+    columnar = config.get("columnar", "false").lower() == "true"
+    batch_size = int(config.get("batch_size", 1000))
+    if config.get("duration") and dataset_index is None:
+        # Generate events until the deadline of the collector instead of a fixed number
+        num_events = None
+    if dataset_index is not None:
+        # Replay a pre-generated dataset so event generation is not part of the measured duration
+        path = prepare_dataset(dataset_index, sequence_number, num_events, name)
+        num_events = dataset_size(path)
+        batches = read_dataset(path, batch_size)
+        if not columnar:
+            events = (event for batch in batches for event in batch.events())
+    elif columnar:
+        batches = generate_event_batches(name, 0, num_events, batch_size, sequence_number=sequence_number, device_spread=device_spread)
+    else:
+        events = generate_events(name, 0, num_events, sequence_number=sequence_number, device_spread=device_spread)
+    batch_mode = config.get("batch_mode", False)
+    if columnar and not batch_mode:
+        events = (event for batch in batches for event in batch.events())
+        columnar = False
+    if profiler.enabled():
+        # Timing every single event costs some throughput, so the generate phase is only measured when profiling
+        if columnar:
+            batches = instrumentation.timed(batches, "generate")
+        else:
+            events = instrumentation.timed(events, "generate")
+    # The target rate is per worker, so split it between the processes
+    target_rate = float(config.get("target_rate", 0)) / processes
+    if target_rate:
+        # Open-loop mode: batches are due at a fixed interval independent of how fast the database responds
+        if columnar:
+            batches = instrumentation.paced(batches, batch_size/target_rate)
+        else:
+            send_size = batch_size if batch_mode else 1
+            events = instrumentation.paced(events, send_size/target_rate, send_size)
+    schedule = wait_for_start(name)
+    deadline = None
+    if "end_time" in schedule:
+        deadline = instrumentation.Deadline(schedule["end_time"])
+        if columnar:
+            batches = deadline.limit(batches, len)
+        else:
+            events = deadline.limit(events)
+    instrumentation.reset()
+    stop_samples = threading.Event()
+    sampler = threading.Thread(target=push_samples, args=(stop_samples, float(config.get("sample_interval", 1)), name, process_index == 0), daemon=True)
+    sampler.start()
+    monitor = instrumentation.ResourceMonitor().start()
+    sampler_profile = profiler.SamplingProfiler().start() if profiler.enabled() else None
+    start = time.time()
+    cpu_start = time.process_time()
+    if columnar:
+        module.insert_batches(batches)
+    else:
+        module.insert_events(events)
+    end = time.time()
+    cpu_time = time.process_time() - cpu_start
+    profile = sampler_profile.stop() if sampler_profile else None
+    resources = monitor.stop()
+    stop_samples.set()
+    sampler.join()
+    if deadline:
+        num_events = deadline.events
+    result = dict(operations=num_events, duration=end-start, start_time=start, end_time=end, cpu_time=cpu_time, resources=resources,
+                  latency_histogram=instrumentation.recorder.histogram.to_dict())
+    if profile:
+        result["profile"] = dict(phases=_phase_breakdown(end-start), concurrent_phases=dict(instrumentation.recorder.concurrent_phases),
+                                 sampling=profile)
+    return result
+
+
+def _phase_breakdown(duration):
+    """Returns the seconds the main thread spent per phase, the time not covered by any phase (mostly serialization in the
+    per-event paths) is other"""
+    phases = dict(instrumentation.recorder.phases)
+    phases["other"] = max(0, duration - sum(phases.values()))
+    return phases
+
+
+def _insert_process(args):
+    return insert_process(select_module(), *args)
+
+
+def _merge_process_results(results):
+    histogram = Histogram()
+    for result in results:
+        histogram.merge(Histogram.from_dict(result.pop("latency_histogram")))
+    merged = dict(operations=sum([result["operations"] for result in results]), duration=max([result["duration"] for result in results]),
+                start_time=min([result["start_time"] for result in results]), end_time=max([result["end_time"] for result in results]),
+                cpu_time=sum([result["cpu_time"] for result in results]), resources=instrumentation.merge_resources([result["resources"] for result in results]),
+                latency_histogram=histogram.to_dict(), processes=results)
+    profiles = [result.pop("profile") for result in results if "profile" in result]
+    if profiles:
+        merged["profile"] = dict(phases=profiler.merge_phases([profile["phases"] for profile in profiles]),
+                                 concurrent_phases=profiler.merge_phases([profile.get("concurrent_phases", dict()) for profile in profiles]),
+                                 sampling=profiler.merge([profile["sampling"] for profile in profiles]))
+    return merged
+
+
 def run_insert(module):
     print("Running insert task")
     if config["prefill"]:
         sequence_number = do_prefill(module)
     else:
         sequence_number = 1
-    num_events = int(config["num_inserts"])
-    device_spread = int(config.get("device_spread", "1"))
-    events = generate_events(worker_id(), 0, num_events, sequence_number=sequence_number, device_spread=device_spread)
-    time.sleep(2)
-    start = time.time()
-    module.insert_events(events)
-    duration = time.time() - start
+    processes = int(config.get("processes_per_worker", 1))
+    worker_index = register_worker() if "dataset" in config else None
+    # Every process gets its own share of the events, its own range of sequence numbers and its own dataset file
+    process_args = list()
+    for process_index, (num_events, process_sequence_number) in enumerate(process_shares(int(config["num_inserts"]), sequence_number)):
+        dataset_index = worker_index*processes + process_index if worker_index is not None else None
+        process_args.append((process_index, num_events, process_sequence_number, dataset_index))
+    if processes == 1:
+        data = insert_process(module, *process_args[0])
+    else:
+        print(f"Starting {processes} insert processes", flush=True)
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            data = _merge_process_results(pool.map(_insert_process, process_args))
     url = os.environ.get("COLLECTOR_URL", "http://localhost:5000")
-    data = dict(worker=worker_id(), operations=num_events, duration=duration)
+    data["worker"] = worker_id()
     print(requests.post(f"{url}/result", json=data))
 
 
+def run_mixed(module):
+    print("Running mixed task", flush=True)
+    if not hasattr(module, "queries"):
+        raise Exception("The selected module does not support queries")
+    role = worker_role()
+    print(f"Worker role: {role}", flush=True)
+    if role == "insert":
+        run_insert(module)
+    else:
+        # Query workers take part in the prefill so the insert workers do not wait for them
+        if config["prefill"]:
+            do_prefill(module)
+        # and wait at the start barrier so the first round does not run before the inserts have started
+        run_queries(module, QueryRounds(wait_for_start(worker_id())))
+
+
 def run():
     print("Starting run", flush=True)
     module = select_module()
     wait_for_collector_init()
     task = config.get("task", "insert")
     if task == "query":
+        if null_sink.enabled():
+            raise Exception("The null_sink option can only be used with the insert task")
         run_queries(module)
     elif task == "insert":
+        if null_sink.enabled() and config.get("engine", "sync") != "sync":
+            raise Exception("The null_sink option can only be used with the sync engine")
         run_insert(module)
+    elif task == "mixed":
+        if null_sink.enabled():
+            raise Exception("The null_sink option can only be used with the insert task")
+        run_mixed(module)
+    elif task == "point":
+        if null_sink.enabled():
+            raise Exception("The null_sink option can only be used with the insert task")
+        run_point_queries(module)
+    elif task == "prepare-dataset":
+        run_prepare_dataset()
     else:
         raise Exception(f"Unknown task: {task}")